@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import atexit
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from dotenv import load_dotenv
+import logs
+import metrics
+from tenants import tenant
+from timestamps import ISO_FORMAT
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+ACCOUNTING_DIRECTORY      = os.getenv('ACCOUNTING_DIRECTORY', './temp/accounting') # '' keeps the usage in memory only
+ACCOUNTING_BUCKET_SECONDS = int(os.getenv('ACCOUNTING_BUCKET_SECONDS', 3600)) # width of a time bucket
+ACCOUNTING_FLUSH_INTERVAL = float(os.getenv('ACCOUNTING_FLUSH_INTERVAL', 60)) # seconds between flushes
+ACCOUNTING_TOP_USERS      = int(os.getenv('ACCOUNTING_TOP_USERS', 10)) # users listed per resource
+
+# Metered resources
+STT_SECONDS        = "stt.seconds"
+STT_CACHED_SECONDS = "stt.cached_seconds" # recognitions saved by the transcript cache
+TTS_CHARACTERS     = "tts.characters"
+ASSISTANT_MESSAGES = "assistant.messages"
+CLOUDANT_READS     = "cloudant.reads"
+CLOUDANT_WRITES    = "cloudant.writes"
+COS_PUTS           = "cos.puts"
+COS_BYTES          = "cos.bytes"
+TWILIO_MESSAGES    = "twilio.messages"
+
+logger = logs.get_logger(__name__)
+
+# The message type of the turn being processed, e.g. "text" or "voice"
+message_type = contextvars.ContextVar("message_type", default=None)
+
+# Usage not flushed yet, by (bucket, tenant, user hash, message type, resource)
+_usage = Counter()
+# Usage of the last flush, kept for the usage endpoint
+_flushed = Counter()
+_lock    = threading.Lock()
+_stopped = threading.Event()
+flusher  = None
+
+@contextmanager
+def classified(kind: str):
+    """
+    Charge the usage of the turn being processed to the message type `kind`.
+
+    Parameters
+    ----------
+    kind : str
+        The message type of the turn.
+    """
+    token = message_type.set(kind)
+    try:
+        yield
+    finally:
+        message_type.reset(token)
+
+def charge(resource: str, amount: float = 1):
+    """
+    Charge `amount` of `resource` to the user, the message type and the
+    tenant of the turn being processed, in the current time bucket. Usage
+    outside a turn, e.g. by a broadcast, is charged to no user.
+
+    Parameters
+    ----------
+    resource : str
+        The metered resource, e.g. STT_SECONDS.
+    amount : float
+        The amount consumed.
+    """
+    bucket = int(time.time()) // ACCOUNTING_BUCKET_SECONDS * ACCOUNTING_BUCKET_SECONDS
+    key    = (bucket, tenant().name, logs.user_hash.get(), message_type.get(), resource)
+    with _lock:
+        _usage[key] += amount
+    metrics.increment(f"usage.{resource}", amount)
+
+def usage_records(usage: Counter) -> list:
+    return [{"bucket": datetime.fromtimestamp(bucket, timezone.utc).strftime(ISO_FORMAT),
+             "tenant": name, "user_hash": user, "type": kind,
+             "resource": resource, "amount": round(amount, 3)}
+            for (bucket, name, user, kind, resource), amount in usage.items()]
+
+def flushing():
+    """
+    Append the usage charged since the last flush to the JSON lines file of
+    the day and of this process, in ACCOUNTING_DIRECTORY, so the workers
+    never write to the same file.
+    """
+    global _usage, _flushed
+    with _lock:
+        usage, _usage = _usage, Counter()
+    if not usage:
+        return
+    _flushed = usage
+    if not ACCOUNTING_DIRECTORY:
+        return
+    path = (Path(ACCOUNTING_DIRECTORY)
+            / f"usage-{time.strftime('%Y%m%d', time.gmtime())}-{os.getpid()}.jsonl")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as file:
+            for record in usage_records(usage):
+                file.write(json.dumps(record, separators=(",", ":")) + "\n")
+    except OSError as e:
+        logger.error("Could not write the usage to %s: %s", path, e)
+
+def flushing_periodically():
+    while not _stopped.wait(ACCOUNTING_FLUSH_INTERVAL):
+        flushing()
+
+def start_flusher():
+    """
+    Start the thread flushing the usage, e.g. again in a forked worker,
+    where the thread of the parent process does not exist.
+    """
+    global flusher
+    _stopped.clear()
+    flusher = threading.Thread(target=flushing_periodically, name="accounting", daemon=True)
+    flusher.start()
+
+def after_fork():
+    """
+    Forget the usage charged in the parent process, which flushes it itself,
+    and start a new flushing thread.
+    """
+    global _lock, _usage
+    _lock  = threading.Lock()
+    _usage = Counter()
+    start_flusher()
+
+def stop_flusher():
+    """
+    Flush the remaining usage and stop the flushing thread.
+    """
+    _stopped.set()
+    flushing()
+
+def snapshot() -> dict:
+    """
+    Summarize the usage of the last flush and of the one in progress: the
+    total of each resource by message type, and the users consuming the most
+    of each resource.
+
+    Returns
+    -------
+    dict
+        The totals by message type then resource, and the top users by resource.
+    """
+    with _lock:
+        usage = _flushed + _usage
+    totals = {}
+    users  = {}
+    for (_, _, user, kind, resource), amount in usage.items():
+        by_type = totals.setdefault(kind or "other", {})
+        by_type[resource] = by_type.get(resource, 0) + amount
+        if user:
+            by_user = users.setdefault(resource, Counter())
+            by_user[user] += amount
+    return {"totals": totals,
+            "top_users": {resource: by_user.most_common(ACCOUNTING_TOP_USERS)
+                          for resource, by_user in users.items()}}
+
+start_flusher()
+atexit.register(stop_flusher)
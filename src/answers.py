@@ -0,0 +1,104 @@
+import mimetypes
+from typing import NamedTuple, Optional
+from urllib.parse import urlparse
+
+# Some platforms ship mime tables without the Opus/OGG audio extensions
+mimetypes.add_type('audio/ogg', '.opus')
+mimetypes.add_type('audio/ogg', '.oga')
+
+# Watson Assistant response types that carry a media source
+MEDIA_KINDS = ["audio", "video", "image"]
+
+class Answer(NamedTuple):
+    """
+    A typed answer ready to be delivered to the user.
+
+    Attributes
+    ----------
+    kind : str
+        One of "text", "image", "audio" or "video".
+    mime_type : str
+        The MIME type of the answer content.
+    url : Optional[str]
+        The public link of the media, None for text answers.
+    text : Optional[str]
+        The text of the answer, or the caption/transcript of a media answer.
+    data : Optional[bytes]
+        The media content when it is already in memory, so channels that
+        accept uploads can send it without fetching the URL.
+    """
+    kind: str
+    mime_type: str
+    url: Optional[str] = None
+    text: Optional[str] = None
+    data: Optional[bytes] = None
+
+    @property
+    def is_media(self) -> bool:
+        return self.kind != "text"
+
+    @property
+    def content(self) -> str:
+        """The URL of a media answer or the text of a text answer."""
+        return self.url if self.is_media else self.text
+
+def guess_mime_type(url: str, kind: str) -> str:
+    """
+    Guess the MIME type of a media link from the path of the URL,
+    ignoring query strings and fragments.
+
+    Parameters
+    ----------
+    url : str
+        The media link.
+    kind : str
+        The media kind, used as fallback when the extension is unknown.
+
+    Returns
+    -------
+    str
+        The MIME type of the media.
+    """
+    mime_type, _ = mimetypes.guess_type(urlparse(url).path, strict=False)
+    return mime_type or f"{kind}/*"
+
+def text_answer(text: str) -> Answer:
+    """
+    Build a text answer.
+
+    Parameters
+    ----------
+    text : str
+        The text to deliver.
+
+    Returns
+    -------
+    Answer
+        The typed text answer.
+    """
+    return Answer("text", "text/plain", None, str(text))
+
+def media_answer(kind: str, url: str, mime_type: str = None, text: str = None,
+                 data: bytes = None) -> Answer:
+    """
+    Build a media answer.
+
+    Parameters
+    ----------
+    kind : str
+        One of "image", "audio" or "video".
+    url : str
+        The public link of the media.
+    mime_type : str, optional
+        The MIME type of the media, guessed from the URL when not given.
+    text : str, optional
+        The caption or transcript of the media.
+    data : bytes, optional
+        The media content, when it is already in memory.
+
+    Returns
+    -------
+    Answer
+        The typed media answer.
+    """
+    return Answer(kind, mime_type or guess_mime_type(url, kind), url, text, data)
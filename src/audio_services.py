@@ -1,11 +1,25 @@
-import os, requests
-from datetime import datetime
+import os
+import time
+import shutil
+import hashlib
+import subprocess
+from timestamps import utc_now
 from dotenv import load_dotenv
+from queue import Queue
+from threading import BoundedSemaphore, Thread
 from ibm_watson import SpeechToTextV1, TextToSpeechV1, ApiException
+from ibm_watson.websocket import AudioSource, RecognizeCallback
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from pathlib import Path
-from file_management import write_file, upload_file_cos
-from typing import Tuple
+import accounting
+import metrics
+from cache import BoundedCache
+from logs import get_logger, staged
+from tenants import tenant, tenant_key
+from concurrent.futures import Future
+from file_management import (write_file, upload_file_cos, archive_bytes_cos_async,
+                             archiving_bytes_cos, download_file, stream_file)
+from typing import Iterable, Optional, Tuple
 
 # Load environment variables
 load_dotenv()
@@ -17,17 +31,93 @@ STT_MODEL         = os.getenv('STT_MODEL')
 TTS_API_KEY       = os.getenv('TTS_API_KEY')
 TTS_DEFAULT_VOICE = os.getenv('TTS_DEFAULT_VOICE')
 TTS_SERVICE_URL   = os.getenv('TTS_SERVICE_URL')
+STT_STREAMING     = os.getenv('STT_STREAMING', 'false').lower() == 'true' # bypasses the transcript cache
+STT_MAX_AUDIO_SECONDS = float(os.getenv('STT_MAX_AUDIO_SECONDS', 0)) # 0 disables the limit
+STT_STREAM_TIMEOUT    = float(os.getenv('STT_STREAM_TIMEOUT', 60)) # seconds
+STT_CACHE_SIZE        = int(os.getenv('STT_CACHE_SIZE', 4096))
+STT_CACHE_TTL         = float(os.getenv('STT_CACHE_TTL', 7 * 24 * 3600)) # seconds
+STT_CACHE_PATH        = os.getenv('STT_CACHE_PATH') # optional on-disk persistence
+STT_PREPROCESS         = os.getenv('STT_PREPROCESS', 'false').lower() == 'true'
+STT_PREPROCESS_WORKERS = int(os.getenv('STT_PREPROCESS_WORKERS', 2)) # concurrent ffmpeg processes
+STT_PREPROCESS_TIMEOUT = float(os.getenv('STT_PREPROCESS_TIMEOUT', 10)) # seconds
+STT_SILENCE_THRESHOLD  = os.getenv('STT_SILENCE_THRESHOLD', '-40dB')
+STT_PREPROCESS_BITRATE = os.getenv('STT_PREPROCESS_BITRATE', '16k')
+
+# Audio format delivered as a voice note
+VOICE_MIME_TYPE = 'audio/ogg;codecs=opus'
+
+# Answer used when no speech could be recognized
+UNRECOGNIZABLE_MESSAGE = "Message unrecognizable"
+
+logger = get_logger(__name__)
+
+# Opus granule positions always count samples at 48 kHz
+OPUS_GRANULE_RATE = 48000
+
+# Voice notes are preprocessed by ffmpeg, when installed; each conversion
+# runs in its own ffmpeg process and the semaphore bounds how many run at once
+FFMPEG = shutil.which('ffmpeg')
+preprocess_slots = BoundedSemaphore(STT_PREPROCESS_WORKERS)
 
 # Configuring and authenticating STT and TTS
-speech_to_text = SpeechToTextV1(IAMAuthenticator(STT_API_KEY))
-speech_to_text.set_service_url(STT_SERVICE_URL)
-text_to_speech = TextToSpeechV1(IAMAuthenticator(TTS_API_KEY))
-text_to_speech.set_service_url(TTS_SERVICE_URL)
+def connecting() -> Tuple[SpeechToTextV1, TextToSpeechV1]:
+    """
+    Create the Speech to Text and Text to Speech clients.
+    """
+    stt = SpeechToTextV1(IAMAuthenticator(STT_API_KEY))
+    stt.set_service_url(STT_SERVICE_URL)
+    tts = TextToSpeechV1(IAMAuthenticator(TTS_API_KEY))
+    tts.set_service_url(TTS_SERVICE_URL)
+    return stt, tts
+
+speech_to_text, text_to_speech = connecting()
+
+def after_fork():
+    """
+    Recreate the clients in a forked worker, so it does not share the
+    connections of its parent.
+    """
+    global speech_to_text, text_to_speech
+    speech_to_text, text_to_speech = connecting()
 
 # Create application working directory
 DIRECTORY = './temp'
 Path(DIRECTORY).mkdir(parents=True, exist_ok=True)
 
+# Transcripts and archive links of the audio already recognized,
+# by STT model and audio content hash. Not used with STT_STREAMING, whose
+# recognition starts before the content, and so its hash, is known
+transcript_cache = BoundedCache(STT_CACHE_SIZE, STT_CACHE_TTL, STT_CACHE_PATH)
+
+def text_to_speech_bytes(query: str, accept: str = 'audio/mp3') -> Optional[bytes]:
+    """
+    Given a query as a string, this function will request a speech synthesis 
+    from text and return the resulting audio, encoded as `accept`, in memory.
+    
+    Parameters
+    ----------
+    query : str
+        The text to convert to speech.
+    accept : str
+        The audio format requested from Text to Speech.
+    
+    Returns
+    -------
+    Optional[bytes]
+        The synthesized audio, None if the API request fails
+    """
+    try:
+        audio = text_to_speech.synthesize(
+            query,
+            voice = tenant().tts_voice,
+            accept = accept
+        ).get_result().content
+    except ApiException as ex:
+        logger.error("TTS failed with status code %s: %s", ex.code, ex.message)
+        return None
+    accounting.charge(accounting.TTS_CHARACTERS, len(query))
+    return audio
+
 def text_to_speech_synthesize(file_path: str, query: str) -> None:
     """
     Given a query as a string, this function will request a speech synthesis 
@@ -45,26 +135,13 @@ def text_to_speech_synthesize(file_path: str, query: str) -> None:
     -------
     None
         The function saves the file on the specified path and returns nothing
-    
-    Raises
-    ------
-    ApiException
-        If the API request fails, it raises an exception with the status code 
-        and message provided by the API
     """
-    try:
-        with open(file_path, 'wb') as audio_file:
-            audio_file.write(
-                text_to_speech.synthesize(
-                    query,
-                    voice = TTS_DEFAULT_VOICE,
-                    accept = 'audio/mp3'
-                ).get_result().content
-                )
-    except ApiException as ex:
-        return "Method failed with status code "+str(ex.code)+": "+ex.message
+    audio = text_to_speech_bytes(query)
+    if audio is not None:
+        write_file(file_path, audio)
 
 
+@staged("tts")
 def process_audio_tts(user_ID, query):
     """
     Requests a text-to-speech synthesis from IBM Watson Text to Speech API
@@ -86,8 +163,7 @@ def process_audio_tts(user_ID, query):
         The public URL of the audio file on Cloud Object Storage,
         returns None if the uploading fail.
     """
-    dt_format       = "%d-%m-%Y_%H:%M:%S:%f_UTC"
-    timestamp       = datetime.now().utcnow().strftime(dt_format)
+    timestamp       = utc_now()
     audio_file_name = (DIRECTORY
                        + '/' + str(user_ID)
                        + "_" + str(timestamp)
@@ -95,10 +171,196 @@ def process_audio_tts(user_ID, query):
     text_to_speech_synthesize(audio_file_name, query)
     return upload_file_cos(audio_file_name)
 
+@staged("tts")
+def process_audio_tts_voice(user_ID: str, query: str) -> Tuple[Optional[str], Optional[bytes], Optional[Future]]:
+    """
+    Requests a text-to-speech synthesis encoded as OGG/Opus, which messaging
+    apps play as a voice note, and keeps the audio in memory so it can be
+    uploaded straight to the user. The copy archived on IBM Cloud Object
+    Storage is uploaded in the background.
+    
+    Parameters
+    ----------
+    user_ID : str
+        The user ID used to identify the origin of the audio file on Object Storage
+    query : str
+        The text to convert to speech
+    
+    Returns
+    -------
+    Tuple[Optional[str], Optional[bytes], Optional[Future]]
+        The URL the audio will have on Cloud Object Storage, the audio
+        content and the future of the upload, whose result is None if the
+        upload failed; all None if the synthesis fails.
+    """
+    audio = text_to_speech_bytes(query, VOICE_MIME_TYPE)
+    if audio is None:
+        return None, None, None
+    timestamp       = utc_now()
+    audio_file_name = str(user_ID) + "_" + str(timestamp) + "_chatbot.ogg"
+    audio_link, archived = archiving_bytes_cos(audio_file_name, audio)
+    return audio_link, audio, archived
+
+def ogg_pages(content: bytes, offset: int = 0) -> Iterable[Tuple[int, int]]:
+    """
+    Walk the pages of an OGG stream.
+
+    Parameters
+    ----------
+    content : bytes
+        The OGG stream, possibly cut in the middle of a page.
+    offset : int, optional
+        Where a page starts, to resume a walk that ended at an incomplete page.
+
+    Yields
+    ------
+    Tuple[int, int]
+        The offset where each complete page ends and its granule position.
+    """
+    while content[offset:offset + 4] == b'OggS' and offset + 27 <= len(content):
+        segments    = content[offset + 26]
+        header_size = 27 + segments
+        if offset + header_size > len(content):
+            return
+        body_size = sum(content[offset + 27:offset + header_size])
+        end       = offset + header_size + body_size
+        if end > len(content):
+            return
+        yield end, int.from_bytes(content[offset + 6:offset + 14], 'little', signed=True)
+        offset = end
+
+def ogg_duration(content: bytes) -> float:
+    """
+    Estimate the duration of an OGG/Opus stream from the granule position
+    of its last page, without decoding it.
+
+    Parameters
+    ----------
+    content : bytes
+        The OGG/Opus stream, possibly cut in the middle of a page.
+
+    Returns
+    -------
+    float
+        The duration in seconds of the complete pages.
+    """
+    granule = 0
+    for _, page_granule in ogg_pages(content):
+        if page_granule > 0:
+            granule = page_granule
+    return granule / OPUS_GRANULE_RATE
+
+def truncate_ogg(content: bytes, max_seconds: float) -> bytes:
+    """
+    Cut an OGG/Opus stream at the last page boundary within `max_seconds`.
+
+    Parameters
+    ----------
+    content : bytes
+        The OGG/Opus stream.
+    max_seconds : float
+        The maximum duration to keep, 0 keeps the whole stream.
+
+    Returns
+    -------
+    bytes
+        The truncated stream.
+    """
+    if not max_seconds:
+        return content
+    cut = 0
+    for end, granule in ogg_pages(content):
+        if granule > max_seconds * OPUS_GRANULE_RATE:
+            return content[:cut] if cut else content
+        cut = end
+    return content
+
+def joining_transcripts(results: list) -> str:
+    """
+    Join the best alternative of every result segment of a recognition.
+
+    Parameters
+    ----------
+    results : list
+        The `results` list returned by Speech to Text.
+
+    Returns
+    -------
+    str
+        The transcription of the whole audio, or the unrecognizable message.
+    """
+    transcript = " ".join(
+        str(result['alternatives'][0]['transcript']).strip()
+        for result in results if result.get('alternatives'))
+    if transcript.strip():
+        return transcript.strip().capitalize()
+    return UNRECOGNIZABLE_MESSAGE
+
+def preprocess_command(max_seconds: float) -> list:
+    """
+    Build the ffmpeg command reading OGG/Opus on stdin and writing on stdout
+    the audio trimmed of leading and trailing silence, downmixed to mono
+    16 kHz, capped at `max_seconds` and re-encoded as low-bitrate Opus.
+
+    Parameters
+    ----------
+    max_seconds : float
+        The maximum duration of the output, 0 for no limit.
+
+    Returns
+    -------
+    list
+        The command line.
+    """
+    trimming = f"silenceremove=start_periods=1:start_threshold={STT_SILENCE_THRESHOLD}"
+    command  = [FFMPEG, "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+                "-af", f"{trimming},areverse,{trimming},areverse",
+                "-ac", "1", "-ar", "16000"]
+    if max_seconds:
+        command += ["-t", str(max_seconds)]
+    return command + ["-c:a", "libopus", "-b:a", STT_PREPROCESS_BITRATE,
+                      "-application", "voip", "-f", "ogg", "pipe:1"]
+
+def preprocessing_voice(voice: bytes) -> bytes:
+    """
+    Shrink a voice note before it is sent to Speech to Text, see
+    `preprocess_command`. The original audio is returned when ffmpeg is not
+    installed, fails or does not make the audio smaller.
+
+    Parameters
+    ----------
+    voice : bytes
+        The OGG/Opus audio sent by the user.
+
+    Returns
+    -------
+    bytes
+        The audio to transcribe.
+    """
+    if not FFMPEG:
+        return voice
+    with preprocess_slots:
+        try:
+            result = subprocess.run(
+                preprocess_command(STT_MAX_AUDIO_SECONDS), input=voice,
+                capture_output=True, timeout=STT_PREPROCESS_TIMEOUT, check=True)
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning("Audio preprocessing failed: %s", e)
+            metrics.increment("stt_preprocess.failures")
+            return voice
+    processed = result.stdout
+    if not processed or len(processed) >= len(voice):
+        return voice
+    metrics.increment("stt_preprocess.bytes_in", len(voice))
+    metrics.increment("stt_preprocess.bytes_out", len(processed))
+    return processed
+
 def speech_to_text_recognize(voice: bytes) -> str:
     """
     Given an audio file in ogg format, this function uses IBM Watson Speech to Text 
-    API to transcribe the audio to text.
+    API to transcribe the audio to text. Audio longer than STT_MAX_AUDIO_SECONDS
+    is truncated before being sent, and shrunk by `preprocessing_voice` if
+    STT_PREPROCESS is on.
 
     Parameters
     ----------
@@ -109,42 +371,188 @@ def speech_to_text_recognize(voice: bytes) -> str:
     -------
     str
         The transcription of the speech, as a string
-
-    Raises
-    ------
-    ApiException
-        If the API request fails, it raises an exception with the status code 
-        and message provided by the API
     """
+    audio = truncate_ogg(
+        preprocessing_voice(voice) if STT_PREPROCESS else voice, STT_MAX_AUDIO_SECONDS)
     try: 
         text_from_speech = speech_to_text.recognize(
-            audio        = voice,
+            audio        = audio,
             content_type = 'audio/ogg',
             model        = STT_MODEL,
             low_latency  = True # Ensure that your model is compatible with Low Latency
         ).get_result()
-        if len(text_from_speech['results']) > 0:
-            transcript = str(
-                text_from_speech['results'][0]['alternatives'][0]['transcript'])
-            return transcript.strip().capitalize()
-        else:
-            return "Message unrecognizable"
+        accounting.charge(accounting.STT_SECONDS, ogg_duration(audio))
+        return joining_transcripts(text_from_speech['results'])
     except ApiException as ex:
-        print("Method failed with status code "+str(ex.code)+": "+ex.message)
-        return "Message unrecognizable"
+        logger.error("STT failed with status code %s: %s", ex.code, ex.message)
+        return UNRECOGNIZABLE_MESSAGE
+
+class TranscriptCollector(RecognizeCallback):
+    """
+    Collects the result segments sent by the Speech to Text websocket,
+    keeping the latest hypothesis of each segment.
+    """
+    def __init__(self):
+        RecognizeCallback.__init__(self)
+        self.results = {}
+
+    def on_data(self, data):
+        first_index = data.get('result_index', 0)
+        for index, result in enumerate(data.get('results', [])):
+            self.results[first_index + index] = result
+
+    def on_error(self, error):
+        logger.error("STT websocket failed: %s", error)
+
+    def transcript(self) -> str:
+        return joining_transcripts(
+            [self.results[index] for index in sorted(self.results)])
+
+def speech_to_text_stream(chunks: Iterable[bytes]) -> Tuple[str, bytes]:
+    """
+    Transcribes an OGG audio while it is still being downloaded, streaming
+    each chunk to the Speech to Text websocket interface as it arrives.
+    The stream stops being fed once it exceeds STT_MAX_AUDIO_SECONDS, but the
+    download goes on so the whole audio is archived. Only the pages received
+    since the previous chunk are walked to follow the duration.
+
+    Parameters
+    ----------
+    chunks : Iterable[bytes]
+        The chunks of the audio file, in order.
+
+    Returns
+    -------
+    Tuple[str, bytes]
+        The transcription of the speech and the whole audio content.
+    """
+    audio_buffer = Queue()
+    audio_source = AudioSource(audio_buffer, is_recording=True, is_buffer=True)
+    collector    = TranscriptCollector()
+    recognition  = Thread(
+        target = speech_to_text.recognize_using_websocket,
+        kwargs = dict(
+            audio              = audio_source,
+            content_type       = 'audio/ogg',
+            recognize_callback = collector,
+            model              = STT_MODEL,
+            interim_results    = True,
+            low_latency        = True),
+        daemon = True)
+    recognition.start()
+
+    voice   = bytearray()
+    walked  = 0 # where the first page not walked yet starts
+    granule = 0
+    fed     = 0 # granule position of the audio sent to Speech to Text
+    feeding = True
+    for chunk in chunks:
+        voice.extend(chunk)
+        if not feeding:
+            continue
+        for walked, page_granule in ogg_pages(voice, walked):
+            granule = page_granule if page_granule > 0 else granule
+        if STT_MAX_AUDIO_SECONDS and granule > STT_MAX_AUDIO_SECONDS * OPUS_GRANULE_RATE:
+            feeding = False
+            audio_source.completed_recording()
+            continue
+        fed = granule
+        audio_buffer.put(bytes(chunk))
+    if feeding:
+        audio_source.completed_recording()
+    recognition.join(STT_STREAM_TIMEOUT)
+    accounting.charge(accounting.STT_SECONDS, fed / OPUS_GRANULE_RATE)
+    return collector.transcript(), bytes(voice)
+
+def transcript_cache_key(digest: str) -> str:
+    """
+    Build the transcript cache key of an audio: the STT model and the
+    SHA-256 of the audio content, scoped to the current tenant, since the
+    cached archive link points into the bucket of the tenant.
+
+    Parameters
+    ----------
+    digest : str
+        The SHA-256 of the audio file content.
 
+    Returns
+    -------
+    str
+        The cache key.
+    """
+    return tenant_key(f"{STT_MODEL}:{digest}")
+
+def caching_transcript(key: str, audio_link: str, transcript: str):
+    """
+    Store the archive link and the transcript of an audio in the transcript
+    cache. Failed recognitions are not cached, so they are retried.
+
+    Parameters
+    ----------
+    key : str
+        The transcript cache key of the audio.
+    audio_link : str
+        The public url of the audio file on IBM Cloud Object Storage.
+    transcript : str
+        The transcription of the audio file.
+    """
+    if transcript != UNRECOGNIZABLE_MESSAGE:
+        transcript_cache.set(
+            key, {"audio_link": audio_link, "transcript": transcript})
+
+@staged("stt")
+def process_audio_content(voice: bytes, user_ID: str, timestamp: str) -> Tuple[str, str]:
+    """
+    This function archives an audio file sent from user, already in memory,
+    on IBM Cloud Object Storage in the background and sends its content to
+    the "speech_to_text_recognize" function. Audio already transcribed, such
+    as a forwarded voice note, is answered from the transcript cache and
+    reuses the archived copy.
+
+    Parameters
+    ----------
+    voice : bytes
+        The content of the audio file.
+    user_ID : str
+        The id of the user who sent the audio.
+    timestamp : str
+        The exact moment when user sent the audio.
 
+    Returns
+    -------
+    Tuple[str, str]
+        A tuple containing the public url of the audio file on IBM Cloud Object Storage 
+        and the transcription of the audio file.
+    """
+    digest = hashlib.sha256(voice).hexdigest()
+    key    = transcript_cache_key(digest)
+    cached = transcript_cache.get(key)
+    if cached:
+        metrics.increment("stt_cache.hits")
+        accounting.charge(accounting.STT_CACHED_SECONDS, ogg_duration(voice))
+        return cached["audio_link"], cached["transcript"]
+    metrics.increment("stt_cache.misses")
+    audio_link_cos  = archive_bytes_cos_async(
+        f"{str(user_ID)}_{str(timestamp)}.ogg", voice, digest)
+    text_from_voice = speech_to_text_recognize(voice)
+    caching_transcript(key, audio_link_cos, text_from_voice)
+    return audio_link_cos, text_from_voice
+
+@staged("stt")
 def process_audio_stt(url: str, user_ID: str, timestamp: str) -> Tuple[str, str]:
     """
-    This function downloads an audio file sent from user, uploads it
-    to IBM Cloud Object Storage, then delete the local file. After that,
-    the audio file content, previously stored in a local var, is sent to
-    the "speech_to_text_recognize" function.
+    This function downloads an audio file sent from user into memory and
+    passes it to the "process_audio_content" function, which archives it
+    and transcribes it. When STT_STREAMING is enabled, the audio is
+    transcribed while it downloads and archived once complete. The transcript
+    cache is keyed by the content of the audio, which is only known once the
+    recognition is over, so streaming does not use it: it trades the savings
+    of the cache for the latency of the first transcript.
 
     Parameters
     ----------
     url : str
-        The url of the audio file on IBM Cloud Object Storage.
+        The url of the audio file sent by the user.
     user_ID : str
         The id of the user who sent the audio.
     timestamp : str
@@ -157,9 +565,96 @@ def process_audio_stt(url: str, user_ID: str, timestamp: str) -> Tuple[str, str]
         and the transcription of the audio file.
 
     """
-    audio_file_directory = f"{DIRECTORY}/{str(user_ID)}_{str(timestamp)}.ogg"
-    voice = requests.get(url, allow_redirects=True)
-    write_file(audio_file_directory, voice.content)
-    audio_link_cos  = upload_file_cos(audio_file_directory)
-    text_from_voice = speech_to_text_recognize(voice.content)
-    return audio_link_cos, text_from_voice
\ No newline at end of file
+    if STT_STREAMING:
+        text_from_voice, voice = speech_to_text_stream(stream_file(url))
+        audio_link_cos = archive_bytes_cos_async(
+            f"{str(user_ID)}_{str(timestamp)}.ogg", voice)
+        return audio_link_cos, text_from_voice
+    return process_audio_content(download_file(url), user_ID, timestamp)
+
+def benchmark_preprocessing(paths: Iterable[str], transcribe: bool = False):
+    """
+    Print, for each voice note, the bytes that would be sent to Speech to Text
+    with and without preprocessing, the preprocessing time and, when
+    `transcribe` is set, the time to transcript of both versions. The time to
+    transcript of the preprocessed version includes the preprocessing.
+    Pointing STT_SERVICE_URL to a local stub of Speech to Text measures the
+    client side alone.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        The paths of OGG/Opus voice notes.
+    transcribe : bool
+        Also send both versions to Speech to Text.
+    """
+    totals = [0, 0]
+    transcripts = {"original": 0.0, "preprocessed": 0.0}
+    for path in paths:
+        voice = truncate_ogg(Path(path).read_bytes(), STT_MAX_AUDIO_SECONDS)
+        start = time.monotonic()
+        processed = preprocessing_voice(voice)
+        preprocessing = time.monotonic() - start
+        line = (f"{Path(path).name}: {len(voice)} -> {len(processed)} bytes, "
+                f"{ogg_duration(voice):.1f}s -> {ogg_duration(processed):.1f}s, "
+                f"preprocessed in {preprocessing:.2f}s")
+        totals[0] += len(voice)
+        totals[1] += len(processed)
+        if transcribe:
+            for label, audio, spent in [("original", voice, 0.0),
+                                        ("preprocessed", processed, preprocessing)]:
+                start = time.monotonic()
+                speech_to_text.recognize(audio=audio, content_type='audio/ogg',
+                                         model=STT_MODEL).get_result()
+                spent += time.monotonic() - start
+                transcripts[label] += spent
+                line += f", {label} transcript in {spent:.2f}s"
+        print(line)
+    print(f"total: {totals[0]} -> {totals[1]} bytes "
+          f"({100 * (1 - totals[1] / max(totals[0], 1)):.0f}% saved)")
+    if transcribe:
+        print(f"time to transcript: {transcripts['original']:.2f}s original, "
+              f"{transcripts['preprocessed']:.2f}s preprocessed")
+
+def benchmark_streaming(paths: Iterable[str], chunk_size: int = 16384):
+    """
+    Print, for each voice note, the time to transcript when it is streamed
+    to Speech to Text in chunks of `chunk_size` bytes, as while it downloads,
+    and when it is sent whole. Pointing STT_SERVICE_URL to a local stub of
+    Speech to Text measures the client side alone.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        The paths of OGG/Opus voice notes.
+    chunk_size : int
+        The size of the chunks streamed.
+    """
+    for path in paths:
+        voice = Path(path).read_bytes()
+        start = time.monotonic()
+        _, streamed = speech_to_text_stream(
+            voice[offset:offset + chunk_size] for offset in range(0, len(voice), chunk_size))
+        streaming = time.monotonic() - start
+        start = time.monotonic()
+        speech_to_text_recognize(voice)
+        print(f"{Path(path).name}: {len(voice)} bytes, {ogg_duration(voice):.1f}s, "
+              f"streamed transcript in {streaming:.2f}s ({len(streamed)} bytes kept), "
+              f"whole transcript in {time.monotonic() - start:.2f}s")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmark the preprocessing of voice notes before Speech to Text")
+    parser.add_argument("notes", nargs="+", help="OGG/Opus voice notes")
+    parser.add_argument("--transcribe", action="store_true",
+                        help="also measure the time to transcript")
+    parser.add_argument("--stream", type=int, metavar="CHUNK_SIZE",
+                        help="benchmark the streamed recognition instead, in chunks of this size")
+    arguments = parser.parse_args()
+    if arguments.stream:
+        benchmark_streaming(arguments.notes, arguments.stream)
+    else:
+        if not FFMPEG:
+            parser.error("ffmpeg is not installed")
+        benchmark_preprocessing(arguments.notes, arguments.transcribe)
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import argparse
+from string import Template
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from pathlib import Path
+from dotenv import load_dotenv
+from typing import List, Optional
+import metrics
+from logs import get_logger
+from answers import Answer, media_answer, text_answer
+from audio_services import VOICE_MIME_TYPE, text_to_speech_bytes
+from contacts import IBM_CLOUDANT_CONTACTS_DATABASE, TELEGRAM, WHATSAPP, iter_contacts
+from file_management import upload_bytes_cos
+from rate_limit import TokenBucket
+from telegram_bot import media_registry, return_answer
+from tenants import tenant_by_name, tenant_key, using_tenant
+from twilio_deliver import delivering_answer_whatsapp_rest
+
+########################
+# Setting Environment Variables
+load_dotenv()
+
+# Define environment variables
+BROADCAST_DIRECTORY = os.getenv('BROADCAST_DIRECTORY', './broadcast')
+BROADCAST_PREFIX    = os.getenv('BROADCAST_PREFIX', 'broadcast/')
+BROADCAST_WORKERS   = int(os.getenv('BROADCAST_WORKERS', 16))
+BROADCAST_RATE      = float(os.getenv('BROADCAST_RATE', 20)) # messages per second, all channels
+BROADCAST_BURST     = float(os.getenv('BROADCAST_BURST', 20))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', 10)) # seconds
+
+logger = get_logger(__name__)
+
+def campaign_ID(template: str, audience: dict, voice: bool) -> str:
+    """
+    Derive a stable campaign ID from what is broadcast, so running the same
+    broadcast again resumes it.
+
+    Parameters
+    ----------
+    template : str
+        The message template.
+    audience : dict
+        The Mango selector of the audience.
+    voice : bool
+        Whether the message is sent as audio.
+
+    Returns
+    -------
+    str
+        The campaign ID.
+    """
+    key = json.dumps([template, audience, voice], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+def preparing_voice_asset(campaign: str, text: str) -> Optional[Answer]:
+    """
+    Synthesize the message once and store it on Cloud Object Storage, so
+    every recipient gets the same asset.
+
+    Parameters
+    ----------
+    campaign : str
+        The campaign ID.
+    text : str
+        The text of the message.
+
+    Returns
+    -------
+    Optional[Answer]
+        The audio answer, None if the synthesis or the upload failed.
+    """
+    audio = text_to_speech_bytes(text, VOICE_MIME_TYPE)
+    if audio is None:
+        return None
+    link = upload_bytes_cos(f"{BROADCAST_PREFIX}{campaign}.ogg", audio)
+    if link is None:
+        return None
+    return media_answer("audio", link, "audio/ogg", text=text)
+
+class Broadcast:
+    """
+    A broadcast of one message to the contacts of an audience, fanned out by
+    a pool of senders sharing a token bucket. Progress is checkpointed after
+    each page of contacts, and each contact reached within the page is
+    appended to a journal, so an interrupted broadcast resumes from the last
+    completed page without sending again to the contacts of the journal.
+
+    Parameters
+    ----------
+    template : str
+        The message, where $channel and $chat_ID are replaced per contact.
+    audience : dict
+        The Mango selector of the contacts.
+    voice : bool
+        Send the message as audio instead of text. The audio is synthesized
+        once from the template, without substitution.
+    campaign : str, optional
+        The campaign ID, derived from the broadcast by default.
+    """
+    def __init__(self, template: str, audience: dict, voice: bool = False,
+                 campaign: str = None):
+        self.template = Template(template)
+        self.audience = audience
+        self.voice    = voice
+        self.campaign = campaign or campaign_ID(template, audience, voice)
+        self.checkpoint_path = Path(BROADCAST_DIRECTORY) / f"{self.campaign}.json"
+        self.journal_path    = Path(BROADCAST_DIRECTORY) / f"{self.campaign}.sent"
+        self.journal_lock    = threading.Lock()
+        self.bucket   = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+        self.asset    = None
+        self.state    = {"bookmark": None, "sent": 0, "failed": 0, "done": False}
+        self.started  = None
+        self.reported = 0.0
+        self.resumed_at = 0 # messages sent by previous runs
+        self.warming  = threading.Lock()
+
+    def loading_checkpoint(self):
+        if self.checkpoint_path.exists():
+            self.state.update(json.loads(self.checkpoint_path.read_text()))
+
+    def saving_checkpoint(self):
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.checkpoint_path.with_suffix('.tmp')
+        temporary.write_text(json.dumps(self.state))
+        temporary.replace(self.checkpoint_path)
+
+    def loading_journal(self) -> set:
+        if not self.journal_path.exists():
+            return set()
+        return set(self.journal_path.read_text().split())
+
+    def journaling(self, contact_ID: str):
+        with self.journal_lock, open(self.journal_path, "a") as file:
+            file.write(contact_ID + "\n")
+
+    def answers(self, contact: dict) -> List[Answer]:
+        if self.asset is not None:
+            return [self.asset]
+        return [text_answer(self.template.safe_substitute(contact))]
+
+    def sending(self, contact: dict) -> bool:
+        """
+        Send the message to a contact once the token bucket allows it, and
+        journal the contact once reached.
+
+        Returns
+        -------
+        bool
+            True if the message was sent.
+        """
+        self.bucket.wait()
+        try:
+            with using_tenant(tenant_by_name(contact.get('tenant'))):
+                self.delivering(contact)
+        except Exception as e:
+            logger.warning("Broadcast %s to %s failed: %r", self.campaign, contact['_id'], e)
+            metrics.increment("broadcast.failed")
+            return False
+        self.journaling(contact['_id'])
+        return True
+
+    def delivering(self, contact: dict) -> bool:
+        if contact['channel'] == WHATSAPP:
+            delivering_answer_whatsapp_rest(self.answers(contact), contact['chat_ID'])
+        elif contact['channel'] == TELEGRAM:
+            warming = self.voice and tenant_key(self.asset.url) not in media_registry
+            # The first voice message of a bot is sent alone, the others
+            # reuse the file_id Telegram returned for it
+            with self.warming if warming else nullcontext():
+                return_answer(contact['chat_ID'], self.answers(contact))
+        else:
+            raise ValueError(f"unknown channel {contact['channel']!r}")
+        # Counted for every channel, the warm-up message included
+        metrics.increment("broadcast.sent")
+        return True
+
+    def reporting(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.reported < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self.reported = now
+        elapsed = max(now - self.started, 1e-9)
+        print(f"broadcast {self.campaign}: {self.state['sent']} sent, "
+              f"{self.state['failed']} failed, "
+              f"{(self.state['sent'] - self.resumed_at) / elapsed:.1f} messages/s")
+
+    def run(self) -> dict:
+        """
+        Send the message to every contact of the audience not reached by a
+        previous run of the campaign.
+
+        Returns
+        -------
+        dict
+            The final state of the campaign: sent, failed and done.
+        """
+        self.loading_checkpoint()
+        if self.state['done']:
+            return self.state
+        if self.voice:
+            self.asset = preparing_voice_asset(
+                self.campaign, self.template.template)
+            if self.asset is None:
+                raise RuntimeError("the voice asset could not be prepared")
+        self.checkpoint_path.parent.mkdir(parents=True, exist_ok=True)
+        self.started    = time.monotonic()
+        self.resumed_at = self.state['sent']
+        # Contacts of the interrupted page already reached
+        reached = self.loading_journal()
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS,
+                                thread_name_prefix="broadcast") as executor:
+            for contacts, bookmark in iter_contacts(self.audience, self.state['bookmark']):
+                pending = [contact for contact in contacts if contact['_id'] not in reached]
+                self.state['sent'] += len(contacts) - len(pending)
+                self.resumed_at    += len(contacts) - len(pending)
+                futures = [executor.submit(self.sending, contact) for contact in pending]
+                for future in wait(futures).done:
+                    self.state['sent' if future.result() else 'failed'] += 1
+                self.state['bookmark'] = bookmark
+                self.saving_checkpoint()
+                # The page is checkpointed, its journal is not needed anymore
+                self.journal_path.unlink(missing_ok=True)
+                reached = set()
+                self.reporting()
+        self.state['done'] = True
+        self.saving_checkpoint()
+        self.reporting(force=True)
+        return self.state
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Broadcast a message to the registered contacts")
+    parser.add_argument("template", help="the message; $channel and $chat_ID are substituted")
+    parser.add_argument("--audience", default='{"_id": {"$gt": null}}',
+                        help='Mango selector of the contacts, e.g. \'{"channel": "telegram"}\'')
+    parser.add_argument("--voice", action="store_true",
+                        help="send the message as synthesized audio")
+    parser.add_argument("--campaign", help="campaign ID, to resume a broadcast")
+    arguments = parser.parse_args()
+    if not IBM_CLOUDANT_CONTACTS_DATABASE:
+        parser.error("IBM_CLOUDANT_CONTACTS_DATABASE is not set")
+    Broadcast(arguments.template, json.loads(arguments.audience),
+              arguments.voice, arguments.campaign).run()
@@ -0,0 +1,127 @@
+import atexit
+import json
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from logs import get_logger
+
+logger = get_logger(__name__)
+
+class BoundedCache:
+    """
+    A thread-safe least-recently-used cache with an optional time to live
+    and optional persistence to a JSON file.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of entries; the least recently used entry is
+        evicted when the cache is full.
+    ttl : float, optional
+        Seconds an entry stays valid, entries never expire when None.
+    path : str, optional
+        A JSON file to load the entries from and save them to. The cache is
+        saved every `save_every` writes and when the interpreter exits.
+    save_every : int
+        Number of writes between two saves of the persisted file.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = None,
+                 path: str = None, save_every: int = 50):
+        self.maxsize    = max(int(maxsize), 1)
+        self.ttl        = ttl
+        self.path       = path
+        self.save_every = max(int(save_every), 1)
+        self._entries   = OrderedDict()
+        self._lock      = threading.RLock()
+        self._writes    = 0
+        if self.path:
+            self.load()
+            atexit.register(self.save)
+
+    def _expired(self, expires_at) -> bool:
+        return expires_at is not None and expires_at <= time.time()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for `key`, or `default` if it is missing
+        or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if self._expired(expires_at):
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Store `value` under `key`, evicting the least recently used entries
+        if the cache is full. `ttl` overrides the cache time to live.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._writes += 1
+            should_save = self.path and self._writes % self.save_every == 0
+        if should_save:
+            self.save()
+
+    def pop(self, key, default=None):
+        """
+        Remove `key` from the cache and return its value, or `default`.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None or self._expired(entry[1]):
+            return default
+        return entry[0]
+
+    def __contains__(self, key) -> bool:
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self):
+        """
+        Load the persisted entries, skipping the expired ones.
+        A missing or corrupted file leaves the cache empty.
+        """
+        try:
+            with open(self.path, 'r') as file:
+                entries = json.load(file)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for key, (value, expires_at) in entries:
+                if not self._expired(expires_at):
+                    self._entries[key] = (value, expires_at)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def save(self):
+        """
+        Persist the entries, writing to a temporary file first so that a
+        crash never leaves a truncated file behind.
+        """
+        with self._lock:
+            entries = [[key, list(entry)] for key, entry in self._entries.items()
+                       if not self._expired(entry[1])]
+        temp_path = Path(str(self.path) + '.tmp')
+        try:
+            temp_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(temp_path, 'w') as file:
+                json.dump(entries, file)
+            temp_path.replace(self.path)
+        except OSError as e:
+            logger.warning("Cannot save the cache %s: %s", self.path, e)
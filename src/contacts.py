@@ -0,0 +1,133 @@
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from ibm_cloud_sdk_core import ApiException
+from typing import Iterable, List, Optional, Tuple
+import accounting
+from cache import BoundedCache
+import db
+from db import IBM_CLOUDANT_PAGE_SIZE, printing_db_error
+from tenants import tenant, tenant_key
+from timestamps import utc_now
+
+########################
+# Setting Environment Variables
+load_dotenv()
+
+# Define environment variables
+# Conversations are stored under hashed IDs; the way back to a chat is only
+# kept, in its own database, when IBM_CLOUDANT_CONTACTS_DATABASE is set
+IBM_CLOUDANT_CONTACTS_DATABASE = os.getenv('IBM_CLOUDANT_CONTACTS_DATABASE')
+CONTACTS_REGISTERED_SIZE = int(os.getenv('CONTACTS_REGISTERED_SIZE', 100000))
+
+WHATSAPP = "whatsapp"
+TELEGRAM = "telegram"
+
+# Users already registered by this process, so each is written once
+registered = BoundedCache(CONTACTS_REGISTERED_SIZE)
+registering_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="contacts")
+
+def after_fork():
+    """
+    Recreate the registering pool in a forked worker, whose threads are not
+    inherited.
+    """
+    global registering_executor
+    registering_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="contacts")
+
+def registering_contact(user_ID: str, channel: str, chat_ID: str):
+    """
+    Store the chat a hashed user ID of the current tenant belongs to, unless
+    it is already stored.
+
+    Parameters
+    ----------
+    user_ID : str
+        The hashed ID of the user.
+    channel : str
+        WHATSAPP or TELEGRAM.
+    chat_ID : str
+        The WhatsApp number or the Telegram chat ID of the user.
+    """
+    try:
+        db.service.put_document(
+            db=IBM_CLOUDANT_CONTACTS_DATABASE, doc_id=tenant_key(user_ID),
+            document={"tenant": tenant().name, "channel": channel,
+                      "chat_ID": str(chat_ID), "registered": utc_now()}).get_result()
+    except ApiException as ae:
+        if ae.code != 409: # the contact already exists
+            printing_db_error(ae)
+            registered.pop(tenant_key(user_ID))
+    else:
+        accounting.charge(accounting.CLOUDANT_WRITES)
+
+def register_contact(user_ID: str, channel: str, chat_ID: str):
+    """
+    Register the chat of a user in the background, once per process, when
+    the contacts database is configured.
+
+    Parameters
+    ----------
+    user_ID : str
+        The hashed ID of the user.
+    channel : str
+        WHATSAPP or TELEGRAM.
+    chat_ID : str
+        The WhatsApp number or the Telegram chat ID of the user.
+    """
+    if not IBM_CLOUDANT_CONTACTS_DATABASE or tenant_key(user_ID) in registered:
+        return
+    registered.set(tenant_key(user_ID), True)
+    registering_executor.submit(
+        contextvars.copy_context().run, registering_contact, user_ID, channel, chat_ID)
+
+def contacts_page(selector: dict, bookmark: Optional[str] = None,
+                  limit: int = IBM_CLOUDANT_PAGE_SIZE) -> Tuple[List[dict], Optional[str]]:
+    """
+    Read a page of the contacts matching a Mango selector.
+
+    Parameters
+    ----------
+    selector : dict
+        The Mango selector of the audience, e.g. {"channel": "telegram"}
+        or {"tenant": "default"}.
+    bookmark : str, optional
+        The bookmark returned with the previous page.
+    limit : int
+        The maximum number of contacts of the page.
+
+    Returns
+    -------
+    Tuple[List[dict], Optional[str]]
+        The contacts, and the bookmark of the next page (None on the last page).
+    """
+    options = {"bookmark": bookmark} if bookmark else {}
+    result = db.service.post_find(
+        db=IBM_CLOUDANT_CONTACTS_DATABASE, selector=selector,
+        fields=["_id", "tenant", "channel", "chat_ID"], limit=limit, **options).get_result()
+    accounting.charge(accounting.CLOUDANT_READS)
+    docs = result['docs']
+    return docs, (result.get('bookmark') if len(docs) == limit else None)
+
+def iter_contacts(selector: dict, bookmark: Optional[str] = None) -> Iterable[Tuple[List[dict], Optional[str]]]:
+    """
+    Stream the contacts matching a Mango selector, one page at a time.
+
+    Parameters
+    ----------
+    selector : dict
+        The Mango selector of the audience.
+    bookmark : str, optional
+        The bookmark to resume from.
+
+    Yields
+    ------
+    Tuple[List[dict], Optional[str]]
+        A page of contacts, and the bookmark of the next page.
+    """
+    while True:
+        docs, bookmark = contacts_page(selector, bookmark)
+        yield docs, bookmark
+        if bookmark is None:
+            return
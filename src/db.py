@@ -1,9 +1,20 @@
 import os
-from datetime import datetime
+import json
+import hashlib
+from timestamps import to_sortable, utc_now
 from dotenv import load_dotenv
-from ibmcloudant.cloudant_v1 import CloudantV1
+from ibmcloudant.cloudant_v1 import (BulkDocs, CloudantV1, DesignDocument,
+                                     DesignDocumentOptions,
+                                     DesignDocumentViewsMapReduce)
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from ibm_cloud_sdk_core import ApiException
+from typing import List, Optional, Tuple
+import accounting
+import shadow
+from logs import get_logger
+from tenants import tenant
+from history_archive import (HISTORY_INLINE_THRESHOLD, archived_sessions_page,
+                             compact_document, discarding_archive)
 
 ########################
 # Setting Environment Variables and setting up services
@@ -13,11 +24,94 @@ load_dotenv()
 IBM_CLOUDANT_URL = os.getenv('IBM_CLOUDANT_URL')
 IBM_CLOUDANT_APIKEY = os.getenv('IBM_CLOUDANT_APIKEY')
 IBM_CLOUDANT_DATABASE = os.getenv('IBM_CLOUDANT_DATABASE')
+IBM_CLOUDANT_PAGE_SIZE = int(os.getenv('IBM_CLOUDANT_PAGE_SIZE', 200))
+IBM_CLOUDANT_PARTITIONED = os.getenv('IBM_CLOUDANT_PARTITIONED', 'false').lower() == 'true'
+HISTORY_COMPACTION_ATTEMPTS = int(os.getenv('HISTORY_COMPACTION_ATTEMPTS', 3)) # when the document changes meanwhile
+
+# Design document indexing every shift by (user, time)
+HISTORY_DESIGN_DOC = 'history'
+HISTORY_VIEW       = 'by_time'
+HISTORY_VIEW_MAP   = """
+function (doc) {
+  if (!doc.conversation) return;
+  doc.conversation.forEach(function (session) {
+    (session.conversation || []).forEach(function (shift) {
+      var person = shift.hasOwnProperty('user') ? 'user' : 'chatbot';
+      emit([doc._id, shift.timestamp],
+           {session_ID: session.session_ID, person: person, message: shift[person]});
+    });
+  });
+}
+"""
+
+# Partitioned layout: each session is a document `{user_hash}:{session_ID}`
+# in the partition of its user, indexed by the time of its shifts
+SESSION_TYPE               = 'session'
+SESSIONS_INDEX             = 'sessions-by-time'
+PARTITION_HISTORY_VIEW_MAP = """
+function (doc) {
+  if (doc.type !== 'session') return;
+  (doc.conversation || []).forEach(function (shift) {
+    var person = shift.hasOwnProperty('user') ? 'user' : 'chatbot';
+    emit(shift.timestamp,
+         {session_ID: doc.session_ID, person: person, message: shift[person]});
+  });
+}
+"""
+
+logger = get_logger(__name__)
 
 # Configuring and authenticating 
-authenticator = IAMAuthenticator(IBM_CLOUDANT_APIKEY)
-service = CloudantV1(authenticator=authenticator)
-service.set_service_url(IBM_CLOUDANT_URL)
+def connecting() -> CloudantV1:
+    """
+    Create the Cloudant client.
+    """
+    client = CloudantV1(authenticator=IAMAuthenticator(IBM_CLOUDANT_APIKEY))
+    client.set_service_url(IBM_CLOUDANT_URL)
+    return client
+
+service = connecting()
+
+def after_fork():
+    """
+    Recreate the client in a forked worker, so it does not share the
+    connections of its parent.
+    """
+    global service
+    service = connecting()
+
+def printing_db_error(ae: ApiException):
+    """
+    Log the details of a failed database request.
+
+    Parameters
+    ----------
+    ae : ApiException
+        The exception raised by the Cloudant SDK.
+    """
+    reason = None
+    if (ae.http_response is not None and "reason" in ae.http_response.json()):
+        reason = ae.http_response.json()['reason']
+    logger.error("DB method failed with status code %s: %s (reason: %s)",
+                 ae.code, ae.message, reason)
+
+def partition_document_ID(ID: str, name: str) -> str:
+    """
+    Build the ID of a document in the partition of a user.
+
+    Parameters
+    ----------
+    ID : str
+        The hashed ID of the user, used as partition key.
+    name : str
+        The session ID, or the name of a per-user document.
+
+    Returns
+    -------
+    str
+        The partitioned document ID.
+    """
+    return f"{ID}:{name}"
 
 def verify_document_exists(ID: str) -> bool:
     """
@@ -35,18 +129,21 @@ def verify_document_exists(ID: str) -> bool:
 
     """
     try:
-        all_docs = service.post_all_docs(db=IBM_CLOUDANT_DATABASE, include_docs=False).get_result()
-        for doc in all_docs['rows']:
-            if doc['id'] == ID:
-                return True
-        return False
+        if IBM_CLOUDANT_PARTITIONED:
+            rows = service.post_partition_all_docs(
+                db=tenant().database, partition_key=ID, limit=1).get_result()['rows']
+            accounting.charge(accounting.CLOUDANT_READS)
+            return len(rows) > 0
+        service.head_document(db=tenant().database, doc_id=ID).get_result()
+        accounting.charge(accounting.CLOUDANT_READS)
+        return True
     except ApiException as ae:
-        print("DB Method failed")
-        print(f" - status code: {str(ae.code)}")
-        print(f" - error message: {ae.message}")
-        if ("reason" in ae.http_response.json()):
-            print(f" - reason: {ae.http_response.json()['reason']}")
-            
+        if ae.code == 404:
+            accounting.charge(accounting.CLOUDANT_READS)
+            return False
+        printing_db_error(ae)
+
+
 def reading_doc(ID: str) -> dict:
     """
     Fetches a document with the specified ID from the IBM Cloudant database.
@@ -64,14 +161,39 @@ def reading_doc(ID: str) -> dict:
         The document with the specified ID.
     """
     try:
-        doc = service.get_document(db=IBM_CLOUDANT_DATABASE, doc_id=ID).get_result()
+        doc = service.get_document(db=tenant().database, doc_id=ID).get_result()
+        accounting.charge(accounting.CLOUDANT_READS)
+        return doc
+    except ApiException as ae:
+        printing_db_error(ae)
+
+def reading_partition_doc(ID: str, name: str) -> Optional[dict]:
+    """
+    Fetches a document of the partition of a user, such as a session.
+    
+    Parameters
+    ----------
+    ID : str
+        The hashed ID of the user.
+    name : str
+        The session ID, or the name of the per-user document.
+    
+    Returns
+    -------
+    Optional[dict]
+        The document, None if it does not exist yet.
+    """
+    try:
+        doc = service.get_document(
+            db=tenant().database,
+            doc_id=partition_document_ID(ID, name)).get_result()
+        accounting.charge(accounting.CLOUDANT_READS)
         return doc
     except ApiException as ae:
-        print("DB Method failed")
-        print(f" - status code: {str(ae.code)}")
-        print(f" - error message: {ae.message}")
-        if ("reason" in ae.http_response.json()):
-            print(f" - reason: {ae.http_response.json()['reason']}")
+        if ae.code == 404:
+            accounting.charge(accounting.CLOUDANT_READS)
+        else:
+            printing_db_error(ae)
 
 def viewing_last_session_ID(ID: str) -> str:
     """
@@ -88,6 +210,15 @@ def viewing_last_session_ID(ID: str) -> str:
     str
         The session ID of the last conversation in the document.
     """
+    if IBM_CLOUDANT_PARTITIONED:
+        # Partition-scoped query, served by the partitioned sessions index
+        sessions = service.post_partition_find(
+            db=tenant().database, partition_key=ID,
+            selector={"type": SESSION_TYPE, "timestamp": {"$gt": None}},
+            sort=[{"timestamp": "desc"}], fields=["session_ID"],
+            limit=1).get_result()['docs']
+        accounting.charge(accounting.CLOUDANT_READS)
+        return sessions[0]['session_ID'] if sessions else None
     doc = reading_doc(ID)
     return doc['conversation'][-1]['session_ID']
 
@@ -103,37 +234,71 @@ def create_new_document(ID: str, session_ID: str):
     session_ID : str
         The session ID for the new document
     """
-    if not verify_document_exists(ID):
+    if IBM_CLOUDANT_PARTITIONED:
+        upload_doc(new_session_document(ID, session_ID, utc_now()))
+    elif not verify_document_exists(ID):
         document = {
             "_id": ID,
             "conversation": [
                 {
                     "session_ID": session_ID,
-                    "timestamp": datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f"),
+                    "timestamp": utc_now(),
                     "conversation": []
                 }
             ]
         }
         upload_doc(document)
 
+def new_session_document(ID: str, session_ID: str, timestamp: str) -> dict:
+    """
+    Build an empty session document of the partitioned layout.
+    
+    Parameters
+    ----------
+    ID : str
+        The hashed ID of the user
+    session_ID : str
+        The session ID
+    timestamp : str
+        The moment the session started
+
+    Returns
+    -------
+    dict
+        The session document
+    """
+    return {
+        "_id": partition_document_ID(ID, session_ID),
+        "type": SESSION_TYPE,
+        "session_ID": session_ID,
+        "timestamp": timestamp,
+        "conversation": []}
+
 def upload_doc(doc):
     """
     Uploads a document to the IBM Cloudant database.
-    If there is an error communicating with the database, an exception is raised.
+    If there is an error communicating with the database, it is logged.
     
     Parameters
     ----------
     doc : dict
         The document to be uploaded
+
+    Returns
+    -------
+    bool
+        True if the document was written, False if it was refused, e.g. on a
+        conflict with a newer revision
     """
+    if shadow.suppressing.get():
+        return True
     try:
-        service.post_document(db=IBM_CLOUDANT_DATABASE, document=doc).get_result()
+        service.post_document(db=tenant().database, document=doc).get_result()
     except ApiException as ae:
-        print("DB Method failed")
-        print(f" - status code: {str(ae.code)}")
-        print(f" - error message: {ae.message}")
-        if ("reason" in ae.http_response.json()):
-            print(f" - reason: {ae.http_response.json()['reason']}")
+        printing_db_error(ae)
+        return False
+    accounting.charge(accounting.CLOUDANT_WRITES)
+    return True
 
 def generate_shift(person: str, message: str, timestamp: str) -> dict:
     """
@@ -158,10 +323,52 @@ def generate_shift(person: str, message: str, timestamp: str) -> dict:
         'timestamp': timestamp}
     return shift
 
-def update_conversation_shift(ID: str, session_ID: str, person: str, message: str, timestamp: str):
+def context_digest(context_variables: dict) -> str:
+    """
+    Hash the context variables of a conversation, independently of the
+    order of their keys.
+    
+    Parameters
+    ----------
+    context_variables : dict
+        The user defined context variables
+
+    Returns
+    -------
+    str
+        The SHA-256 of the canonical JSON of the variables
+    """
+    canonical = json.dumps(context_variables, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def updating_context_variables(doc: dict, session_ID: str, context_variables: dict):
+    """
+    Store the context variables in a document under the `context_variables`
+    key, unless the document already holds the same variables.
+    
+    Parameters
+    ----------
+    doc : dict
+        The document to update in place
+    session_ID : str
+        The session ID of the conversation
+    context_variables : dict
+        user defined context variables of the conversation
+    """
+    digest = context_digest(context_variables)
+    if doc.get('context_variables', {}).get('hash') != digest:
+        doc['context_variables'] = {
+            "session_ID": session_ID,
+            "hash": digest,
+            "values": context_variables}
+
+def update_conversation_shift(ID: str, session_ID: str, person: str, message: str, timestamp: str,
+                              context_variables: dict = None):
     """
     Update the conversation shift with the specified ID, session ID, person, message, and timestamp 
     in the IBM Cloudant database, if conversation does not exist it creates a new one.
+    The context variables, when given, are stored in the same write under the
+    `context_variables` key, only if they changed.
     
     Parameters
     ----------
@@ -175,7 +382,22 @@ def update_conversation_shift(ID: str, session_ID: str, person: str, message: st
         message for this conversation shift
     timestamp : str
         timestamp for this conversation shift
+    context_variables : dict, optional
+        user defined context variables of the conversation
+
+    Returns
+    -------
+    bool
+        True if the shift was written
     """
+    if IBM_CLOUDANT_PARTITIONED:
+        # Only the session document is read and rewritten
+        doc = (reading_partition_doc(ID, session_ID)
+               or new_session_document(ID, session_ID, timestamp))
+        doc['conversation'].append(generate_shift(person, message, str(timestamp)))
+        if context_variables is not None:
+            updating_context_variables(doc, session_ID, context_variables)
+        return upload_doc(doc)
     conversation_exists = False
     doc = reading_doc(ID)
     for session in doc['conversation']:
@@ -189,21 +411,380 @@ def update_conversation_shift(ID: str, session_ID: str, person: str, message: st
                 "conversation":[generate_shift(person, message, timestamp)],
             }
         doc['conversation'].append(new_conversation)
-    upload_doc(doc)
+    if context_variables is not None:
+        updating_context_variables(doc, session_ID, context_variables)
+    # Archive the old sessions in the same write as the new shift
+    compacted = (HISTORY_INLINE_THRESHOLD and len(doc['conversation']) > HISTORY_INLINE_THRESHOLD
+                 and compact_document(doc))
+    if upload_doc(doc):
+        return True
+    if compacted:
+        discarding_archive(doc)
+    return False
+
+def unlinking_audio(ID: str, session_ID: str, audio_link: str) -> bool:
+    """
+    Replace the link of an audio answer that could not be archived with None
+    in the chatbot shifts of a session, as for an answer whose synthesis
+    failed, so the history does not point at a missing object.
+
+    Parameters
+    ----------
+    ID : str
+        The ID of the user
+    session_ID : str
+        The session ID of the conversation
+    audio_link : str
+        The COS link of the audio
+
+    Returns
+    -------
+    bool
+        True if the link was replaced, or was not found
+    """
+    for _ in range(HISTORY_COMPACTION_ATTEMPTS):
+        if IBM_CLOUDANT_PARTITIONED:
+            doc      = reading_partition_doc(ID, session_ID)
+            sessions = [doc] if doc else []
+        else:
+            doc      = reading_doc(ID)
+            sessions = [session for session in (doc or {}).get('conversation', [])
+                        if session.get('session_ID') == session_ID]
+        shifts = [shift for session in sessions for shift in session.get('conversation', [])
+                  if isinstance(shift.get('chatbot'), list) and audio_link in shift['chatbot']]
+        if not shifts:
+            return True
+        for shift in shifts:
+            shift['chatbot'] = [None if part == audio_link else part for part in shift['chatbot']]
+        if upload_doc(doc):
+            return True
+    return False
 
-def upload_specific_feature(ID: str, feature_name: str, value):
+def compact_history(ID: str) -> bool:
     """
-    Update specific feature to a document with the specified ID and feature name and value in the IBM Cloudant database.
+    Move the old sessions of a document to a compressed archive on Cloud
+    Object Storage, keeping a pointer to the archive in the document. If the
+    document changed since it was read, the archive is deleted and the
+    compaction starts over from the new revision.
     
     Parameters
     ----------
     ID : str
-        The ID of the document to be updated
-    feature_name : str
-        feature name to be updated
-    value : any
-        The value to be updated for the feature
+        The ID of the document to compact
+
+    Returns
+    -------
+    bool
+        True if the document was compacted
     """
-    doc = reading_doc(ID)
-    doc[feature_name] = value
-    upload_doc(doc)
\ No newline at end of file
+    if IBM_CLOUDANT_PARTITIONED:
+        return compact_partition_history(ID)
+    for _ in range(HISTORY_COMPACTION_ATTEMPTS):
+        doc = reading_doc(ID)
+        if not doc or not compact_document(doc):
+            return False
+        if upload_doc(doc):
+            return True
+        discarding_archive(doc)
+    return False
+
+def reading_partition_sessions(ID: str) -> List[dict]:
+    """
+    Fetch all the session documents of a user, oldest first, with a
+    partition-scoped query.
+    
+    Parameters
+    ----------
+    ID : str
+        The hashed ID of the user
+
+    Returns
+    -------
+    List[dict]
+        The session documents
+    """
+    sessions = []
+    bookmark = None
+    while True:
+        page = service.post_partition_find(
+            db=tenant().database, partition_key=ID,
+            selector={"type": SESSION_TYPE, "timestamp": {"$gt": None}},
+            sort=[{"timestamp": "asc"}], limit=IBM_CLOUDANT_PAGE_SIZE,
+            bookmark=bookmark).get_result()
+        accounting.charge(accounting.CLOUDANT_READS)
+        sessions.extend(page['docs'])
+        if len(page['docs']) < IBM_CLOUDANT_PAGE_SIZE:
+            return sessions
+        bookmark = page['bookmark']
+
+def compact_partition_history(ID: str) -> bool:
+    """
+    Move the old session documents of a user to a compressed archive on
+    Cloud Object Storage and delete them, keeping the pointers to the
+    archives in the `{user_hash}:archive` document. The sessions are only
+    deleted once the pointer is saved; if the pointers document changed
+    since it was read, the archive is deleted and the compaction starts over.
+    
+    Parameters
+    ----------
+    ID : str
+        The hashed ID of the user
+
+    Returns
+    -------
+    bool
+        True if sessions were archived
+    """
+    for _ in range(HISTORY_COMPACTION_ATTEMPTS):
+        sessions = reading_partition_sessions(ID)
+        index    = (reading_partition_doc(ID, 'archive')
+                    or {"_id": partition_document_ID(ID, 'archive'), "archived_sessions": []})
+        history  = {"_id": ID, "conversation": sessions,
+                    "archived_sessions": index['archived_sessions']}
+        if not compact_document(history):
+            return False
+        index['archived_sessions'] = history['archived_sessions']
+        if upload_doc(index):
+            break
+        discarding_archive(history)
+    else:
+        return False
+    archived = sessions[:len(sessions) - len(history['conversation'])]
+    results  = service.post_bulk_docs(
+        db=tenant().database,
+        bulk_docs=BulkDocs(docs=[{"_id": session['_id'], "_rev": session['_rev'],
+                                  "_deleted": True} for session in archived])).get_result()
+    accounting.charge(accounting.CLOUDANT_WRITES)
+    for result in results:
+        if result.get('error'):
+            # Changed since it was read, it stays and is archived again next time
+            logger.warning("Archived session %s was not deleted: %s", result.get('id'), result['error'])
+    return True
+
+def compact_all_histories() -> int:
+    """
+    Compact every document of the database, paging through the document IDs
+    so the memory used does not depend on the size of the database.
+
+    Returns
+    -------
+    int
+        The number of documents compacted
+    """
+    compacted = 0
+    start_key = None
+    last_ID   = None
+    while True:
+        page = service.post_all_docs(
+            db=tenant().database, include_docs=False,
+            limit=IBM_CLOUDANT_PAGE_SIZE + 1, start_key=start_key).get_result()
+        rows = page['rows']
+        for row in rows[:IBM_CLOUDANT_PAGE_SIZE]:
+            if row['id'].startswith('_design/'):
+                continue
+            # In the partitioned layout every user owns several documents
+            ID = row['id'].split(':')[0] if IBM_CLOUDANT_PARTITIONED else row['id']
+            if ID != last_ID and compact_history(ID):
+                compacted += 1
+            last_ID = ID
+        if len(rows) <= IBM_CLOUDANT_PAGE_SIZE:
+            return compacted
+        start_key = rows[-1]['id']
+
+def reading_archived_sessions(ID: str, offset: int = 0, limit: int = 10) -> List[dict]:
+    """
+    Read a page of the sessions of a document that were archived on Cloud
+    Object Storage, oldest first. Archives outside the page are not fetched.
+    
+    Parameters
+    ----------
+    ID : str
+        The ID of the document
+    offset : int
+        The number of archived sessions to skip
+    limit : int
+        The maximum number of sessions to return
+
+    Returns
+    -------
+    List[dict]
+        The archived sessions of the page
+    """
+    if IBM_CLOUDANT_PARTITIONED:
+        doc = reading_partition_doc(ID, 'archive')
+    else:
+        doc = reading_doc(ID)
+    if not doc:
+        return []
+    return archived_sessions_page(doc, offset, limit)
+
+def create_history_index():
+    """
+    Create, or update, the design document indexing every shift of the
+    database by user ID and timestamp (by timestamp within each partition
+    in the partitioned layout).
+    """
+    if IBM_CLOUDANT_PARTITIONED:
+        design_document = DesignDocument(
+            views={HISTORY_VIEW: DesignDocumentViewsMapReduce(map=PARTITION_HISTORY_VIEW_MAP)},
+            options=DesignDocumentOptions(partitioned=True))
+    else:
+        design_document = DesignDocument(views={
+            HISTORY_VIEW: DesignDocumentViewsMapReduce(map=HISTORY_VIEW_MAP)})
+    try:
+        current = service.get_design_document(
+            db=tenant().database, ddoc=HISTORY_DESIGN_DOC).get_result()
+        design_document.rev = current['_rev']
+    except ApiException as ae:
+        if ae.code != 404:
+            raise
+    service.put_design_document(
+        db=tenant().database, ddoc=HISTORY_DESIGN_DOC,
+        design_document=design_document).get_result()
+
+def query_history(ID: str, since: str = None, until: str = None, limit: int = 50,
+                  cursor: Tuple[str, str, int] = None) -> Tuple[List[dict], Optional[Tuple[str, str, int]]]:
+    """
+    Query the shifts of a user between two moments through the (user, time)
+    index, without loading the user document. Pages are chained by passing
+    the returned cursor as `cursor` of the next query. Several shifts can
+    share a timestamp, even within a document, so the cursor is the position
+    of the first shift of the next page in the index: its timestamp, its
+    document ID and the number of rows of that timestamp and document that
+    precede it.
+    
+    Parameters
+    ----------
+    ID : str
+        The ID of the user document
+    since : str, optional
+        ISO-8601 UTC timestamp of the first shift to return, inclusive
+    until : str, optional
+        ISO-8601 UTC timestamp of the last shift to return, inclusive
+    limit : int
+        The maximum number of shifts to return
+    cursor : Tuple[str, str, int], optional
+        The cursor returned with the previous page, replaces `since`
+
+    Returns
+    -------
+    Tuple[List[dict], Optional[Tuple[str, str, int]]]
+        The shifts, oldest first, each with its timestamp, session ID, person
+        and message, and the cursor of the next page (None on the last page)
+    """
+    timestamp, doc_ID, skip = cursor or (since or "", None, 0)
+    if IBM_CLOUDANT_PARTITIONED:
+        # Partition-scoped view, only the index of this user is read
+        rows = service.post_partition_view(
+            db=tenant().database, partition_key=ID,
+            ddoc=HISTORY_DESIGN_DOC, view=HISTORY_VIEW,
+            start_key=timestamp, start_key_doc_id=doc_ID, skip=skip or None,
+            end_key=until or {}, limit=limit + 1).get_result()['rows']
+        keys = [row['key'] for row in rows]
+    else:
+        rows = service.post_view(
+            db=tenant().database, ddoc=HISTORY_DESIGN_DOC, view=HISTORY_VIEW,
+            start_key=[ID, timestamp], start_key_doc_id=doc_ID, skip=skip or None,
+            end_key=[ID, until or {}], limit=limit + 1).get_result()['rows']
+        keys = [row['key'][1] for row in rows]
+    shifts = [dict(row['value'], timestamp=key) for row, key in zip(rows[:limit], keys)]
+    if len(rows) <= limit:
+        return shifts, None
+    position = (keys[limit], rows[limit]['id'])
+    preceding = sum(1 for row, key in zip(rows[:limit], keys) if (key, row['id']) == position)
+    if preceding == limit and position == (timestamp, doc_ID):
+        # The whole page is at the position of the cursor, which skipped some already
+        preceding += skip
+    return shifts, (*position, preceding)
+
+def migrating_document_timestamps(doc: dict) -> bool:
+    """
+    Convert the legacy timestamps of a document to ISO-8601 UTC in place.
+    
+    Parameters
+    ----------
+    doc : dict
+        The conversation document of a user
+
+    Returns
+    -------
+    bool
+        True if any timestamp changed
+    """
+    changed = False
+    def converting(item, field):
+        nonlocal changed
+        if field in item:
+            sortable = to_sortable(item[field])
+            changed  = changed or sortable != item[field]
+            item[field] = sortable
+    if doc.get('type') == SESSION_TYPE:
+        sessions = [doc]
+    else:
+        sessions = doc.get('conversation', [])
+    for session in sessions:
+        converting(session, 'timestamp')
+        for shift in session.get('conversation', []):
+            converting(shift, 'timestamp')
+    for pointer in doc.get('archived_sessions', []):
+        converting(pointer, 'from')
+        converting(pointer, 'to')
+    return changed
+
+def migrate_legacy_timestamps() -> int:
+    """
+    Convert the legacy timestamps of every document of the database to
+    ISO-8601 UTC, one page of documents and one bulk write at a time.
+
+    Returns
+    -------
+    int
+        The number of documents migrated
+    """
+    migrated  = 0
+    start_key = None
+    while True:
+        rows = service.post_all_docs(
+            db=tenant().database, include_docs=True,
+            limit=IBM_CLOUDANT_PAGE_SIZE + 1, start_key=start_key).get_result()['rows']
+        changed = [row['doc'] for row in rows[:IBM_CLOUDANT_PAGE_SIZE]
+                   if not row['id'].startswith('_design/')
+                   and migrating_document_timestamps(row['doc'])]
+        if changed:
+            service.post_bulk_docs(
+                db=tenant().database, bulk_docs=BulkDocs(docs=changed)).get_result()
+            migrated += len(changed)
+        if len(rows) <= IBM_CLOUDANT_PAGE_SIZE:
+            return migrated
+        start_key = rows[-1]['id']
+
+def setup_database():
+    """
+    Create the database, partitioned if IBM_CLOUDANT_PARTITIONED is on,
+    along with the indexes used by the application.
+    """
+    try:
+        service.put_database(
+            db=tenant().database, partitioned=IBM_CLOUDANT_PARTITIONED).get_result()
+    except ApiException as ae:
+        if ae.code != 412: # the database already exists
+            raise
+    if IBM_CLOUDANT_PARTITIONED:
+        service.post_index(
+            db=tenant().database, name=SESSIONS_INDEX, ddoc=SESSIONS_INDEX,
+            index={"fields": ["timestamp"]}, type='json', partitioned=True).get_result()
+    create_history_index()
+
+if __name__ == "__main__":
+    import sys
+    command = sys.argv[1] if len(sys.argv) > 1 else "compact"
+    if command == "compact":
+        print(f"{compact_all_histories()} documents compacted")
+    elif command == "migrate-timestamps":
+        print(f"{migrate_legacy_timestamps()} documents migrated")
+    elif command == "create-indexes":
+        create_history_index()
+    elif command == "setup":
+        setup_database()
+    else:
+        print("Usage: python db.py [compact|migrate-timestamps|create-indexes|setup]")
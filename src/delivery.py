@@ -0,0 +1,185 @@
+import os
+import time
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlencode
+from dotenv import load_dotenv
+from typing import Optional
+import logs
+import metrics
+from cache import BoundedCache
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+DELIVERY_STATUS_CALLBACK_URL = os.getenv('DELIVERY_STATUS_CALLBACK_URL') # public URL of /delivery-status
+DELIVERY_BUFFER_SIZE = int(os.getenv('DELIVERY_BUFFER_SIZE', 10000)) # status events kept
+
+# Upper bounds, in seconds, of the delivery latency histograms
+LATENCY_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60, 300]
+
+# Statuses of a part that will never reach the user
+FAILED_STATUSES = ["failed", "undelivered"]
+
+# Statuses a part can be given, any other is recorded as "unknown" so that
+# callers cannot create metric keys at will
+KNOWN_STATUSES = {"accepted", "scheduled", "canceled", "queued", "sending", "sent",
+                  "delivered", "read", "partially_delivered", *FAILED_STATUSES}
+
+# When the inbound message of the turn being processed was received
+turn_started = contextvars.ContextVar("turn_started", default=None)
+
+# Latest status events, (time, turn, part, channel, status, latency, error code)
+events = deque(maxlen=DELIVERY_BUFFER_SIZE)
+
+# Highest part index delivered for each recent turn. The callbacks of a turn
+# only all reach the same process with a single worker per node, the
+# out-of-order count misses the turns whose callbacks are split otherwise
+delivered_parts = BoundedCache(DELIVERY_BUFFER_SIZE)
+
+@contextmanager
+def tracking_turn(started: float = None):
+    """
+    Measure the delivery latencies of the parts of a turn from when its
+    inbound message was sent, if the channel tells, or from now.
+
+    Parameters
+    ----------
+    started : float, optional
+        When the inbound message was sent, as a UNIX time.
+    """
+    token = turn_started.set(started or time.time())
+    try:
+        yield
+    finally:
+        turn_started.reset(token)
+
+def status_callback(part: int) -> Optional[str]:
+    """
+    Build the status callback URL of an outbound part of the current turn.
+    The turn, the part and the time the turn started travel in the URL, so
+    the callback can be received by any worker or node.
+
+    Parameters
+    ----------
+    part : int
+        The index of the part in the answer.
+
+    Returns
+    -------
+    Optional[str]
+        The URL, None if DELIVERY_STATUS_CALLBACK_URL is not set or no turn
+        is being tracked.
+    """
+    if not DELIVERY_STATUS_CALLBACK_URL or turn_started.get() is None:
+        return None
+    query = urlencode({"turn": logs.turn_ID.get() or "", "part": part,
+                       "t0": f"{turn_started.get():.3f}"})
+    return f"{DELIVERY_STATUS_CALLBACK_URL}?{query}"
+
+def recording(channel: str, status: str, turn: str = None, part: int = None,
+              started: float = None, error_code: str = None):
+    """
+    Record a status of an outbound part: add it to the ring buffer, to the
+    latency histogram of its channel and status, and to the failure rate.
+    The failure rate is over the parts whose final status this process
+    received, delivered or failed, so it holds whichever worker receives
+    the callbacks.
+
+    Parameters
+    ----------
+    channel : str
+        "whatsapp" or "telegram".
+    status : str
+        The status of the part, one of KNOWN_STATUSES.
+    turn : str, optional
+        The ID of the inbound turn the part answers.
+    part : int, optional
+        The index of the part in the answer.
+    started : float, optional
+        When the inbound message was received, as a UNIX time.
+    error_code : str, optional
+        The error code of a failed part.
+    """
+    status  = status if status in KNOWN_STATUSES else "unknown"
+    now     = time.time()
+    latency = round(max(now - started, 0), 3) if started else None
+    events.append((round(now, 3), turn, part, channel, status, latency, error_code))
+    prefix = f"delivery.{channel}"
+    metrics.increment(f"{prefix}.{status}")
+    if status == "queued":
+        metrics.increment(f"{prefix}.parts")
+    if latency is not None:
+        for bound in LATENCY_BUCKETS:
+            if latency <= bound:
+                metrics.increment(f"{prefix}.{status}.latency_le_{bound}")
+        metrics.increment(f"{prefix}.{status}.latency_count")
+        metrics.increment(f"{prefix}.{status}.latency_sum", latency)
+    if status in FAILED_STATUSES:
+        metrics.increment(f"{prefix}.failures")
+    if status in FAILED_STATUSES or status == "delivered":
+        metrics.increment(f"{prefix}.settled")
+        metrics.set_gauge(f"{prefix}.failure_rate",
+                          metrics.ratio(f"{prefix}.failures", f"{prefix}.settled"))
+    if status == "delivered" and turn and part is not None:
+        highest = delivered_parts.get(turn)
+        if highest is not None and highest > part:
+            # A later part of the answer reached the user first
+            metrics.increment(f"{prefix}.out_of_order")
+        delivered_parts.set(turn, max(part, highest if highest is not None else part))
+
+def recording_part(channel: str, part: int, status: str = "queued"):
+    """
+    Record that a part of the current turn was handed to its channel, and
+    its first status if the channel already gives it.
+
+    Parameters
+    ----------
+    channel : str
+        "whatsapp" or "telegram".
+    part : int
+        The index of the part in the answer.
+    status : str, optional
+        The status of the part once handed over, "queued" by default.
+    """
+    turn, started = logs.turn_ID.get(), turn_started.get()
+    recording(channel, "queued", turn, part, started)
+    if status != "queued":
+        recording(channel, status, turn, part, started)
+
+def percentile(values: list, fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def summary() -> dict:
+    """
+    Summarize the status events of the ring buffer: the number of events
+    and the latency percentiles of each channel and status.
+
+    Returns
+    -------
+    dict
+        The summary, by channel then status.
+    """
+    latencies = {}
+    counts    = {}
+    for _, _, _, channel, status, latency, _ in list(events):
+        key = (channel, status)
+        counts[key] = counts.get(key, 0) + 1
+        if latency is not None:
+            latencies.setdefault(key, []).append(latency)
+    report = {}
+    for (channel, status), count in counts.items():
+        values = sorted(latencies.get((channel, status), []))
+        report.setdefault(channel, {})[status] = {
+            "count": count,
+            "p50": percentile(values, 0.50),
+            "p90": percentile(values, 0.90),
+            "p99": percentile(values, 0.99)}
+    for channel in report:
+        report[channel]["failure_rate"] = metrics.ratio(
+            f"delivery.{channel}.failures", f"delivery.{channel}.settled")
+    return report
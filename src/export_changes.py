@@ -0,0 +1,298 @@
+import os
+import csv
+import dbm
+import gzip
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from dotenv import load_dotenv
+from typing import Dict, List, Tuple
+from db import SESSION_TYPE, service
+from tenants import tenant
+from timestamps import to_sortable, utc_now
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError: # Parquet is optional, compressed CSV is used without it
+    pyarrow = None
+
+########################
+# Setting Environment Variables
+load_dotenv()
+
+# Define environment variables
+EXPORT_DIRECTORY  = os.getenv('EXPORT_DIRECTORY', './export')
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 200)) # documents per changes request
+EXPORT_FOLLOW_INTERVAL = float(os.getenv('EXPORT_FOLLOW_INTERVAL', 30)) # seconds
+
+COLUMNS = ["user_ID", "session_ID", "shift_index", "timestamp", "person",
+           "message", "message_is_audio", "message_parts"]
+
+def reading_watermark(raw: bytes) -> Dict[str, int]:
+    """
+    Decode the watermark of a user: the number of shifts already exported
+    from each of their sessions. A watermark written by an older export, the
+    timestamp of the last shift exported, is returned under the "" key; the
+    sessions it covers are exported from that timestamp on, so the shifts
+    sharing it are exported again rather than lost.
+
+    Parameters
+    ----------
+    raw : bytes
+        The watermark as stored in the dbm file.
+
+    Returns
+    -------
+    Dict[str, int]
+        The shifts exported, by session ID.
+    """
+    value = raw.decode()
+    return json.loads(value) if value.startswith('{') else {"": value}
+
+def flatten_document(doc: dict, watermark: Dict[str, int] = None) -> Tuple[List[dict], Dict[str, int]]:
+    """
+    Flatten the conversation shifts of a user document into rows, skipping
+    the shifts exported by a previous change of the same document. Shifts
+    are only ever appended to a session, so the shifts of a session past
+    the count already exported are the new ones, whatever their timestamps.
+
+    Parameters
+    ----------
+    doc : dict
+        The conversation document of a user.
+    watermark : Dict[str, int], optional
+        The number of shifts already exported from each session of the user.
+
+    Returns
+    -------
+    Tuple[List[dict], Dict[str, int]]
+        One row per new shift, and the updated watermark.
+    """
+    rows      = []
+    watermark = dict(watermark or {})
+    legacy    = watermark.get("")
+    if doc.get('type') == SESSION_TYPE:
+        # Partitioned layout, the document is a single session of its user
+        user_ID, sessions = doc['_id'].split(':')[0], [doc]
+    else:
+        user_ID, sessions = doc['_id'], doc.get('conversation', [])
+        # Sessions moved to the history archive are not exported again
+        watermark = {session.get('session_ID'): watermark[session.get('session_ID')]
+                     for session in sessions if session.get('session_ID') in watermark}
+    for session in sessions:
+        shifts   = session.get('conversation', [])
+        exported = watermark.get(session.get('session_ID'), 0)
+        for index, shift in enumerate(shifts[exported:], exported):
+            timestamp = to_sortable(shift.get('timestamp'))
+            if legacy and session.get('session_ID') not in watermark and timestamp < legacy:
+                continue
+            person  = 'user' if 'user' in shift else 'chatbot'
+            message = shift.get(person)
+            rows.append({
+                "user_ID": user_ID,
+                "session_ID": session.get('session_ID'),
+                "shift_index": index,
+                "timestamp": timestamp,
+                "person": person,
+                "message": json.dumps(message) if isinstance(message, list) else str(message),
+                "message_is_audio": person == 'user' and isinstance(message, list),
+                "message_parts": len(message) if isinstance(message, list) else 1})
+        watermark[session.get('session_ID')] = len(shifts)
+    return rows, watermark
+
+def writing_rows(rows: List[dict], file_stem: Path) -> Path:
+    """
+    Write a batch of rows as a Parquet file, or as a gzip'd CSV file when
+    pyarrow is not installed.
+
+    Parameters
+    ----------
+    rows : List[dict]
+        The rows of the batch.
+    file_stem : Path
+        The path of the file to write, without extension.
+
+    Returns
+    -------
+    Path
+        The path of the written file.
+    """
+    if pyarrow is not None:
+        file_path = file_stem.with_suffix('.parquet')
+        table = pyarrow.Table.from_pylist(rows, schema=pyarrow.schema([
+            ("user_ID", pyarrow.string()), ("session_ID", pyarrow.string()),
+            ("shift_index", pyarrow.int32()), ("timestamp", pyarrow.string()),
+            ("person", pyarrow.string()), ("message", pyarrow.string()),
+            ("message_is_audio", pyarrow.bool_()), ("message_parts", pyarrow.int32())]))
+        pyarrow.parquet.write_table(table, file_path, compression='zstd')
+        return file_path
+    file_path = file_stem.with_suffix('.csv.gz')
+    with gzip.open(file_path, 'wt', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return file_path
+
+def shard_selector(shard: int, shards: int) -> dict:
+    """
+    Build the selector of the documents of a shard. User IDs are SHA-256
+    hashes, so splitting the hexadecimal space evenly balances the shards.
+
+    Parameters
+    ----------
+    shard : int
+        The index of the shard.
+    shards : int
+        The number of shards.
+
+    Returns
+    -------
+    dict
+        The Mango selector on the document ID.
+    """
+    lower = f"{shard * 0x10000 // shards:04x}"
+    if shard == shards - 1:
+        return {"_id": {"$gte": lower}}
+    upper = f"{(shard + 1) * 0x10000 // shards:04x}"
+    return {"_id": {"$gte": lower, "$lt": upper}}
+
+def export_shard(shard: int = 0, shards: int = 1, follow: bool = False) -> int:
+    """
+    Export the new shifts of a shard, following the changes feed from the
+    checkpoint of the previous run. Each batch of changes is written to its
+    own file before the checkpoint moves, so an interrupted export resumes
+    without losing rows. The number of shifts exported from each session of
+    a user is kept in an on-disk dbm file, so memory does not grow with the
+    number of users.
+
+    Parameters
+    ----------
+    shard : int
+        The index of the shard.
+    shards : int
+        The number of shards.
+    follow : bool
+        Keep polling the changes feed once it is caught up.
+
+    Returns
+    -------
+    int
+        The number of rows exported.
+    """
+    directory = Path(EXPORT_DIRECTORY)
+    directory.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = directory / f"checkpoint-{shard}-of-{shards}.json"
+    since = (json.loads(checkpoint_path.read_text())['last_seq']
+             if checkpoint_path.exists() else '0')
+    exported = 0
+    with dbm.open(str(directory / f"watermarks-{shard}-of-{shards}"), 'c') as watermarks:
+        while True:
+            changes = service.post_changes(
+                db=tenant().database, since=since, include_docs=True,
+                limit=EXPORT_BATCH_SIZE, filter='_selector',
+                selector=shard_selector(shard, shards)).get_result()
+            rows    = []
+            updated = {}
+            for change in changes['results']:
+                doc = change.get('doc')
+                if change.get('deleted') or not doc:
+                    continue
+                user_ID   = doc['_id'].split(':')[0]
+                watermark = updated.get(user_ID) or (
+                    reading_watermark(watermarks[user_ID]) if user_ID in watermarks else {})
+                doc_rows, updated[user_ID] = flatten_document(doc, watermark)
+                rows.extend(doc_rows)
+            if rows:
+                stem = utc_now().replace(':', '').replace('.', '')
+                file_path = writing_rows(rows, directory / f"shifts-{shard}-{stem}")
+                exported += len(rows)
+                print(f"shard {shard}: {len(rows)} rows -> {file_path.name}")
+            # The watermarks and the checkpoint only move once the rows are written
+            for user_ID, watermark in updated.items():
+                watermarks[user_ID] = json.dumps(watermark, separators=(',', ':'))
+            since = changes['last_seq']
+            checkpoint_path.write_text(json.dumps({"last_seq": since}))
+            if changes.get('pending', 0) == 0:
+                if not follow:
+                    return exported
+                time.sleep(EXPORT_FOLLOW_INTERVAL)
+
+def export_all(shards: int = 1, follow: bool = False) -> int:
+    """
+    Export every shard in parallel, one process per shard.
+
+    Parameters
+    ----------
+    shards : int
+        The number of shards.
+    follow : bool
+        Keep following the changes feed once it is caught up.
+
+    Returns
+    -------
+    int
+        The number of rows exported.
+    """
+    if shards == 1:
+        return export_shard(0, 1, follow)
+    with ProcessPoolExecutor(max_workers=shards) as executor:
+        results = [executor.submit(export_shard, shard, shards, follow)
+                   for shard in range(shards)]
+        return sum(result.result() for result in results)
+
+def benchmark_export(shifts: int, shifts_per_session: int = 20, sessions_per_user: int = 5):
+    """
+    Print the time to flatten and write synthetic user documents totalling
+    `shifts` shifts, in the format `writing_rows` picks, without Cloudant.
+
+    Parameters
+    ----------
+    shifts : int
+        The number of shifts of all the documents.
+    shifts_per_session : int
+        The number of shifts of each session.
+    sessions_per_user : int
+        The number of sessions of each user document.
+    """
+    per_user = shifts_per_session * sessions_per_user
+    docs = [{"_id": f"{user:064x}", "conversation": [
+                {"session_ID": f"{user}-{session}", "conversation": [
+                    {"timestamp": "2024-01-01 12:00:00.000000",
+                     **({"user": "hello"} if index % 2 == 0 else {"chatbot": ["Hi!", "How can I help?"]})}
+                    for index in range(shifts_per_session)]}
+                for session in range(sessions_per_user)]}
+            for user in range(max(shifts // per_user, 1))]
+    start = time.monotonic()
+    rows  = []
+    for doc in docs:
+        rows.extend(flatten_document(doc)[0])
+    flattened = time.monotonic() - start
+    directory = Path(EXPORT_DIRECTORY)
+    directory.mkdir(parents=True, exist_ok=True)
+    start = time.monotonic()
+    file_path = writing_rows(rows, directory / "benchmark")
+    written = time.monotonic() - start
+    print(f"{len(rows)} rows flattened in {flattened:.2f}s ({len(rows) / max(flattened, 1e-9):.0f} rows/s), "
+          f"written to {file_path.name} in {written:.2f}s ({len(rows) / max(written, 1e-9):.0f} rows/s, "
+          f"{file_path.stat().st_size / 1e6:.1f} MB)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export conversation shifts from the Cloudant changes feed")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="number of shards exported in parallel")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep following the changes feed")
+    parser.add_argument("--benchmark", type=int, metavar="SHIFTS",
+                        help="time flattening and writing this many synthetic shifts instead")
+    arguments = parser.parse_args()
+    if arguments.benchmark:
+        benchmark_export(arguments.benchmark)
+        raise SystemExit
+    start = time.monotonic()
+    rows  = export_all(arguments.shards, arguments.follow)
+    elapsed = time.monotonic() - start
+    print(f"{rows} rows exported in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
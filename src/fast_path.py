@@ -0,0 +1,252 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dotenv import load_dotenv
+from typing import Callable, Dict, List, NamedTuple, Optional, Pattern, Union
+import metrics
+import router
+from answers import Answer, media_answer, text_answer
+import audio_services
+from audio_services import UNRECOGNIZABLE_MESSAGE, text_to_speech_bytes
+from file_management import already_archived, cos_link, upload_bytes_cos
+from logs import get_logger, staged
+from tenants import tenant, tenant_key, tenants, using_tenant
+from watson_assistant import TTS_MIME_TYPE, VOICE_MIME_TYPE, cleaning_text_formatting
+
+########################
+# Setting Environment Variables
+load_dotenv()
+
+# Define environment variables
+DEFAULT_ERROR_MESSAGE        = str(os.getenv('WA_DEFAULT_ERROR_MESSAGE')).replace("_"," ")
+FAST_PATH_RULES_PATH         = os.getenv('FAST_PATH_RULES_PATH') # JSON list of rules, see `loading_rules`
+FAST_PATH_UNRECOGNIZED_REPLY = os.getenv('FAST_PATH_UNRECOGNIZED_REPLY', DEFAULT_ERROR_MESSAGE) # '' asks Watson
+FAST_PATH_PREFIX             = os.getenv('FAST_PATH_PREFIX', 'fast_path/') # COS prefix of the synthesized replies
+FAST_PATH_WORKERS            = int(os.getenv('FAST_PATH_WORKERS', 2))
+
+logger = get_logger(__name__)
+
+class Rule(NamedTuple):
+    """
+    A reply given without calling Watson Assistant.
+
+    Attributes
+    ----------
+    name : str
+        The name of the rule, used in the metrics.
+    reply : str
+        The text of the reply, synthesized for voice turns.
+    new_session : bool
+        Whether the turn starts a new Watson Assistant session, as "break" does.
+    pattern : Optional[Pattern]
+        The regular expression matched by the message, None for phrase rules.
+    """
+    name: str
+    reply: str
+    new_session: bool = False
+    pattern: Optional[Pattern] = None
+
+# Built-in rules, matched by the kind of turn rather than by its text
+NON_SUPPORTED_FILE = Rule("non_supported_file", DEFAULT_ERROR_MESSAGE)
+UNRECOGNIZED       = Rule("unrecognized", FAST_PATH_UNRECOGNIZED_REPLY)
+
+def loading_rules(path: Optional[str]):
+    """
+    Compile the rules of a JSON file, e.g.
+    [{"name": "help", "phrases": ["help", "/help"], "reply": "How can I help you?"},
+     {"name": "restart", "phrases": ["break"], "reply": "Hi!", "new_session": true},
+     {"name": "thanks", "pattern": "^thank(s| you)\\W*$", "reply": "You are welcome!"}]
+    Phrases are matched whole and case-insensitively, patterns in order.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        The path of the rules, None for none.
+
+    Returns
+    -------
+    Tuple[Dict[str, Rule], List[Rule]]
+        The rules by phrase, and the pattern rules.
+    """
+    phrases, patterns = {}, []
+    if not path:
+        return phrases, patterns
+    with open(path) as file:
+        for entry in json.load(file):
+            rule = Rule(entry["name"], entry["reply"], entry.get("new_session", False))
+            for phrase in entry.get("phrases", []):
+                phrases[phrase.strip().lower()] = rule
+            if entry.get("pattern"):
+                patterns.append(rule._replace(pattern=re.compile(entry["pattern"], re.IGNORECASE)))
+    return phrases, patterns
+
+rules_by_phrase, pattern_rules = loading_rules(FAST_PATH_RULES_PATH)
+
+# Shifts of the fast-path turns, written after the reply
+recording_executor = ThreadPoolExecutor(
+    max_workers=FAST_PATH_WORKERS, thread_name_prefix="fast-path")
+
+# Synthesized replies, by tenant, format and text
+voice_replies: Dict[str, Optional[Answer]] = {}
+
+def after_fork():
+    """
+    Recreate the recording pool in a forked worker, whose threads are not
+    inherited.
+    """
+    global recording_executor
+    recording_executor = ThreadPoolExecutor(
+        max_workers=FAST_PATH_WORKERS, thread_name_prefix="fast-path")
+
+def matching_rule(message: Union[str, List[str]], message_is_audio: bool,
+                  non_supported_file: bool) -> Optional[Rule]:
+    """
+    Find the rule answering a turn, if any.
+
+    Parameters
+    ----------
+    message : Union[str, List[str]]
+        The message from the user, [audio link, transcript] for voice.
+    message_is_audio : bool
+        True if the message is in audio format, otherwise False.
+    non_supported_file : bool
+        True if the file type of the message is not supported, otherwise False.
+
+    Returns
+    -------
+    Optional[Rule]
+        The rule, None if the turn goes to Watson Assistant.
+    """
+    if non_supported_file:
+        return NON_SUPPORTED_FILE
+    text = str(message[1] if message_is_audio else message).strip()
+    if UNRECOGNIZED.reply and text in ("", UNRECOGNIZABLE_MESSAGE):
+        return UNRECOGNIZED
+    rule = rules_by_phrase.get(text.lower())
+    if rule:
+        return rule
+    for rule in pattern_rules:
+        if rule.pattern.search(text):
+            return rule
+    return None
+
+def voice_reply(reply: str, voice_native: bool) -> Optional[Answer]:
+    """
+    Synthesize a reply once per tenant and format, and store it on Cloud
+    Object Storage under a key derived from its text and voice, so every
+    turn and every worker share the same asset. A reply already stored by
+    another worker, or before a restart, is linked rather than synthesized
+    again.
+
+    Parameters
+    ----------
+    reply : str
+        The text of the reply.
+    voice_native : bool
+        Whether the channel uploads voice notes directly, which get OGG/Opus
+        kept in memory, rather than MP3 sent by link.
+
+    Returns
+    -------
+    Optional[Answer]
+        The audio answer, None if the synthesis or the upload failed.
+    """
+    phrase    = cleaning_text_formatting(reply)
+    mime_type = VOICE_MIME_TYPE if voice_native else TTS_MIME_TYPE
+    key       = tenant_key(f"{mime_type}:{phrase}")
+    if key in voice_replies:
+        return voice_replies[key]
+    digest    = hashlib.sha256(f"{tenant().tts_voice}:{key}".encode()).hexdigest()[:16]
+    file_name = f"{FAST_PATH_PREFIX}{digest}.{'ogg' if voice_native else 'mp3'}"
+    if already_archived(file_name):
+        # Sent by link, Telegram keeps the file_id after the first send
+        voice_replies[key] = media_answer("audio", cos_link(file_name), mime_type, phrase)
+        return voice_replies[key]
+    audio  = text_to_speech_bytes(
+        phrase, audio_services.VOICE_MIME_TYPE if voice_native else 'audio/mp3')
+    answer = None
+    if audio is not None:
+        link = upload_bytes_cos(file_name, audio)
+        if link:
+            answer = media_answer("audio", link, mime_type, phrase,
+                                  audio if voice_native else None)
+    # Failures are not kept, so the next turn tries again
+    if answer:
+        voice_replies[key] = answer
+    return answer
+
+@staged("fast_path")
+def rule_answers(rule: Rule, message_is_audio: bool, voice_native: bool) -> List[Answer]:
+    """
+    Build the answers of a rule, as Watson Assistant answers are built: a
+    voice turn gets the synthesized reply before its text.
+
+    Parameters
+    ----------
+    rule : Rule
+        The rule answering the turn.
+    message_is_audio : bool
+        True if the message is in audio format, otherwise False.
+    voice_native : bool
+        Whether the channel uploads voice notes directly.
+
+    Returns
+    -------
+    List[Answer]
+        The typed answers.
+    """
+    metrics.increment(f"fast_path.{rule.name}")
+    answers = []
+    if message_is_audio and rule is not NON_SUPPORTED_FILE:
+        audio_answer = voice_reply(rule.reply, voice_native)
+        if audio_answer:
+            answers.append(audio_answer)
+    answers.append(text_answer(rule.reply))
+    return answers
+
+def recording_async(user_ID: str, recording: Callable, *args):
+    """
+    Run `recording` in the background in turn with the turns of the user,
+    so it starts once the turn that submitted it is over, and before the
+    turns of the user that arrive after it.
+
+    Parameters
+    ----------
+    user_ID : str
+        The hashed ID of the user.
+    recording : Callable
+        The function writing the shifts of the turn.
+    """
+    router.submitting_in_order(
+        user_ID, partial(recording_executor.submit, contextvars.copy_context().run),
+        recording, *args).add_done_callback(reporting_failure)
+
+def reporting_failure(future):
+    if future.exception() is not None:
+        logger.error("Recording a fast-path turn failed", exc_info=future.exception())
+
+def warming():
+    """
+    Synthesize the replies of every rule for every tenant, in the format of
+    each of its channels, before the first voice turn needs them.
+    """
+    replies = {rule.reply for rule in [*rules_by_phrase.values(), *pattern_rules, UNRECOGNIZED]
+               if rule.reply}
+    for each in tenants.values():
+        with using_tenant(each):
+            for reply in replies:
+                if each.twilio_number:
+                    voice_reply(reply, False)
+                if each.telegram_token:
+                    voice_reply(reply, True)
+
+def warming_async():
+    """
+    Synthesize the replies on a background thread.
+    """
+    threading.Thread(target=warming, name="fast-path", daemon=True).start()
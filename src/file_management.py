@@ -1,8 +1,19 @@
 import os, requests
+import hashlib
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
 from ibm_boto3 import resource as cos_resource
 from ibm_botocore.client import Config
+from ibm_botocore.exceptions import ClientError
 from pathlib import Path
 from dotenv import load_dotenv
+from typing import Optional, Tuple
+import accounting
+import metrics
+import shadow
+from cache import BoundedCache
+from logs import get_logger, staged
+from tenants import tenant, tenant_key
 
 # Setting Environment Variables and setting up services
 load_dotenv()
@@ -13,17 +24,52 @@ COS_BUCKET = os.getenv('COS_BUCKET')
 COS_BUCKET_LINK = os.getenv('COS_BUCKET_LINK')
 COS_ENDPOINT = os.getenv('COS_ENDPOINT')
 COS_INSTANCE_CRN = os.getenv('COS_INSTANCE_CRN')
+COS_ARCHIVE_WORKERS = int(os.getenv('COS_ARCHIVE_WORKERS', 4))
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 16 * 1024))
+COS_DEDUP = os.getenv('COS_DEDUP', 'false').lower() == 'true'
+COS_DEDUP_PREFIX = os.getenv('COS_DEDUP_PREFIX', 'media/')
+COS_DEDUP_INDEX_SIZE = int(os.getenv('COS_DEDUP_INDEX_SIZE', 100000))
+COS_DEDUP_INDEX_PATH = os.getenv('COS_DEDUP_INDEX_PATH') # optional on-disk persistence
+
+logger = get_logger(__name__)
 
 # Create application working directory
 DIRECTORY = './temp'
 Path(DIRECTORY).mkdir(parents=True, exist_ok=True)
 
-cos = cos_resource('s3',
-    ibm_api_key_id=COS_API_KEY_ID,
-    ibm_service_instance_id=COS_INSTANCE_CRN,
-    config=Config(signature_version='oauth'),
-    endpoint_url=COS_ENDPOINT
-)
+def connecting():
+    """
+    Create the COS resource.
+    """
+    return cos_resource('s3',
+        ibm_api_key_id=COS_API_KEY_ID,
+        ibm_service_instance_id=COS_INSTANCE_CRN,
+        config=Config(signature_version='oauth'),
+        endpoint_url=COS_ENDPOINT
+    )
+
+cos = connecting()
+
+# Pooled HTTP connections used to download the media sent by users
+http = requests.Session()
+
+# Background uploads that are kept out of the reply's critical path
+archive_executor = ThreadPoolExecutor(
+    max_workers=COS_ARCHIVE_WORKERS, thread_name_prefix='cos-archive')
+
+def after_fork():
+    """
+    Recreate the COS resource, the HTTP session and the archive pool in a
+    forked worker, so it does not share the connections of its parent.
+    """
+    global cos, http, archive_executor
+    cos  = connecting()
+    http = requests.Session()
+    archive_executor = ThreadPoolExecutor(
+        max_workers=COS_ARCHIVE_WORKERS, thread_name_prefix='cos-archive')
+
+# Content-addressed keys known to exist in the bucket
+archive_index = BoundedCache(COS_DEDUP_INDEX_SIZE, None, COS_DEDUP_INDEX_PATH)
 
 def write_file(file_path, content):
     """
@@ -56,17 +102,87 @@ def upload_file_cos(file_path):
         The COS link of the uploaded file
     """
     file_name = file_path.lstrip(DIRECTORY + '/')
+    if shadow.suppressing.get():
+        Path(file_path).unlink(missing_ok=True)
+        return cos_link(file_name)
     try:
-        cos.Object(COS_BUCKET, file_name).upload_file(file_path)
+        size = os.path.getsize(file_path)
+        cos.Object(tenant().cos_bucket, file_name).upload_file(file_path)
+        accounting.charge(accounting.COS_PUTS)
+        accounting.charge(accounting.COS_BYTES, size)
         Path(file_path).unlink(missing_ok=True)
     except Exception as e:
-        print(Exception, e)
+        logger.error("COS upload of %s failed: %s", file_name, e)
     else:
-        return COS_BUCKET_LINK + '/' + file_name
+        return tenant().cos_bucket_link + '/' + file_name
+
+def download_file(url: str) -> bytes:
+    """
+    Download a file into memory, reusing the pooled HTTP connections.
+
+    Parameters
+    ----------
+    url: str
+        URL of the file to be downloaded.
+
+    Returns
+    -------
+    bytes
+        The content of the file
+    """
+    return http.get(url, allow_redirects=True).content
+
+def stream_file(url: str):
+    """
+    Download a file in chunks, reusing the pooled HTTP connections, so it can
+    be processed before the download completes.
+
+    Parameters
+    ----------
+    url: str
+        URL of the file to be downloaded.
+
+    Yields
+    ------
+    bytes
+        The chunks of the file, in order
+    """
+    with http.get(url, allow_redirects=True, stream=True) as response:
+        yield from response.iter_content(DOWNLOAD_CHUNK_SIZE)
+
+@staged("media")
+def save_media_content(user_ID: int, timestamp: str, file_type: str, content: bytes,
+                       digest: str = None) -> str:
+    """
+    Archive a media file already in memory on cloud object storage,
+    under a user-specific name, or under its content hash if COS_DEDUP is on.
+    
+    Parameters
+    ----------
+    user_ID: int
+        Identifier of the user
+    timestamp: str
+        Timestamp of the file
+    file_type: str
+        File extension of the media file.
+    content: bytes
+        Content of the media file.
+    digest: str, optional
+        SHA-256 of the content, when already computed.
+        
+    Returns
+    -------
+    str
+        The link of the file in cloud object storage
+    """
+    file_name = f"{user_ID}_{timestamp}_user.{file_type.split('/')[-1]}"
+    return archive_bytes_cos(file_name, content, digest)
 
+@staged("media")
 def save_media_file(user_ID: int, timestamp: str, file_type: str, url: str) -> str:
     """
-    Download a media file from a given URL and save it to a user-specific directory.
+    Download a media file from a given URL and save it to cloud object storage,
+    under a user-specific name. The content is hashed while it downloads.
     
     Parameters
     ----------
@@ -84,8 +200,222 @@ def save_media_file(user_ID: int, timestamp: str, file_type: str, url: str) -> s
     str
         The link of the file in cloud object storage
     """
-    file = requests.get(url, allow_redirects=True)
-    file_path = f"{DIRECTORY}/{user_ID}_{timestamp}_user.{file_type.split('/')[-1]}"
-    write_file(file_path, file.content)
-    file_link_cos = upload_file_cos(file_path)
-    return file_link_cos
\ No newline at end of file
+    content = bytearray()
+    digest  = hashlib.sha256()
+    for chunk in stream_file(url):
+        digest.update(chunk)
+        content.extend(chunk)
+    return save_media_content(
+        user_ID, timestamp, file_type, bytes(content), digest.hexdigest())
+
+def cos_link(file_name: str) -> str:
+    """
+    Build the public COS link of an object of the bucket.
+
+    Parameters
+    ----------
+    file_name: str
+        The key of the object in the bucket
+
+    Returns
+    -------
+    str
+        The COS link of the object
+    """
+    return tenant().cos_bucket_link + '/' + file_name
+
+def upload_bytes_cos(file_name: str, content: bytes):
+    """
+    Uploads `content` straight from memory to the COS bucket specified in
+    the environment variables, under the key `file_name`.
+
+    Parameters
+    ----------
+    file_name: str
+        The key of the object in the bucket
+    content: bytes
+        The content to upload
+
+    Returns
+    -------
+    Optional[str]
+        The COS link of the uploaded object, None if the upload failed
+    """
+    if shadow.suppressing.get():
+        return cos_link(file_name)
+    try:
+        cos.Object(tenant().cos_bucket, file_name).put(Body=content)
+        accounting.charge(accounting.COS_PUTS)
+        accounting.charge(accounting.COS_BYTES, len(content))
+    except Exception as e:
+        logger.error("COS upload of %s failed: %s", file_name, e)
+    else:
+        return cos_link(file_name)
+
+def delete_cos(file_name: str) -> bool:
+    """
+    Deletes the object `file_name` from the COS bucket.
+
+    Parameters
+    ----------
+    file_name: str
+        The key of the object in the bucket
+
+    Returns
+    -------
+    bool
+        True if the object was deleted, or did not exist
+    """
+    if shadow.suppressing.get():
+        return True
+    try:
+        cos.Object(tenant().cos_bucket, file_name).delete()
+    except Exception as e:
+        logger.error("COS deletion of %s failed: %s", file_name, e)
+        return False
+    return True
+
+def archive_key(file_name: str, content: bytes, digest: str = None) -> str:
+    """
+    Choose the key under which a file is archived: its own name, or the
+    SHA-256 of its content if COS_DEDUP is on, so identical files share
+    one object.
+
+    Parameters
+    ----------
+    file_name: str
+        The user-specific name of the file
+    content: bytes
+        The content of the file
+    digest: str, optional
+        SHA-256 of the content, when already computed
+
+    Returns
+    -------
+    str
+        The key of the object in the bucket
+    """
+    if not COS_DEDUP:
+        return file_name
+    digest = digest or hashlib.sha256(content).hexdigest()
+    return COS_DEDUP_PREFIX + digest + Path(file_name).suffix
+
+def already_archived(key: str) -> bool:
+    """
+    Check whether a content-addressed object exists, looking at the local
+    index first and then sending a HEAD request to the bucket.
+
+    Parameters
+    ----------
+    key: str
+        The key of the object in the bucket
+
+    Returns
+    -------
+    bool
+        True if the object exists
+    """
+    if tenant_key(key) in archive_index:
+        return True
+    try:
+        cos.Object(tenant().cos_bucket, key).load()
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            logger.warning("COS HEAD of %s failed: %s", key, e)
+        return False
+    archive_index.set(tenant_key(key), True)
+    return True
+
+def storing_archive(key: str, content: bytes) -> Optional[str]:
+    """
+    Upload `content` under `key`, unless it is a content-addressed object
+    that is already archived, in which case only its link is returned.
+
+    Parameters
+    ----------
+    key: str
+        The key of the object in the bucket
+    content: bytes
+        The content to upload
+
+    Returns
+    -------
+    Optional[str]
+        The COS link of the object, None if the upload failed
+    """
+    if COS_DEDUP and already_archived(key):
+        metrics.increment("cos_dedup.hits")
+        metrics.increment("cos_dedup.bytes_saved", len(content))
+        return cos_link(key)
+    link = upload_bytes_cos(key, content)
+    if link and COS_DEDUP and not shadow.suppressing.get():
+        archive_index.set(tenant_key(key), True)
+    return link
+
+def archive_bytes_cos(file_name: str, content: bytes, digest: str = None) -> Optional[str]:
+    """
+    Archives `content` on the COS bucket, deduplicating it by content hash
+    if COS_DEDUP is on.
+
+    Parameters
+    ----------
+    file_name: str
+        The user-specific name of the file
+    content: bytes
+        The content to upload
+    digest: str, optional
+        SHA-256 of the content, when already computed
+
+    Returns
+    -------
+    Optional[str]
+        The COS link of the object, None if the upload failed
+    """
+    return storing_archive(archive_key(file_name, content, digest), content)
+
+def archive_bytes_cos_async(file_name: str, content: bytes, digest: str = None) -> str:
+    """
+    Schedules the archival of `content` on the COS bucket on a background
+    thread and returns the link the object will have once archived.
+
+    Parameters
+    ----------
+    file_name: str
+        The user-specific name of the file
+    content: bytes
+        The content to upload
+    digest: str, optional
+        SHA-256 of the content, when already computed
+
+    Returns
+    -------
+    str
+        The COS link of the object
+    """
+    return archiving_bytes_cos(file_name, content, digest)[0]
+
+def archiving_bytes_cos(file_name: str, content: bytes, digest: str = None) -> Tuple[str, Future]:
+    """
+    Schedules the archival of `content` on the COS bucket on a background
+    thread, like `archive_bytes_cos_async`, and also returns the future of
+    the upload, for callers that must know whether the link is valid.
+
+    Parameters
+    ----------
+    file_name: str
+        The user-specific name of the file
+    content: bytes
+        The content to upload
+    digest: str, optional
+        SHA-256 of the content, when already computed
+
+    Returns
+    -------
+    Tuple[str, Future]
+        The COS link of the object, and the future of the upload, whose
+        result is None if it failed
+    """
+    key = archive_key(file_name, content, digest)
+    # The upload runs on behalf of the tenant of the turn
+    archived = archive_executor.submit(contextvars.copy_context().run, storing_archive, key, content)
+    return cos_link(key), archived
@@ -0,0 +1,68 @@
+import os
+
+# Server profile of the WhatsApp app, picked up by `gunicorn whatsapp:app`
+# when started from this directory.
+#
+# Turns are processed by the scheduler pools; a web thread only waits for a
+# text turn (up to SCHEDULER_TIMEOUT) or acknowledges a voice turn, so the
+# work is I/O bound and threads are cheap. Each web thread holds at most one
+# text turn, so threads should exceed SCHEDULER_TEXT_WORKERS (48) to keep the
+# text pool busy, with the rest left for voice acknowledgements and probes.
+#
+# The app runs in a single worker: the turns in flight for idempotency, the
+# rate-limit buckets, the queues of each user's turns, the metrics, the
+# delivery statuses and the usage are all kept in the process, and several
+# workers would each see a part of them. It scales with threads instead.
+# Measured with locust against stubbed dependencies (300 ms per turn):
+# 1x64 threads with 48 text workers served 149 turns/s at p95 360 ms, where
+# 4x16 with 8 text workers each served 108 turns/s at p95 1.7 s.
+bind    = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+worker_class = "gthread"
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+threads = int(os.getenv('GUNICORN_THREADS', 64))
+
+# The modules and their SDK clients are imported once, in the master;
+# post_fork recreates what holds connections or threads in each worker
+preload_app = True
+
+# A text turn waits at most SCHEDULER_TIMEOUT (8) seconds for its answer
+timeout          = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive        = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Recycling the worker would drop its in-process state, so it is off by
+# default; set it to recycle now and then, so slow leaks cannot pile up
+max_requests        = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+def post_fork(server, worker):
+    import accounting
+    import audio_services
+    import contacts
+    import db
+    import fast_path
+    import file_management
+    import health
+    import logs
+    import router
+    import scheduler
+    import shadow
+    import twilio_deliver
+    import watson_assistant
+    logs.after_fork()
+    accounting.after_fork()
+    for module in [db, file_management, audio_services, watson_assistant,
+                   twilio_deliver, router, scheduler, contacts, shadow, fast_path]:
+        module.after_fork()
+    # Open the connections, fetch the tokens and synthesize the fast-path
+    # replies before the first turn
+    health.warming_async()
+    fast_path.warming_async()
+
+def worker_exit(server, worker):
+    import accounting
+    import logs
+    import shadow
+    accounting.stop_flusher()
+    shadow.stop_writer()
+    logs.stop_listener()
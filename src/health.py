@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+from dotenv import load_dotenv
+from typing import Callable, Dict, Tuple
+import audio_services
+import db
+import file_management
+import watson_assistant
+from logs import get_logger
+from tenants import tenant
+from timestamps import utc_now
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', 30)) # seconds between readiness checks
+
+logger = get_logger(__name__)
+
+def checking_cloudant():
+    db.service.head_database(db=tenant().database).get_result()
+
+def checking_cos():
+    file_management.cos.meta.client.head_bucket(Bucket=tenant().cos_bucket)
+
+def checking_token(client) -> Callable[[], None]:
+    # Fetching the IAM token is what makes the first call of a Watson client slow
+    return lambda: client().authenticator.token_manager.get_token()
+
+# The dependencies a worker needs before it can answer turns
+CHECKS: Dict[str, Callable[[], None]] = {
+    "cloudant": checking_cloudant,
+    "cos": checking_cos,
+    "assistant": checking_token(lambda: watson_assistant.assistant),
+    "speech_to_text": checking_token(lambda: audio_services.speech_to_text),
+    "text_to_speech": checking_token(lambda: audio_services.text_to_speech)}
+
+status  = {}
+_lock   = threading.Lock()
+_running = threading.Event()
+
+def warming():
+    """
+    Run every dependency check, which also opens the connections and fetches
+    the tokens the first turns would otherwise wait for, and record the result.
+    """
+    for name, check in CHECKS.items():
+        start = time.monotonic()
+        try:
+            check()
+            result = {"ok": True}
+        except Exception as e:
+            logger.warning("Dependency %s is not ready: %s", name, e)
+            result = {"ok": False, "error": str(e)}
+        result.update(latency=round(time.monotonic() - start, 3),
+                      checked=utc_now(), checked_at=time.monotonic())
+        with _lock:
+            status[name] = result
+    _running.clear()
+
+def warming_async():
+    """
+    Run the dependency checks on a background thread, unless they already run.
+    """
+    if _running.is_set():
+        return
+    _running.set()
+    threading.Thread(target=warming, name="health", daemon=True).start()
+
+def readiness() -> Tuple[bool, dict]:
+    """
+    Report whether every dependency answered its last check. Checks older
+    than HEALTH_CHECK_INTERVAL are refreshed in the background, so the
+    readiness probe never waits on a dependency.
+
+    Returns
+    -------
+    Tuple[bool, dict]
+        Whether the worker is ready, and the last check of each dependency.
+    """
+    with _lock:
+        checks = {name: dict(result) for name, result in status.items()}
+    now = time.monotonic()
+    if len(checks) < len(CHECKS) or any(
+            now - result["checked_at"] > HEALTH_CHECK_INTERVAL for result in checks.values()):
+        warming_async()
+    for result in checks.values():
+        result.pop("checked_at")
+    ready = len(checks) == len(CHECKS) and all(result["ok"] for result in checks.values())
+    return ready, checks
@@ -0,0 +1,205 @@
+import os
+import gzip
+import json
+import uuid
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from typing import Iterable, List, Optional
+import file_management
+from file_management import delete_cos, upload_bytes_cos
+from tenants import tenant
+from timestamps import parse_timestamp
+
+########################
+# Setting Environment Variables
+load_dotenv()
+
+# Define environment variables
+HISTORY_MAX_AGE_DAYS     = float(os.getenv('HISTORY_MAX_AGE_DAYS', 30))
+HISTORY_KEEP_SESSIONS    = max(int(os.getenv('HISTORY_KEEP_SESSIONS', 20)), 1)
+HISTORY_ARCHIVE_PREFIX   = os.getenv('HISTORY_ARCHIVE_PREFIX', 'history/')
+HISTORY_INLINE_THRESHOLD = int(os.getenv('HISTORY_INLINE_THRESHOLD', 0)) # 0 disables inline compaction
+
+def last_activity(session: dict) -> Optional[datetime]:
+    """
+    Get the time of the last shift of a session, or the time the session
+    started if it has no shift.
+
+    Parameters
+    ----------
+    session : dict
+        A session of the conversation document.
+
+    Returns
+    -------
+    Optional[datetime]
+        The time of the last activity, None if it cannot be parsed.
+    """
+    if session.get('conversation'):
+        return parse_timestamp(session['conversation'][-1].get('timestamp'))
+    return parse_timestamp(session.get('timestamp'))
+
+def sessions_to_archive(sessions: List[dict], now: datetime) -> int:
+    """
+    Count the oldest sessions that should leave the hot document: those
+    beyond the last HISTORY_KEEP_SESSIONS and those idle for more than
+    HISTORY_MAX_AGE_DAYS. The last session is always kept, so the current
+    session ID can still be read from the document.
+
+    Parameters
+    ----------
+    sessions : List[dict]
+        The sessions of the conversation document, oldest first.
+    now : datetime
+        The current UTC time.
+
+    Returns
+    -------
+    int
+        The number of sessions to archive, from the start of the list.
+    """
+    count = max(len(sessions) - HISTORY_KEEP_SESSIONS, 0)
+    limit = now - timedelta(days=HISTORY_MAX_AGE_DAYS)
+    for index, session in enumerate(sessions):
+        activity = last_activity(session)
+        if activity is None or activity >= limit:
+            break
+        count = max(count, index + 1)
+    return min(count, len(sessions) - 1)
+
+def writing_archive(sessions: List[dict]) -> bytes:
+    """
+    Serialize sessions as gzip'd JSON lines, one session per line.
+
+    Parameters
+    ----------
+    sessions : List[dict]
+        The sessions to archive.
+
+    Returns
+    -------
+    bytes
+        The compressed archive.
+    """
+    lines = "".join(json.dumps(session, separators=(',', ':')) + "\n"
+                    for session in sessions)
+    return gzip.compress(lines.encode('utf-8'))
+
+def reading_archive(key: str) -> List[dict]:
+    """
+    Download and decompress an archive of sessions from Cloud Object Storage.
+
+    Parameters
+    ----------
+    key : str
+        The key of the archive in the bucket.
+
+    Returns
+    -------
+    List[dict]
+        The archived sessions, oldest first.
+    """
+    body  = file_management.cos.Object(tenant().cos_bucket, key).get()['Body'].read()
+    lines = gzip.decompress(body).decode('utf-8').splitlines()
+    return [json.loads(line) for line in lines if line]
+
+def compact_document(doc: dict, now: datetime = None) -> bool:
+    """
+    Move the old sessions of a conversation document to a compressed archive
+    on Cloud Object Storage, keeping only a pointer to the archive in the
+    document. The document is modified in place and must be uploaded by
+    the caller; it is left untouched if the archive upload fails.
+
+    Parameters
+    ----------
+    doc : dict
+        The conversation document of a user.
+    now : datetime, optional
+        The current UTC time.
+
+    Returns
+    -------
+    bool
+        True if sessions were archived and the document changed.
+    """
+    now      = now or datetime.utcnow()
+    sessions = doc.get('conversation', [])
+    count    = sessions_to_archive(sessions, now)
+    if count <= 0:
+        return False
+    archived = sessions[:count]
+    key = (f"{HISTORY_ARCHIVE_PREFIX}{doc['_id']}/"
+           f"{now.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}.jsonl.gz")
+    if upload_bytes_cos(key, writing_archive(archived)) is None:
+        return False
+    doc['conversation'] = sessions[count:]
+    doc.setdefault('archived_sessions', []).append({
+        "key": key,
+        "sessions": count,
+        "first_session_ID": archived[0].get('session_ID'),
+        "last_session_ID": archived[-1].get('session_ID'),
+        "from": archived[0].get('timestamp'),
+        "to": archived[-1].get('timestamp')})
+    return True
+
+def discarding_archive(doc: dict):
+    """
+    Delete the archive written by the last `compact_document` of a document
+    that could not be saved, e.g. because it changed in the meantime, so no
+    archive is left without a pointer to it.
+
+    Parameters
+    ----------
+    doc : dict
+        The conversation document, as compacted.
+    """
+    delete_cos(doc['archived_sessions'][-1]['key'])
+
+def archived_sessions_page(doc: dict, offset: int = 0, limit: int = 10) -> List[dict]:
+    """
+    Read a page of the archived sessions of a conversation document, oldest
+    first. Only the archives overlapping the page are downloaded.
+
+    Parameters
+    ----------
+    doc : dict
+        The conversation document of a user.
+    offset : int
+        The number of archived sessions to skip.
+    limit : int
+        The maximum number of sessions to return.
+
+    Returns
+    -------
+    List[dict]
+        The archived sessions of the page.
+    """
+    page = []
+    for pointer in doc.get('archived_sessions', []):
+        if len(page) >= limit:
+            break
+        if offset >= pointer['sessions']:
+            offset -= pointer['sessions']
+            continue
+        sessions = reading_archive(pointer['key'])
+        page.extend(sessions[offset:offset + limit - len(page)])
+        offset = 0
+    return page
+
+def iter_archived_sessions(doc: dict) -> Iterable[dict]:
+    """
+    Iterate over all the archived sessions of a conversation document,
+    oldest first, downloading each archive only when it is reached.
+
+    Parameters
+    ----------
+    doc : dict
+        The conversation document of a user.
+
+    Yields
+    ------
+    dict
+        The archived sessions.
+    """
+    for pointer in doc.get('archived_sessions', []):
+        yield from reading_archive(pointer['key'])
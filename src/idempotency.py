@@ -0,0 +1,103 @@
+import os
+import threading
+from dotenv import load_dotenv
+from concurrent.futures import Future
+from typing import Callable, Optional, Tuple
+import metrics
+from cache import BoundedCache
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+IDEMPOTENCY_WINDOW      = float(os.getenv('IDEMPOTENCY_WINDOW', 600)) # seconds
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 100000))
+
+IN_FLIGHT = "in_flight"
+COMPLETED = "completed"
+
+# Inbound turns seen within the window, by delivery key
+# (Twilio MessageSid, Telegram update_id), with their state and reply
+turns = BoundedCache(IDEMPOTENCY_MAX_ENTRIES, IDEMPOTENCY_WINDOW)
+_lock = threading.Lock()
+
+def begin_turn(key: Optional[str]) -> Tuple[bool, Optional[str]]:
+    """
+    Register an inbound turn before processing it. A turn whose key was
+    already seen within the window is a retry of the platform and must not
+    be processed again.
+
+    Parameters
+    ----------
+    key : Optional[str]
+        The delivery key of the turn, unique per platform message. None for
+        a message without one, which is never deduplicated.
+
+    Returns
+    -------
+    Tuple[bool, Optional[str]]
+        Whether the turn is a duplicate, and the reply cached when the
+        original turn completed (None while it is still in flight).
+    """
+    if key is None:
+        return False, None
+    with _lock:
+        state = turns.get(key)
+        if state is None:
+            turns.set(key, (IN_FLIGHT, None))
+    metrics.increment("idempotency.turns")
+    if state is None:
+        return False, None
+    metrics.increment("idempotency.duplicates")
+    metrics.set_gauge("idempotency.duplicate_rate",
+                      metrics.ratio("idempotency.duplicates", "idempotency.turns"))
+    return True, state[1]
+
+def complete_turn(key: Optional[str], reply: str = None):
+    """
+    Mark a turn as completed, caching its reply for the retries.
+
+    Parameters
+    ----------
+    key : Optional[str]
+        The delivery key of the turn, None if it has none.
+    reply : str, optional
+        The reply returned to the platform.
+    """
+    if key is not None:
+        turns.set(key, (COMPLETED, reply))
+
+def abandon_turn(key: Optional[str]):
+    """
+    Forget a turn whose processing failed, so that a retry processes it.
+
+    Parameters
+    ----------
+    key : Optional[str]
+        The delivery key of the turn, None if it has none.
+    """
+    if key is not None:
+        turns.pop(key)
+
+def settling_turn(key: Optional[str]) -> Callable[[Future], None]:
+    """
+    Build the done-callback of a turn processed in the background: the turn
+    is completed with its result as reply once it succeeds, or abandoned if
+    it fails, so that a retry processes it.
+
+    Parameters
+    ----------
+    key : Optional[str]
+        The delivery key of the turn, None if it has none.
+
+    Returns
+    -------
+    Callable[[Future], None]
+        The callback, for `Future.add_done_callback`.
+    """
+    def settling(future: Future):
+        if future.cancelled() or future.exception() is not None:
+            abandon_turn(key)
+        else:
+            complete_turn(key, future.result())
+    return settling
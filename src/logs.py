@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+from dotenv import load_dotenv
+import metrics
+from timestamps import ISO_FORMAT
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+LOG_LEVEL        = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE   = int(os.getenv('LOG_QUEUE_SIZE', 10000)) # records waiting to be written
+LOG_ERROR_BURST  = int(os.getenv('LOG_ERROR_BURST', 10)) # identical warnings and errors per window
+LOG_ERROR_WINDOW = float(os.getenv('LOG_ERROR_WINDOW', 60)) # seconds
+
+# Fields of the turn being processed, added to every record
+user_hash = contextvars.ContextVar("user_hash", default=None)
+turn_ID   = contextvars.ContextVar("turn_ID", default=None)
+stage     = contextvars.ContextVar("stage", default=None)
+
+# Seconds spent in each stage by the turn being timed, see `timing_stages`
+stage_seconds = contextvars.ContextVar("stage_seconds", default=None)
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).strftime(ISO_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "user_hash": getattr(record, "user_hash", None),
+            "turn_ID": getattr(record, "turn_ID", None),
+            "stage": getattr(record, "stage", None)}
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TurnFilter(logging.Filter):
+    """
+    Stamps each record with the fields of the turn and samples warnings and
+    errors: at most LOG_ERROR_BURST records with the same logger and message
+    template are kept per LOG_ERROR_WINDOW seconds, and the next record kept
+    tells how many were dropped. A failing dependency then cannot flood the
+    logs. It runs in the thread logging the record, where the context
+    variables of the turn are set.
+    """
+    def __init__(self):
+        super().__init__()
+        self.windows = {}
+        self._lock   = threading.Lock()
+
+    def sampling(self, record: logging.LogRecord) -> bool:
+        signature = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            start, count, suppressed = self.windows.get(signature, (now, 0, 0))
+            if now - start >= LOG_ERROR_WINDOW:
+                start, count = now, 0
+            if count >= LOG_ERROR_BURST:
+                self.windows[signature] = (start, count, suppressed + 1)
+                return False
+            self.windows[signature] = (start, count + 1, 0)
+            if len(self.windows) > 10000: # signatures are bounded, oldest first out
+                self.windows.pop(next(iter(self.windows)))
+        record.suppressed = suppressed
+        return True
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING and not self.sampling(record):
+            return False
+        record.user_hash = user_hash.get()
+        record.turn_ID   = turn_ID.get()
+        record.stage     = stage.get()
+        return True
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the writing thread, dropping them when the queue is
+    full instead of blocking the thread logging them.
+    """
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.increment("logs.dropped")
+
+log_queue = queue.Queue(LOG_QUEUE_SIZE)
+writing_handler = logging.StreamHandler(sys.stdout)
+writing_handler.setFormatter(JsonFormatter())
+listener = None
+
+def start_listener():
+    """
+    Start the thread writing the queued records, e.g. again in a forked
+    worker, where the thread of the parent process does not exist.
+    """
+    global listener
+    listener = QueueListener(log_queue, writing_handler, respect_handler_level=False)
+    listener.start()
+
+def after_fork():
+    """
+    Start a new queue and writing thread in a forked worker. The thread of
+    the parent process is not inherited, and its queue may have been locked
+    at the time of the fork.
+    """
+    global log_queue
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler.queue = log_queue
+    start_listener()
+
+def stop_listener():
+    """
+    Write the queued records and stop the writing thread.
+    """
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+
+root = logging.getLogger("chatbot")
+root.setLevel(LOG_LEVEL)
+root.propagate = False
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.addFilter(TurnFilter())
+root.addHandler(queue_handler)
+start_listener()
+atexit.register(stop_listener)
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Get the logger of a module.
+
+    Parameters
+    ----------
+    name : str
+        The name of the module.
+
+    Returns
+    -------
+    logging.Logger
+        A logger writing JSON records in the background.
+    """
+    return root.getChild(name)
+
+@contextmanager
+def turn(user: str, ID: str):
+    """
+    Tag the records logged while processing a turn, including by the
+    scheduled work that copies the context.
+
+    Parameters
+    ----------
+    user : str
+        The hashed ID of the user.
+    ID : str
+        The ID of the turn, e.g. the MessageSid or the update_id.
+    """
+    tokens = [user_hash.set(user), turn_ID.set(ID)]
+    try:
+        yield
+    finally:
+        turn_ID.reset(tokens[1])
+        user_hash.reset(tokens[0])
+
+@contextmanager
+def timing_stages():
+    """
+    Add up the seconds spent in each stage of the turn being processed,
+    including by the scheduled work that copies the context. A stage nested
+    in another, e.g. "tts" in "assistant", is also counted in the outer one.
+
+    Yields
+    ------
+    dict
+        The seconds spent so far, by stage.
+    """
+    timings = {}
+    token = stage_seconds.set(timings)
+    try:
+        yield timings
+    finally:
+        stage_seconds.reset(token)
+
+def staged(name: str):
+    """
+    Decorates a function so that the records it logs carry its stage, and
+    its duration is added to the stage of the turn being timed.
+
+    Parameters
+    ----------
+    name : str
+        The stage, e.g. "stt", "assistant" or "delivery".
+
+    Returns
+    -------
+    Callable
+        The decorator.
+    """
+    def decorator(function):
+        @wraps(function)
+        def running(*args, **kwargs):
+            if stage.get() == name:
+                # Already timed by the caller, e.g. process_audio_stt
+                return function(*args, **kwargs)
+            token = stage.set(name)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings = stage_seconds.get()
+                if timings is not None:
+                    timings[name] = timings.get(name, 0) + time.perf_counter() - start
+                stage.reset(token)
+        return running
+    return decorator
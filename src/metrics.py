@@ -0,0 +1,55 @@
+import threading
+from collections import Counter
+
+# In-process counters and gauges, exported as JSON by the web app
+_counters = Counter()
+_gauges   = {}
+_lock     = threading.Lock()
+
+def increment(name: str, amount: float = 1):
+    """
+    Increase the counter `name` by `amount`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the counter, dot separated (e.g. "idempotency.duplicates").
+    amount : float
+        The amount to add.
+    """
+    with _lock:
+        _counters[name] += amount
+
+def set_gauge(name: str, value: float):
+    """
+    Set the gauge `name` to `value`.
+
+    Parameters
+    ----------
+    name : str
+        The name of the gauge, dot separated.
+    value : float
+        The current value.
+    """
+    with _lock:
+        _gauges[name] = value
+
+def ratio(numerator: str, denominator: str) -> float:
+    """
+    Divide two counters, returning 0 while the denominator is empty.
+    """
+    with _lock:
+        total = _counters[denominator]
+        return _counters[numerator] / total if total else 0.0
+
+def snapshot() -> dict:
+    """
+    Copy the current counters and gauges.
+
+    Returns
+    -------
+    dict
+        The counters and the gauges, by name.
+    """
+    with _lock:
+        return {"counters": dict(_counters), "gauges": dict(_gauges)}
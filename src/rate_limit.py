@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from typing import Callable
+import metrics
+from cache import BoundedCache
+from tenants import tenant, tenant_key, using_tenant
+
+try:
+    import redis
+except ImportError: # the shared backend is optional
+    redis = None
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+# RATE_LIMIT_RATE (tokens per second), RATE_LIMIT_BURST and
+# RATE_LIMIT_CONCURRENT_TURNS are settings of each tenant, see tenants.py
+RATE_LIMIT_VOICE_COST = float(os.getenv('RATE_LIMIT_VOICE_COST', 3)) # tokens per voice turn
+RATE_LIMIT_MAX_USERS  = int(os.getenv('RATE_LIMIT_MAX_USERS', 100000))
+RATE_LIMIT_MESSAGE    = os.getenv('RATE_LIMIT_MESSAGE', '').replace("_", " ") # empty drops silently
+RATE_LIMIT_REDIS_URL  = os.getenv('RATE_LIMIT_REDIS_URL') # optional backend shared by nodes
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` tokens per second, up to `burst` tokens.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens added per second.
+    burst : float
+        Capacity of the bucket, which starts full.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate    = rate
+        self.burst   = burst
+        self.tokens  = burst
+        self.updated = time.monotonic()
+        self._lock   = threading.Lock()
+
+    def take(self, cost: float = 1) -> bool:
+        """
+        Take `cost` tokens if the bucket holds enough of them.
+
+        Returns
+        -------
+        bool
+            True if the tokens were taken.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < cost:
+                return False
+            self.tokens -= cost
+            return True
+
+    def wait(self, cost: float = 1):
+        """
+        Block until `cost` tokens can be taken, then take them.
+        """
+        while not self.take(cost):
+            time.sleep(max(cost / self.rate / 4, 0.001))
+
+# Local backend: the buckets of the most recent users, and the turns in progress
+buckets      = BoundedCache(RATE_LIMIT_MAX_USERS)
+active_turns = {}
+_lock        = threading.Lock()
+
+# Shared backend, an atomic token bucket kept in Redis
+REDIS_TOKEN_BUCKET = """
+local state  = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local tokens  = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate)
+local allowed = 0
+if tokens >= cost then
+  tokens  = tokens - cost
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+# Release of a turn in progress, without going below zero: the count may
+# have expired while a long turn was running
+REDIS_RELEASE_TURN = """
+local active = tonumber(redis.call('GET', KEYS[1]) or '0')
+if active <= 1 then
+  redis.call('DEL', KEYS[1])
+  return 0
+end
+return redis.call('DECR', KEYS[1])
+"""
+shared = redis.Redis.from_url(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL and redis else None
+taking_shared_tokens  = shared.register_script(REDIS_TOKEN_BUCKET) if shared else None
+releasing_shared_turn = shared.register_script(REDIS_RELEASE_TURN) if shared else None
+
+def _taking_tokens(user_key: str, cost: float) -> bool:
+    rate, burst = tenant().rate_limit_rate, tenant().rate_limit_burst
+    if shared:
+        return bool(taking_shared_tokens(
+            keys=[f"rate_limit:bucket:{user_key}"],
+            args=[rate, burst, cost, time.time()]))
+    bucket = buckets.get(user_key)
+    if bucket is None:
+        bucket = TokenBucket(rate, burst)
+        buckets.set(user_key, bucket)
+    return bucket.take(cost)
+
+def _starting_turn(user_key: str) -> bool:
+    limit = tenant().rate_limit_concurrent_turns
+    if shared:
+        key    = f"rate_limit:active:{user_key}"
+        active = shared.incr(key)
+        shared.expire(key, 300) # a crashed node cannot lock a user out for good
+        if active > limit:
+            releasing_shared_turn(keys=[key])
+            return False
+        return True
+    with _lock:
+        if active_turns.get(user_key, 0) >= limit:
+            return False
+        active_turns[user_key] = active_turns.get(user_key, 0) + 1
+        return True
+
+def acquire_turn(user_hash: str, is_voice: bool = False) -> bool:
+    """
+    Admit a turn of a user before any external call is made: the user must
+    have fewer than RATE_LIMIT_CONCURRENT_TURNS turns in progress and enough
+    tokens in their bucket, with the limits of the current tenant. An
+    admitted turn must be released.
+
+    Parameters
+    ----------
+    user_hash : str
+        The hashed ID of the user.
+    is_voice : bool
+        Whether the turn carries media, which costs RATE_LIMIT_VOICE_COST tokens.
+
+    Returns
+    -------
+    bool
+        True if the turn is admitted.
+    """
+    user_key = tenant_key(user_hash)
+    name     = tenant().name
+    if not _starting_turn(user_key):
+        metrics.increment("rate_limit.throttled.concurrency")
+        metrics.increment(f"tenant.{name}.rate_limit.throttled")
+        return False
+    if not _taking_tokens(user_key, RATE_LIMIT_VOICE_COST if is_voice else 1):
+        release_turn(user_hash)
+        metrics.increment("rate_limit.throttled.rate")
+        metrics.increment(f"tenant.{name}.rate_limit.throttled")
+        return False
+    metrics.increment("rate_limit.admitted")
+    metrics.increment(f"tenant.{name}.turns")
+    return True
+
+def release_turn(user_hash: str):
+    """
+    Mark an admitted turn of a user as finished.
+
+    Parameters
+    ----------
+    user_hash : str
+        The hashed ID of the user.
+    """
+    user_key = tenant_key(user_hash)
+    if shared:
+        releasing_shared_turn(keys=[f"rate_limit:active:{user_key}"])
+        return
+    with _lock:
+        remaining = active_turns.get(user_key, 0) - 1
+        if remaining > 0:
+            active_turns[user_key] = remaining
+        else:
+            active_turns.pop(user_key, None)
+
+def releasing_when_done(user_hash: str) -> Callable[[Future], None]:
+    """
+    Build the done-callback of the job of an admitted turn, releasing the
+    turn once the job returns, fails, or is refused before it starts.
+
+    Parameters
+    ----------
+    user_hash : str
+        The hashed ID of the user.
+
+    Returns
+    -------
+    Callable[[Future], None]
+        The callback, for `Future.add_done_callback`.
+    """
+    # The callback runs outside the context of the turn
+    user_tenant = tenant()
+    def releasing(future: Future):
+        with using_tenant(user_tenant):
+            release_turn(user_hash)
+    return releasing
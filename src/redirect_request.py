@@ -1,6 +1,10 @@
 import os
 from dotenv import load_dotenv
-from typing import List, Union
+from typing import List, Optional, Union
+import fast_path
+from answers import Answer, text_answer
+from shadow import captured, suppressing
+from tenants import tenant_key
 from watson_assistant import assistant_conversation, create_session_ID
 from db import (create_new_document, update_conversation_shift,
                 verify_document_exists, viewing_last_session_ID)
@@ -11,6 +15,7 @@ load_dotenv() # This is used to enable loading environment variables from the
               # .env file
 DEFAULT_ERROR_MESSAGE = str(os.getenv('WA_DEFAULT_ERROR_MESSAGE')).replace("_"," ")
 
+# Current session ID of each user, by tenant
 session_IDs = {}
 
 def update_session_ID(user_ID: int):
@@ -24,10 +29,36 @@ def update_session_ID(user_ID: int):
         The ID of the user.
     """
     session_ID = create_session_ID()
-    session_IDs[user_ID] = session_ID
+    session_IDs[tenant_key(user_ID)] = session_ID
     create_new_document(str(user_ID), session_ID)
 
 
+def recording_fast_path(rule: fast_path.Rule, message: Union[str, List[str]],
+                        user_ID: int, timestamp: float, session_ID: Optional[str] = None):
+    """
+    Write the shifts of a turn answered by a fast-path rule, as
+    `redirect_request` writes them for the turns it answers itself.
+
+    Parameters
+    ----------
+    rule : fast_path.Rule
+        The rule that answered the turn.
+    message : Union[str, List[str]]
+        The message from the user.
+    user_ID : int
+        The ID of the user.
+    timestamp : float
+        The timestamp of the message.
+    session_ID : Optional[str]
+        The session the turn started, None to use the current one.
+    """
+    if session_ID is None:
+        checking_user_existence_DB(user_ID)
+        session_ID = session_IDs[tenant_key(user_ID)]
+    update_conversation_shift(user_ID, session_ID, 'user', message, timestamp)
+    update_conversation_shift(user_ID, session_ID, 'chatbot', rule.reply, timestamp)
+
+
 def checking_user_existence_DB(user_ID: int):
     """
     Check if the user exists in the IBM Cloudant database,
@@ -38,17 +69,27 @@ def checking_user_existence_DB(user_ID: int):
     user_ID : int
         The ID of the user.
     """
+    if suppressing.get() and tenant_key(user_ID) in session_IDs:
+        # A replay keeps the sessions it opened on the candidate assistant
+        return
+    session_ID = None
     if verify_document_exists(user_ID):
-        session_IDs[user_ID] = viewing_last_session_ID(user_ID)
+        session_ID = viewing_last_session_ID(user_ID)
+    if session_ID:
+        session_IDs[tenant_key(user_ID)] = session_ID
     else:
         update_session_ID(user_ID)
 
 
+@captured
 def redirect_request(
     message: Union[str, List[str]], user_ID: int, message_is_audio: bool, 
-    timestamp: float, non_supported_file: bool) -> str:
+    timestamp: float, non_supported_file: bool,
+    voice_native: bool = False) -> List[Answer]:
     """
-    Redirect the user's request to the appropriate function.
+    Redirect the user's request to the appropriate function. Turns matching
+    a fast-path rule are answered at once, and their shifts are written in
+    the background.
 
     Parameters
     ----------
@@ -62,27 +103,40 @@ def redirect_request(
         The timestamp of the message.
     non_supported_file : bool
         True if the file type of the message is not supported, otherwise False.
+    voice_native : bool
+        True if the channel receives audio answers as in-memory voice notes.
 
     Returns
     -------
-    str
-        The response from the chatbot.
+    List[Answer]
+        The typed answers from the chatbot.
     """
+    rule = fast_path.matching_rule(message, message_is_audio, non_supported_file)
+    if rule:
+        session_ID = None
+        if rule.new_session:
+            # Created before answering, so the next turn finds the new session
+            update_session_ID(user_ID)
+            session_ID = session_IDs[tenant_key(user_ID)]
+        fast_path.recording_async(
+            user_ID, recording_fast_path, rule, message, user_ID, timestamp, session_ID)
+        return fast_path.rule_answers(rule, message_is_audio, voice_native)
     if str(message).lower() == "break":
         update_session_ID(user_ID)
         message = "Hi"
     else:
         checking_user_existence_DB(user_ID)
     update_conversation_shift(
-        user_ID, session_IDs[user_ID], 'user', message, timestamp)
+        user_ID, session_IDs[tenant_key(user_ID)], 'user', message, timestamp)
     if message_is_audio:
         return assistant_conversation(
-            message[1], user_ID, session_IDs[user_ID], message_is_audio)
+            message[1], user_ID, session_IDs[tenant_key(user_ID)], message_is_audio,
+            voice_native)
     elif not non_supported_file:
         return assistant_conversation(
-            message, user_ID, session_IDs[user_ID], message_is_audio)
+            message, user_ID, session_IDs[tenant_key(user_ID)], message_is_audio)
     else:
         update_conversation_shift(
-            user_ID, session_IDs[user_ID], 'chatbot',
+            user_ID, session_IDs[tenant_key(user_ID)], 'chatbot',
             DEFAULT_ERROR_MESSAGE, timestamp)
-        return DEFAULT_ERROR_MESSAGE
\ No newline at end of file
+        return [text_answer(DEFAULT_ERROR_MESSAGE)]
\ No newline at end of file
@@ -0,0 +1,175 @@
+import os
+import gzip
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+from typing import Iterable, List
+import accounting
+import logs
+import router
+import shadow
+from delivery import percentile
+from redirect_request import redirect_request, session_IDs, update_session_ID
+from tenants import tenant_by_name, tenant_key, using_tenant
+from timestamps import utc_now
+
+########################
+# Setting Environment Variables
+load_dotenv()
+
+# Define environment variables
+WA_SHADOW_ID      = os.getenv('WA_SHADOW_ID') # candidate assistant, e.g. a new skill version
+REPLAY_WORKERS    = int(os.getenv('REPLAY_WORKERS', 8))
+REPLAY_MAX_DIFFS  = int(os.getenv('REPLAY_MAX_DIFFS', 100)) # differing turns listed in the report
+
+logger = logs.get_logger(__name__)
+
+def reading_captures(paths: Iterable[str]) -> List[dict]:
+    """
+    Read the turns captured by `shadow.captured`, in the order they arrived.
+
+    Parameters
+    ----------
+    paths : Iterable[str]
+        The compressed JSON lines files.
+
+    Returns
+    -------
+    List[dict]
+        The captured turns, by arrival time.
+    """
+    turns = []
+    for path in paths:
+        with gzip.open(path, "rt") as file:
+            turns.extend(json.loads(line) for line in file if line.strip())
+    return sorted(turns, key=lambda turn: turn["at"])
+
+def latencies(values: List[float]) -> dict:
+    values = sorted(round(value, 3) for value in values)
+    return {"p50": percentile(values, 0.50), "p90": percentile(values, 0.90),
+            "p99": percentile(values, 0.99)}
+
+class Replay():
+    """
+    Replays captured turns against a candidate assistant, keeping their
+    pacing sped up by `speedup`, with the writes to Cloudant and Cloud
+    Object Storage suppressed and nothing delivered. Turns go through
+    `redirect_request`, fast path included, without being captured again.
+    Each user gets a session of the candidate assistant, and their turns
+    run one at a time.
+    """
+    def __init__(self, turns: List[dict], assistant_ID: str, speedup: float = 1):
+        self.turns        = turns
+        self.assistant_ID = assistant_ID
+        self.speedup      = speedup
+        self.results      = []
+        self.lock         = threading.Lock()
+
+    def answering(self, turn: dict) -> list:
+        user_ID = turn["user_hash"]
+        message_is_audio = turn["type"] == "audio"
+        if tenant_key(user_ID) not in session_IDs:
+            # The sessions stored in Cloudant belong to the baseline assistant
+            update_session_ID(user_ID)
+        return redirect_request.__wrapped__(
+            [None, turn["message"]] if message_is_audio else turn["message"], user_ID,
+            message_is_audio, utc_now(), turn["type"] == "file", turn.get("voice_native", False))
+
+    def replaying(self, index: int, turn: dict):
+        candidate = tenant_by_name(turn["tenant"])._replace(wa_ID=self.assistant_ID)
+        with using_tenant(candidate), logs.turn(turn["user_hash"], f"replay:{index}"), \
+                logs.timing_stages() as stages, accounting.classified("replay"), \
+                shadow.suppressed():
+            start = time.perf_counter()
+            try:
+                answers = shadow.normalized_answers(self.answering(turn))
+                error = None
+            except Exception as e:
+                logger.exception("Replay of turn %s failed", index)
+                answers, error = None, str(e)
+            result = {"index": index, "answers": answers, "error": error,
+                      "seconds": time.perf_counter() - start, "stages": dict(stages)}
+        with self.lock:
+            self.results.append(result)
+
+    def run(self):
+        """
+        Submit each turn when it is due, after the previous turns of its
+        user, then wait for all of them.
+        """
+        if not self.turns:
+            return
+        first = self.turns[0]["at"]
+        start = time.monotonic()
+        with ThreadPoolExecutor(REPLAY_WORKERS, thread_name_prefix="replay") as executor:
+            futures = []
+            for index, turn in enumerate(self.turns):
+                if self.speedup:
+                    delay = (turn["at"] - first) / self.speedup - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                futures.append(router.submitting_in_order(
+                    turn["user_hash"], executor.submit, self.replaying, index, turn))
+            # The waiting turns are submitted as the previous ones end
+            wait(futures)
+
+    def report(self) -> dict:
+        """
+        Compare the candidate with the captured baseline: the turns whose
+        answers differ, and the latency of each stage.
+
+        Returns
+        -------
+        dict
+            The counts, the differing turns and the latencies.
+        """
+        diffs   = []
+        failed  = 0
+        stages  = {}
+        for result in sorted(self.results, key=lambda result: result["index"]):
+            turn = self.turns[result["index"]]
+            if result["error"]:
+                failed += 1
+            elif result["answers"] != turn["answers"]:
+                diffs.append({"at": turn["at"], "user_hash": turn["user_hash"],
+                              "type": turn["type"], "message": turn["message"],
+                              "baseline": turn["answers"], "candidate": result["answers"]})
+            for side, timings in (("baseline", turn["stages"]), ("candidate", result["stages"])):
+                for name, seconds in timings.items():
+                    stages.setdefault(name, {}).setdefault(side, []).append(seconds)
+            stages.setdefault("turn", {}).setdefault("baseline", []).append(turn["seconds"])
+            stages["turn"].setdefault("candidate", []).append(result["seconds"])
+        replayed = len(self.results)
+        return {"turns": replayed, "failed": failed, "different": len(diffs),
+                "identical": replayed - failed - len(diffs),
+                "diffs": diffs[:REPLAY_MAX_DIFFS],
+                "latency": {name: {side: latencies(values) for side, values in sides.items()}
+                            for name, sides in stages.items()}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay captured turns against a candidate assistant and compare the answers")
+    parser.add_argument("captures", nargs="+", help="files written by SHADOW_CAPTURE_DIRECTORY")
+    parser.add_argument("--assistant-id", default=WA_SHADOW_ID,
+                        help="the candidate assistant, WA_SHADOW_ID by default")
+    parser.add_argument("--speedup", type=float, default=1,
+                        help="how much faster than captured the turns arrive, 0 for no pacing")
+    parser.add_argument("--report", help="write the full report to this JSON file")
+    arguments = parser.parse_args()
+    if not arguments.assistant_id:
+        parser.error("no candidate assistant, set WA_SHADOW_ID or --assistant-id")
+    replay = Replay(reading_captures(arguments.captures), arguments.assistant_id,
+                    arguments.speedup)
+    replay.run()
+    report = replay.report()
+    if arguments.report:
+        with open(arguments.report, "w") as file:
+            json.dump(report, file, indent=2)
+    print(f"{report['turns']} turns replayed: {report['identical']} identical, "
+          f"{report['different']} different, {report['failed']} failed")
+    for name, sides in report["latency"].items():
+        print(f"{name}: " + ", ".join(
+            f"{side} p50 {values['p50']}s p90 {values['p90']}s" for side, values in sides.items()))
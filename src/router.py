@@ -0,0 +1,300 @@
+import os
+import time
+import bisect
+import hashlib
+import threading
+import contextvars
+import requests
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from dotenv import load_dotenv
+from typing import Callable, Dict, List, Optional
+import metrics
+from logs import get_logger
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+CLUSTER_NODES      = os.getenv('CLUSTER_NODES', '') # comma-separated base URLs, empty disables routing
+CLUSTER_NODES_FILE = os.getenv('CLUSTER_NODES_FILE') # optional, one base URL per line, reloaded on change
+CLUSTER_SELF       = os.getenv('CLUSTER_SELF', '') # base URL of this node, as listed in the nodes
+CLUSTER_VIRTUAL_NODES   = int(os.getenv('CLUSTER_VIRTUAL_NODES', 128)) # points per node on the ring
+CLUSTER_RELOAD_INTERVAL = float(os.getenv('CLUSTER_RELOAD_INTERVAL', 10)) # seconds
+CLUSTER_FORWARD_TIMEOUT = float(os.getenv('CLUSTER_FORWARD_TIMEOUT', 10)) # seconds, under the ~15s Twilio waits
+CLUSTER_CONNECT_TIMEOUT = float(os.getenv('CLUSTER_CONNECT_TIMEOUT', 2)) # seconds
+
+logger = get_logger(__name__)
+
+# Set on forwarded requests, so a node that disagrees on the owner
+# processes the request instead of forwarding it again
+FORWARDED_HEADER = 'X-Chatbot-Forwarded-By'
+
+class ForwardingFailed(Exception):
+    """
+    Raised when the node owning a user was reached but did not answer in
+    time or failed: it may be processing the turn, so it must not be
+    processed here too.
+    """
+
+class HashRing:
+    """
+    A consistent-hash ring of nodes. Each node owns CLUSTER_VIRTUAL_NODES
+    points, so when a node joins or leaves only the users next to its
+    points change owner.
+
+    Parameters
+    ----------
+    nodes : List[str]
+        The base URLs of the nodes.
+    """
+    def __init__(self, nodes: List[str]):
+        self.nodes  = sorted(set(nodes))
+        points      = sorted((self.hashing(f"{node}#{replica}"), node)
+                             for node in self.nodes
+                             for replica in range(CLUSTER_VIRTUAL_NODES))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    @staticmethod
+    def hashing(key: str) -> int:
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], 'big')
+
+    def owner(self, key: str) -> Optional[str]:
+        """
+        Find the node owning a key.
+
+        Parameters
+        ----------
+        key : str
+            The key, e.g. the hashed ID of a user.
+
+        Returns
+        -------
+        Optional[str]
+            The base URL of the node, None if the ring is empty.
+        """
+        if not self.owners:
+            return None
+        index = bisect.bisect(self.hashes, self.hashing(key)) % len(self.hashes)
+        return self.owners[index]
+
+def reading_nodes() -> List[str]:
+    """
+    Read the nodes of the cluster from CLUSTER_NODES_FILE, if set, or from
+    CLUSTER_NODES.
+
+    Returns
+    -------
+    List[str]
+        The base URLs of the nodes.
+    """
+    if CLUSTER_NODES_FILE:
+        try:
+            with open(CLUSTER_NODES_FILE) as file:
+                return [line.strip().rstrip('/') for line in file
+                        if line.strip() and not line.startswith('#')]
+        except OSError as e:
+            logger.error("Cannot read the cluster nodes: %s", e)
+    return [node.strip().rstrip('/') for node in CLUSTER_NODES.split(',') if node.strip()]
+
+# Pooled connections to the other nodes
+http = requests.Session()
+
+def after_fork():
+    """
+    Recreate the HTTP session in a forked worker, so it does not share the
+    connections of its parent, and forget the turns of the parent.
+    """
+    global http, _turns_lock
+    http = requests.Session()
+    _turns_lock = threading.Lock()
+    waiting_turns.clear()
+
+ring      = HashRing(reading_nodes())
+_checked  = time.monotonic()
+_modified = None
+_lock     = threading.Lock()
+
+def current_ring() -> HashRing:
+    """
+    Get the ring of the cluster, rebuilt when the nodes file changes, which
+    is checked at most every CLUSTER_RELOAD_INTERVAL seconds.
+
+    Returns
+    -------
+    HashRing
+        The ring.
+    """
+    global ring, _checked, _modified
+    if not CLUSTER_NODES_FILE or time.monotonic() - _checked < CLUSTER_RELOAD_INTERVAL:
+        return ring
+    with _lock:
+        _checked = time.monotonic()
+        try:
+            modified = os.stat(CLUSTER_NODES_FILE).st_mtime
+        except OSError:
+            return ring
+        if modified != _modified:
+            _modified = modified
+            nodes = reading_nodes()
+            if nodes != ring.nodes:
+                ring = HashRing(nodes)
+                logger.info("Cluster nodes changed: %s", ring.nodes)
+        metrics.set_gauge("router.nodes", len(ring.nodes))
+        return ring
+
+def owner_node(user_hash: str) -> Optional[str]:
+    """
+    Find the node that should process the turns of a user.
+
+    Parameters
+    ----------
+    user_hash : str
+        The hashed ID of the user.
+
+    Returns
+    -------
+    Optional[str]
+        The base URL of another node, None if this node owns the user or
+        routing is disabled.
+    """
+    owner = current_ring().owner(user_hash)
+    if owner is None or owner == CLUSTER_SELF.rstrip('/'):
+        return None
+    return owner
+
+def forwarding(node: str, path: str, headers: dict, **body) -> Optional[requests.Response]:
+    """
+    Forward a webhook request to the node owning its user.
+
+    Parameters
+    ----------
+    node : str
+        The base URL of the node.
+    path : str
+        The path of the webhook.
+    headers : dict
+        The headers to forward, e.g. the content type.
+    body
+        The body, as `data` or `json` of requests.post.
+
+    Returns
+    -------
+    Optional[requests.Response]
+        The response of the node, None if the node could not be reached, in
+        which case the request should be processed locally.
+
+    Raises
+    ------
+    ForwardingFailed
+        If the node was reached but timed out or failed.
+    """
+    headers = dict(headers, **{FORWARDED_HEADER: CLUSTER_SELF or 'unknown'})
+    try:
+        response = http.post(node + path, headers=headers,
+                             timeout=(CLUSTER_CONNECT_TIMEOUT, CLUSTER_FORWARD_TIMEOUT), **body)
+        response.raise_for_status()
+    except requests.ConnectionError as e:
+        # Includes the connect timeout: the request never reached the node
+        logger.warning("Node %s unreachable, processing locally: %s", node, e)
+        metrics.increment("router.forward_unreachable")
+        return None
+    except requests.RequestException as e:
+        logger.warning("Forwarding to %s failed: %s", node, e)
+        metrics.increment("router.forward_failed")
+        raise ForwardingFailed(node) from e
+    metrics.increment("router.forwarded")
+    return response
+
+def is_forwarded(headers) -> bool:
+    """
+    Tell whether a request was already forwarded by another node.
+    """
+    return FORWARDED_HEADER in headers
+
+# Turns of each user waiting for the one in progress on this node, in the
+# order they arrived. A user is listed while one of their turns runs.
+waiting_turns: Dict[str, deque] = {}
+_turns_lock = threading.Lock()
+
+def submitting_in_order(user_hash: str, submit: Callable[..., Future], function,
+                        *args) -> Future:
+    """
+    Submit a turn so that the turns of a user run one at a time on this
+    node, in the order they arrived. A turn arriving while another turn of
+    its user runs waits in the queue of the user rather than in a worker,
+    and is submitted, in the context it arrived in, once the previous turn
+    is over.
+
+    Parameters
+    ----------
+    user_hash : str
+        The hashed ID of the user.
+    submit : Callable[..., Future]
+        Submits a function to a pool, e.g. `partial(scheduler.submit, kind)`.
+    function : Callable
+        The function processing the turn.
+
+    Returns
+    -------
+    Future
+        The future result of the function. For a waiting turn, it fails
+        with what `submit` raises when the turn is finally submitted.
+
+    Raises
+    ------
+    Exception
+        What `submit` raises, e.g. scheduler.Overloaded, when no turn of the
+        user is running.
+    """
+    with _turns_lock:
+        if user_hash in waiting_turns:
+            waiting = Future()
+            waiting_turns[user_hash].append(
+                (submit, function, args, waiting, contextvars.copy_context()))
+            metrics.increment("router.turns_waiting")
+            return waiting
+        waiting_turns[user_hash] = deque()
+    try:
+        future = submit(function, *args)
+    except BaseException:
+        submitting_next(user_hash)
+        raise
+    future.add_done_callback(lambda _: submitting_next(user_hash))
+    return future
+
+def submitting_next(user_hash: str):
+    """
+    Submit the next waiting turn of a user, once their previous turn is
+    over, or forget the user if none is waiting.
+
+    Parameters
+    ----------
+    user_hash : str
+        The hashed ID of the user.
+    """
+    while True:
+        with _turns_lock:
+            if not waiting_turns[user_hash]:
+                del waiting_turns[user_hash]
+                return
+            submit, function, args, waiting, context = waiting_turns[user_hash].popleft()
+        if not waiting.set_running_or_notify_cancel():
+            continue
+        try:
+            future = context.run(submit, function, *args)
+        except Exception as e:
+            waiting.set_exception(e)
+            continue
+        future.add_done_callback(lambda done: settling_waiting(user_hash, waiting, done))
+        return
+
+def settling_waiting(user_hash: str, waiting: Future, done: Future):
+    submitting_next(user_hash)
+    if done.cancelled():
+        waiting.set_exception(CancelledError())
+    elif done.exception() is not None:
+        waiting.set_exception(done.exception())
+    else:
+        waiting.set_result(done.result())
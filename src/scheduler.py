@@ -0,0 +1,139 @@
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+import metrics
+from logs import get_logger
+
+# Load environment variables
+load_dotenv()
+
+# Voice turns (download, STT, archive, Watson, TTS) cost 10-50x a text turn,
+# so each kind runs in its own pool and a voice burst cannot starve text
+VOICE = "voice"
+TEXT  = "text"
+
+# Define environment variables
+POOL_SIZES = {
+    VOICE: int(os.getenv('SCHEDULER_VOICE_WORKERS', 16)), # per process, the WhatsApp app runs one
+    TEXT:  int(os.getenv('SCHEDULER_TEXT_WORKERS', 48))}
+QUEUE_SIZES = {
+    VOICE: int(os.getenv('SCHEDULER_VOICE_QUEUE', 32)),
+    TEXT:  int(os.getenv('SCHEDULER_TEXT_QUEUE', 96))}
+SCHEDULER_TIMEOUT      = float(os.getenv('SCHEDULER_TIMEOUT', 8)) # seconds, under the ~15s Twilio waits and CLUSTER_FORWARD_TIMEOUT
+SCHEDULER_BUSY_MESSAGE = os.getenv('SCHEDULER_BUSY_MESSAGE', '').replace("_", " ")
+
+logger = get_logger(__name__)
+
+class Overloaded(Exception):
+    """
+    Raised when a turn is refused because its pool and queue are full.
+    """
+
+def creating_pools() -> dict:
+    return {kind: ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"{kind}-turn")
+            for kind, size in POOL_SIZES.items()}
+
+pools = creating_pools()
+
+# Admission control: a turn holds a slot from submission to completion
+slots = {kind: threading.BoundedSemaphore(POOL_SIZES[kind] + QUEUE_SIZES[kind])
+         for kind in POOL_SIZES}
+pending = {kind: 0 for kind in POOL_SIZES}
+_lock   = threading.Lock()
+
+def after_fork():
+    """
+    Recreate the pools in a forked worker, whose threads are not inherited.
+    """
+    global pools
+    pools = creating_pools()
+
+def _tracking_depth(kind: str, change: int):
+    with _lock:
+        pending[kind] += change
+        depth = pending[kind]
+    metrics.set_gauge(f"scheduler.{kind}.depth", depth)
+
+def submit(kind: str, function, *args, **kwargs) -> Future:
+    """
+    Run a turn in the pool of its kind, without waiting for it. The context
+    variables of the caller are carried into the worker thread.
+
+    Parameters
+    ----------
+    kind : str
+        VOICE or TEXT.
+    function : Callable
+        The function processing the turn.
+
+    Returns
+    -------
+    Future
+        The future result of the function.
+
+    Raises
+    ------
+    Overloaded
+        If the pool and its queue are full.
+    """
+    if not slots[kind].acquire(blocking=False):
+        metrics.increment(f"scheduler.{kind}.rejected")
+        raise Overloaded(kind)
+    metrics.increment(f"scheduler.{kind}.admitted")
+    _tracking_depth(kind, 1)
+    queued_at = time.monotonic()
+
+    def running():
+        metrics.set_gauge(f"scheduler.{kind}.queue_wait_seconds",
+                          time.monotonic() - queued_at)
+        return function(*args, **kwargs)
+
+    def releasing(_):
+        _tracking_depth(kind, -1)
+        slots[kind].release()
+
+    try:
+        future = pools[kind].submit(contextvars.copy_context().run, running)
+    except Exception:
+        releasing(None)
+        raise
+    future.add_done_callback(releasing)
+    return future
+
+def run(kind: str, function, *args, **kwargs):
+    """
+    Run a turn in the pool of its kind and wait for its result.
+
+    Parameters
+    ----------
+    kind : str
+        VOICE or TEXT.
+    function : Callable
+        The function processing the turn.
+
+    Returns
+    -------
+    Any
+        The result of the function.
+
+    Raises
+    ------
+    Overloaded
+        If the pool and its queue are full.
+    """
+    return submit(kind, function, *args, **kwargs).result(SCHEDULER_TIMEOUT)
+
+def reporting_failure(future: Future):
+    """
+    Log the exception of a turn that nobody waits for.
+
+    Parameters
+    ----------
+    future : Future
+        The future of the turn.
+    """
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Scheduled turn failed", exc_info=future.exception())
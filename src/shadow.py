@@ -0,0 +1,160 @@
+import os
+import gzip
+import json
+import time
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from dotenv import load_dotenv
+from typing import List
+import logs
+from answers import Answer
+from tenants import tenant
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+SHADOW_CAPTURE_DIRECTORY      = os.getenv('SHADOW_CAPTURE_DIRECTORY') # captures the turns when set
+SHADOW_CAPTURE_FLUSH_INTERVAL = float(os.getenv('SHADOW_CAPTURE_FLUSH_INTERVAL', 5)) # seconds between writes
+
+logger = logs.get_logger(__name__)
+
+# Whether the turn being processed is a replay, whose writes must not reach
+# Cloudant or Cloud Object Storage
+suppressing = contextvars.ContextVar("suppressing", default=False)
+
+# Turns captured and not written yet
+_captured = []
+_lock     = threading.Lock()
+_stopped  = threading.Event()
+writer    = None
+
+@contextmanager
+def suppressed():
+    """
+    Keep the writes of the turn being processed, including by the scheduled
+    work that copies the context, away from Cloudant and Cloud Object Storage.
+    """
+    token = suppressing.set(True)
+    try:
+        yield
+    finally:
+        suppressing.reset(token)
+
+def normalized_answers(answers: List[Answer]) -> List[list]:
+    """
+    Reduce answers to what a replay can compare: the kind, and the text or,
+    for media without text, the link. Synthesized audio is compared by its
+    text, since its link changes on every turn.
+
+    Parameters
+    ----------
+    answers : List[Answer]
+        The typed answers from the chatbot.
+
+    Returns
+    -------
+    List[list]
+        The kind and the text or link of each answer.
+    """
+    return [[answer.kind, answer.text if answer.text is not None else answer.url]
+            for answer in answers]
+
+def turn_type(message, message_is_audio: bool, non_supported_file: bool) -> str:
+    if message_is_audio:
+        return "audio"
+    if non_supported_file:
+        return "file"
+    return "text"
+
+def captured(redirecting):
+    """
+    Decorates `redirect_request` so that, when SHADOW_CAPTURE_DIRECTORY is
+    set, each turn is captured with its answers and the seconds spent in
+    each stage, for a later replay against a candidate assistant. The text
+    of a voice message is its transcript.
+    """
+    @wraps(redirecting)
+    def capturing(message, user_ID, message_is_audio, timestamp, non_supported_file,
+                  voice_native=False):
+        if not SHADOW_CAPTURE_DIRECTORY or suppressing.get():
+            return redirecting(message, user_ID, message_is_audio, timestamp,
+                               non_supported_file, voice_native)
+        at      = time.time()
+        start   = time.perf_counter()
+        answers = redirecting(message, user_ID, message_is_audio, timestamp,
+                              non_supported_file, voice_native)
+        stages  = logs.stage_seconds.get() or {}
+        turn = {"at": round(at, 3), "tenant": tenant().name, "user_hash": str(user_ID),
+                "type": turn_type(message, message_is_audio, non_supported_file),
+                "message": message[1] if message_is_audio else str(message),
+                "voice_native": voice_native,
+                "answers": normalized_answers(answers),
+                "seconds": round(time.perf_counter() - start, 3),
+                "stages": {name: round(seconds, 3) for name, seconds in stages.items()}}
+        with _lock:
+            _captured.append(turn)
+        return answers
+    return capturing
+
+def writing():
+    """
+    Append the turns captured since the last write to the compressed JSON
+    lines file of the hour, in SHADOW_CAPTURE_DIRECTORY. Each write adds a
+    gzip member, which `gzip.open` reads back as one stream.
+    """
+    global _captured
+    with _lock:
+        turns, _captured = _captured, []
+    if not turns:
+        return
+    path = (Path(SHADOW_CAPTURE_DIRECTORY)
+            / f"turns-{time.strftime('%Y%m%d%H', time.gmtime())}-{os.getpid()}.jsonl.gz")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(path, "at") as file:
+            for turn in turns:
+                file.write(json.dumps(turn, separators=(",", ":")) + "\n")
+    except OSError as e:
+        logger.error("Could not write the captured turns to %s: %s", path, e)
+
+def writing_periodically():
+    while not _stopped.wait(SHADOW_CAPTURE_FLUSH_INTERVAL):
+        writing()
+
+def start_writer():
+    """
+    Start the thread writing the captured turns, e.g. again in a forked
+    worker, where the thread of the parent process does not exist.
+    """
+    global writer
+    if not SHADOW_CAPTURE_DIRECTORY:
+        return
+    _stopped.clear()
+    writer = threading.Thread(target=writing_periodically, name="shadow-capture", daemon=True)
+    writer.start()
+
+def after_fork():
+    """
+    Forget the turns captured in the parent process, which writes them
+    itself, and start a new writing thread.
+    """
+    global _lock, _captured
+    _lock     = threading.Lock()
+    _captured = []
+    start_writer()
+
+def stop_writer():
+    """
+    Write the remaining captured turns and stop the writing thread.
+    """
+    _stopped.set()
+    if SHADOW_CAPTURE_DIRECTORY:
+        writing()
+
+start_writer()
+atexit.register(stop_writer)
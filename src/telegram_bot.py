@@ -2,83 +2,66 @@ import os
 import telegram
 import hashlib
 from dotenv import load_dotenv
+
+# Load environment variables, before the modules reading them are imported
+load_dotenv("./venv/master.env")
+
+from flask import Flask, abort, request
+from queue import Queue
 from telegram.ext import *
-from datetime import datetime
-from audio_services import process_audio_stt
-from file_management import save_media_file
+from timestamps import utc_now
+from functools import partial, wraps
+from typing import List, Optional
+from answers import MEDIA_KINDS, Answer
+from cache import BoundedCache
+from concurrent.futures import Future
+from idempotency import abandon_turn, begin_turn, complete_turn, settling_turn
+import accounting
+import contacts
+import delivery
+import fast_path
+import logs
+import rate_limit
+import router
+import scheduler
+from rate_limit import RATE_LIMIT_MESSAGE
+from scheduler import SCHEDULER_BUSY_MESSAGE
+from audio_services import STT_STREAMING, process_audio_content, process_audio_stt
+from file_management import save_media_content
 from redirect_request import redirect_request
+from tenants import by_telegram_token, tenant, tenant_key, using_tenant
 
-# Load environment variables
-load_dotenv("./venv/master.env")
+logger = logs.get_logger(__name__)
 
 # Define environment variables
 PORT                 = os.getenv("TELEGRAM_PORT")
-TELEGRAM_BOT_TOKEN   = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL") # var must finish with /
+MEDIA_REGISTRY_PATH  = os.getenv("TELEGRAM_MEDIA_REGISTRY_PATH", "./temp/telegram_media_registry.json")
+MEDIA_REGISTRY_SIZE  = int(os.getenv("TELEGRAM_MEDIA_REGISTRY_SIZE", 10000))
+MEDIA_REGISTRY_TTL   = float(os.getenv("TELEGRAM_MEDIA_REGISTRY_TTL", 30 * 24 * 3600)) # seconds
+PHOTO_MAX_SIDE       = int(os.getenv("TELEGRAM_PHOTO_MAX_SIDE", 0)) # pixels, 0 keeps the largest size
 
-# Configuring Telegram Bot
-bot = telegram.Bot(token=TELEGRAM_BOT_TOKEN)
-
-def answer_is_media(answer: str) -> bool:
-    """
-    Check whether the given answer is a media file.
-
-    Parameters
-    ----------
-    answer : str
-        The answer from the chatbot
-
-    Returns
-    -------
-    bool
-        True if the answer is a media file, False otherwise.
-    """
-    common_media_file_types = ["jpg", "peg", "png", "mp3", "wav", "ogg", "mp4", "pus"]
-    if type(answer) is str:
-        if answer[-3:] in common_media_file_types:
-            return True
-        else:
-            return False
-    else:
-        return False
+# Configuring one Telegram Bot per tenant, they share the process and its pools
+bots = {token: telegram.Bot(token=token) for token in by_telegram_token}
 
-def is_photo(ext: str) -> bool:
+def current_bot() -> telegram.Bot:
     """
-    Check whether the given file extension is a picture extension.
-
-    Parameters
-    ----------
-    ext : str
-        The file extension.
+    Get the Telegram Bot of the tenant of the turn being processed.
 
     Returns
     -------
-    bool
-        True if is an usual picture format, False otherwise.
+    telegram.Bot
+        The bot.
     """
-    if ext[-3:] in ["jpg", "peg", "png"]:
-        return True
-    else:
-        return False
+    return bots[tenant().telegram_token]
 
-def is_audio(ext: str) -> bool:
-    """
-    Check whether the given file extension is an audio extension.
+# Audio MIME types that Telegram plays as voice messages
+VOICE_MIME_TYPES = ["audio/ogg", "audio/opus"]
 
-    Parameters
-    ----------
-    ext : str
-        The file extension.
-
-    Returns
-    -------
-    bool
-        True if is an usual audio format, False otherwise.
-    """
-    if ext[-3:] in ["mp3", "wav", "ogg", "mp4", "pus"]:
-        return True
-    else:
-        return False
+# Media links already sent to Telegram, mapped to the file_id Telegram returned;
+# file_ids are only valid for the bot that sent them, so keys are scoped by tenant
+media_registry = BoundedCache(
+    MEDIA_REGISTRY_SIZE, MEDIA_REGISTRY_TTL, MEDIA_REGISTRY_PATH or None)
 
 def change_text_formatting(sentence: str) -> str:
     """
@@ -105,17 +88,89 @@ def change_text_formatting(sentence: str) -> str:
             sentence = sentence.replace(char, replacement)
     return sentence
 
-from typing import List, Union
+def media_sender(kind: str, mime_type: str):
+    """
+    Choose the Telegram method used to send a media answer.
+    OGG/Opus audio is sent as a voice message.
 
-def send_media(user_ID, media):
-    if is_photo(media):
-        bot.send_photo(user_ID, media)
-    elif is_audio(media):
-        bot.send_audio(user_ID, media, caption="", title="")
-    else:
-        bot.send_message(user_ID, media)
+    Parameters
+    ----------
+    kind : str
+        The kind of the media answer.
+    mime_type : str
+        The MIME type of the media answer.
+
+    Returns
+    -------
+    Callable
+        A function taking the chat ID and the media (URL or file_id).
+    """
+    if kind == "image":
+        return current_bot().send_photo
+    elif kind == "audio" and mime_type in VOICE_MIME_TYPES:
+        return current_bot().send_voice
+    elif kind == "audio":
+        return partial(current_bot().send_audio, caption="", title="")
+    elif kind == "video":
+        return current_bot().send_video
+    return current_bot().send_message
+
+def sent_file_id(message: telegram.Message) -> str:
+    """
+    Get the file_id Telegram assigned to the media of a sent message.
+
+    Parameters
+    ----------
+    message : telegram.Message
+        The message returned by the Telegram API.
 
-def return_answer(user_ID: str, assistant_answer: Union[str, List[str]]):
+    Returns
+    -------
+    Optional[str]
+        The file_id of the media, None if the message has no media.
+    """
+    attachment = message.effective_attachment
+    if isinstance(attachment, list):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, "file_id", None)
+
+def send_media(user_ID: str, answer: Answer):
+    """
+    Send a media answer to the user. Media already in memory is uploaded
+    directly. Otherwise, the first time a media link is sent,
+    Telegram downloads it and the returned file_id is recorded, so later
+    sends of the same link reuse the file already stored by Telegram.
+
+    Parameters
+    ----------
+    user_ID : str
+        The identification code of the user.
+    answer : Answer
+        The typed media answer from the chatbot.
+    """
+    send = media_sender(answer.kind, answer.mime_type)
+    if answer.kind not in MEDIA_KINDS:
+        send(user_ID, answer.url)
+        return
+    if answer.data is not None:
+        # Synthesized on this turn, upload it instead of having Telegram
+        # fetch the copy that is still being archived
+        send(user_ID, answer.data)
+        return
+    registry_key = tenant_key(answer.url)
+    file_id = media_registry.get(registry_key)
+    if file_id:
+        try:
+            send(user_ID, file_id)
+            return
+        except telegram.error.BadRequest:
+            media_registry.pop(registry_key)
+    file_id = sent_file_id(send(user_ID, answer.url))
+    if file_id:
+        media_registry.set(registry_key, file_id)
+
+@logs.staged("delivery")
+def return_answer(user_ID: str, assistant_answer: List[Answer]):
     """
     Deliver the chatbot's answer to the user via Telegram using the Telegram API.
 
@@ -124,25 +179,148 @@ def return_answer(user_ID: str, assistant_answer: Union[str, List[str]]):
     user_ID : int
         The identification code of the user.
 
-    assistant_answer : Union[str, List[str]]
-        The answer from the chatbot.
+    assistant_answer : List[Answer]
+        The typed answers from the chatbot.
     """
-    if type(assistant_answer) is list:
-        for answer in assistant_answer:
-            if not answer_is_media(answer):
-                answer = change_text_formatting(answer)
-                bot.send_message(
-                    user_ID, answer, parse_mode="MarkdownV2")
-            else:
+    for part, answer in enumerate(assistant_answer):
+        try:
+            if answer.is_media:
                 send_media(user_ID, answer)
-    else:
-        if not answer_is_media(assistant_answer):
-            assistant_answer = change_text_formatting(assistant_answer)
-            bot.send_message(
-                user_ID, assistant_answer, parse_mode="MarkdownV2")
+            else:
+                current_bot().send_message(
+                    user_ID, change_text_formatting(answer.text),
+                    parse_mode="MarkdownV2")
+        except Exception:
+            delivery.recording_part("telegram", part, "failed")
+            raise
+        # Bots get no delivery receipts, a part is done once Telegram accepts it
+        delivery.recording_part("telegram", part, "sent")
+
+def select_photo_size(photo_sizes: List[telegram.PhotoSize]) -> telegram.PhotoSize:
+    """
+    Choose the rendition of a photo to archive. Telegram sends each photo in
+    several sizes; the largest one whose longest side fits TELEGRAM_PHOTO_MAX_SIDE
+    is chosen, or the largest one when no limit is set.
+
+    Parameters
+    ----------
+    photo_sizes : List[telegram.PhotoSize]
+        The available renditions of the photo.
+
+    Returns
+    -------
+    telegram.PhotoSize
+        The rendition to download.
+    """
+    def area(size):
+        return size.width * size.height
+    if not PHOTO_MAX_SIDE:
+        return max(photo_sizes, key=area)
+    fitting = [size for size in photo_sizes
+               if max(size.width, size.height) <= PHOTO_MAX_SIDE]
+    if fitting:
+        return max(fitting, key=area)
+    return min(photo_sizes, key=area)
+
+def download_attachment(attachment) -> bytes:
+    """
+    Download a message attachment into memory through the bot's own pooled
+    connection.
+
+    Parameters
+    ----------
+    attachment : telegram.TelegramObject
+        The voice, photo size or document sent by the user.
+
+    Returns
+    -------
+    bytes
+        The content of the attachment.
+    """
+    return bytes(attachment.get_file().download_as_bytearray())
+
+def idempotent(handler):
+    """
+    Decorates an update handler so that each update is processed once per
+    update_id. Telegram resends updates that were not acknowledged in time,
+    and those duplicates are dropped. An update handed to a scheduler pool
+    is completed when its job succeeds, and forgotten if it fails, so a
+    resend processes it again.
+
+    Parameters
+    ----------
+    handler : Callable
+        The update handler.
+
+    Returns
+    -------
+    Callable
+        The handler, skipping updates already seen.
+    """
+    @wraps(handler)
+    def handling_once(update: Updater, context: CallbackContext):
+        turn_key = "telegram:" + tenant_key(str(update.update_id))
+        duplicate, _ = begin_turn(turn_key)
+        if duplicate:
+            return
+        try:
+            result = handler(update, context)
+        except Exception:
+            abandon_turn(turn_key)
+            raise
+        if isinstance(result, Future):
+            result.add_done_callback(settling_turn(turn_key))
         else:
-            send_media(user_ID, assistant_answer)
+            complete_turn(turn_key)
+    return handling_once
+
+def scheduled(kind: str):
+    """
+    Decorates an update handler so that it runs in the scheduler pool of its
+    kind instead of a dispatcher thread, which is released at once. The user
+    must first be within their rate limit, or the update is answered with
+    RATE_LIMIT_MESSAGE, if set. An update refused by admission control is
+    answered with SCHEDULER_BUSY_MESSAGE, if set. The turns of a user run
+    one at a time.
+
+    Parameters
+    ----------
+    kind : str
+        scheduler.VOICE for media updates, scheduler.TEXT otherwise.
 
+    Returns
+    -------
+    Callable
+        The decorator. The decorated handler returns the future of the job,
+        None if the update was refused.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def submitting(update: Updater, context: CallbackContext) -> Optional[Future]:
+            user_hash = hashlib.sha256(str(update.message.chat_id).encode()).hexdigest()
+            if not rate_limit.acquire_turn(user_hash, kind == scheduler.VOICE):
+                if RATE_LIMIT_MESSAGE:
+                    current_bot().send_message(update.message.chat_id, RATE_LIMIT_MESSAGE)
+                return
+            contacts.register_contact(user_hash, contacts.TELEGRAM, update.message.chat_id)
+            try:
+                with logs.turn(user_hash, str(update.update_id)), logs.timing_stages(), \
+                        delivery.tracking_turn(update.message.date.timestamp()), \
+                        accounting.classified(kind):
+                    future = router.submitting_in_order(
+                        user_hash, partial(scheduler.submit, kind), handler, update, context)
+                future.add_done_callback(rate_limit.releasing_when_done(user_hash))
+                future.add_done_callback(scheduler.reporting_failure)
+                return future
+            except scheduler.Overloaded:
+                rate_limit.release_turn(user_hash)
+                if SCHEDULER_BUSY_MESSAGE:
+                    current_bot().send_message(update.message.chat_id, SCHEDULER_BUSY_MESSAGE)
+        return submitting
+    return decorator
+
+@idempotent
+@scheduled(scheduler.TEXT)
 def start_command(update: Updater, context: CallbackContext):
     """
     Starts a new conversation with the Bot. 
@@ -158,7 +336,7 @@ def start_command(update: Updater, context: CallbackContext):
     """
     user_ID = str(update.message.chat_id)
     encrypted_user_ID = hashlib.sha256(user_ID.encode()).hexdigest()
-    timestamp = datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f_UTC")
+    timestamp = utc_now()
     non_supported_file = False
     message_is_audio = False
 
@@ -184,6 +362,8 @@ def help_command(update: Updater, context: CallbackContext):
     update.message.reply_text("How can I help you? Please type or say your needs.")
 
 
+@idempotent
+@scheduled(scheduler.TEXT)
 def handle_message(update: Updater, context: CallbackContext):
     """
     Handles incoming text messages from the user, passing it to message handler.
@@ -200,7 +380,7 @@ def handle_message(update: Updater, context: CallbackContext):
     """
     user_ID = str(update.message.chat_id)
     encrypted_user_ID = hashlib.sha256(user_ID.encode()).hexdigest()
-    timestamp = datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f_UTC")
+    timestamp = utc_now()
     non_supported_file = False
     message_is_audio = False
 
@@ -210,6 +390,8 @@ def handle_message(update: Updater, context: CallbackContext):
         timestamp, non_supported_file)
     return_answer(user_ID, assistant_answer)
 
+@idempotent
+@scheduled(scheduler.VOICE)
 def handle_photo(update: Updater, context: CallbackContext):
     """
     Handles incoming pictures from the user, passing it to message handler.
@@ -226,17 +408,19 @@ def handle_photo(update: Updater, context: CallbackContext):
     """
     user_ID = str(update.message.chat_id)
     encrypted_user_ID = hashlib.sha256(user_ID.encode()).hexdigest()
-    timestamp = datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f_UTC")
+    timestamp = utc_now()
     file_type = "jpg"
-    url = update.message.photo[-1].get_file()["file_path"]
+    photo = download_attachment(select_photo_size(update.message.photo))
     non_supported_file = True
     message_is_audio = False
 
-    file_link = save_media_file(encrypted_user_ID, timestamp, file_type, url)
+    file_link = save_media_content(encrypted_user_ID, timestamp, file_type, photo)
     assistant_answer = redirect_request(
                 file_link, encrypted_user_ID, message_is_audio, timestamp, non_supported_file)
     return_answer(user_ID, assistant_answer)    
 
+@idempotent
+@scheduled(scheduler.VOICE)
 def handle_voice(update: Updater, context: CallbackContext):
     """
     Handles incoming audio messages from the user, passing it to message handler.
@@ -253,22 +437,28 @@ def handle_voice(update: Updater, context: CallbackContext):
     """
     user_ID = str(update.message.chat_id)
     encrypted_user_ID = hashlib.sha256(user_ID.encode()).hexdigest()
-    timestamp = datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f_UTC")
+    timestamp = utc_now()
     non_supported_file = False
     message_is_audio = True
 
-    voice_link = update.message.effective_attachment.get_file()["file_path"]
-    audio_link, message_recognized = process_audio_stt(
-        voice_link, encrypted_user_ID, timestamp)
+    if STT_STREAMING:
+        # Transcribe while the voice note downloads
+        voice_link = update.message.effective_attachment.get_file().file_path
+        audio_link, message_recognized = process_audio_stt(
+            voice_link, encrypted_user_ID, timestamp)
+    else:
+        voice = download_attachment(update.message.effective_attachment)
+        audio_link, message_recognized = process_audio_content(
+            voice, encrypted_user_ID, timestamp)
     message = [audio_link, message_recognized]
     assistant_answer = redirect_request(
         message, encrypted_user_ID, message_is_audio, 
-        timestamp, non_supported_file)
+        timestamp, non_supported_file, voice_native=True)
     return_answer(user_ID, assistant_answer)
         
 def error(update: Updater, context: CallbackContext):
     """
-    Displays errors occurred during application execution. 
+    Logs errors occurred during application execution. 
 
     Parameters
     ----------
@@ -279,17 +469,18 @@ def error(update: Updater, context: CallbackContext):
     context: class 'telegram.ext.callbackcontext.CallbackContext''
         A class for callback
     """
-    print(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused an error", getattr(update, "update_id", None),
+                 exc_info=context.error)
 
-def main():
+def adding_handlers(dp: Dispatcher):
     """
-    Creates an updater class who enables incoming requests from user and answers from the bot.
     Redirect the incoming message to the according function, based on message type (text, audio, image).
-    Starts a small http server to listen for updates via webhook.
-    """
-    updater = Updater(TELEGRAM_BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
 
+    Parameters
+    ----------
+    dp : class 'telegram.ext.dispatcher.Dispatcher'
+        The dispatcher of a bot.
+    """
     dp.add_handler(CommandHandler("start", start_command))
     dp.add_handler(CommandHandler("help", help_command))
     dp.add_handler(MessageHandler(Filters.text, handle_message))
@@ -297,16 +488,68 @@ def main():
     dp.add_handler(MessageHandler(Filters.photo, handle_photo))
     dp.add_error_handler(error)
 
+# Webhook receiving the updates of every tenant's bot at /<bot token>
+webhook_app = Flask(__name__)
+dispatchers = {}
+
+@webhook_app.route("/<token>", methods=['POST'])
+def receiving_update(token: str):
+    """
+    Dispatch an update to the handlers on behalf of the tenant of the bot
+    it was sent to, or forward it to the node owning its user when the app
+    runs on several nodes.
+
+    Parameters
+    ----------
+    token : str
+        The token of the bot, from the webhook path.
+    """
+    if token not in dispatchers:
+        abort(404)
+    payload = request.get_json(force=True)
+    chat    = (payload.get('message') or {}).get('chat') or {}
+    if 'id' in chat and not router.is_forwarded(request.headers):
+        node = router.owner_node(hashlib.sha256(str(chat['id']).encode()).hexdigest())
+        try:
+            if node and router.forwarding(node, request.path, {}, json=payload) is not None:
+                return ""
+        except router.ForwardingFailed:
+            # The owner may still process it, Telegram retries the update
+            return "", 502
+    with using_tenant(by_telegram_token[token]):
+        update = telegram.Update.de_json(payload, bots[token])
+        dispatchers[token].process_update(update)
+    return ""
+
+def main():
+    """
+    Creates an updater class who enables incoming requests from user and answers from the bot.
+    Starts a small http server to listen for updates via webhook. With several
+    tenants, a single webhook server receives the updates of all their bots.
+    """
     # On local run using ngrok, TELEGRAM_WEBHOOK_URL looks like https://xxxx-xxx-xxx-xx-xxx.ngrok.io/
     # Default port is 80
+    port = int(os.environ.get("PORT", PORT))
+    fast_path.warming_async()
+    if len(bots) > 1:
+        for token, bot in bots.items():
+            dispatchers[token] = Dispatcher(bot, Queue(), workers=0, use_context=True)
+            adding_handlers(dispatchers[token])
+            bot.set_webhook(TELEGRAM_WEBHOOK_URL + token)
+        webhook_app.run(host="0.0.0.0", port=port)
+        return
+
+    token   = tenant().telegram_token
+    updater = Updater(token, use_context=True)
+    adding_handlers(updater.dispatcher)
     updater.start_webhook(
         listen="0.0.0.0",
-        port=int(os.environ.get("PORT", PORT)),
-        url_path=TELEGRAM_BOT_TOKEN,
+        port=port,
+        url_path=token,
         key="private.key",
-        webhook_url=TELEGRAM_WEBHOOK_URL + TELEGRAM_BOT_TOKEN
+        webhook_url=TELEGRAM_WEBHOOK_URL + token
         )
     updater.idle()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
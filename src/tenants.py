@@ -0,0 +1,155 @@
+import os
+import json
+import contextvars
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from typing import Dict, NamedTuple, Optional
+
+# Load environment variables
+load_dotenv()
+
+# Define environment variables
+TENANTS_CONFIG = os.getenv('TENANTS_CONFIG') # optional JSON file listing the tenants
+
+class Tenant(NamedTuple):
+    """
+    The settings of one bot served by the process. Clients, connection
+    pools, caches and worker pools are shared by every tenant; only these
+    settings differ.
+    """
+    name: str
+    wa_ID: Optional[str]
+    twilio_number: Optional[str]
+    telegram_token: Optional[str]
+    database: Optional[str]
+    cos_bucket: Optional[str]
+    cos_bucket_link: Optional[str]
+    tts_voice: Optional[str]
+    rate_limit_rate: float
+    rate_limit_burst: float
+    rate_limit_concurrent_turns: int
+
+# The single bot configured by the environment variables, as before tenants
+DEFAULT_TENANT = Tenant(
+    name="default",
+    wa_ID=os.getenv('WA_ID'),
+    twilio_number=os.getenv('TWILIO_SANDBOX_NUMBER'),
+    telegram_token=os.getenv('TELEGRAM_BOT_TOKEN'),
+    database=os.getenv('IBM_CLOUDANT_DATABASE'),
+    cos_bucket=os.getenv('COS_BUCKET'),
+    cos_bucket_link=os.getenv('COS_BUCKET_LINK'),
+    tts_voice=os.getenv('TTS_DEFAULT_VOICE'),
+    rate_limit_rate=float(os.getenv('RATE_LIMIT_RATE', 0.5)),
+    rate_limit_burst=float(os.getenv('RATE_LIMIT_BURST', 10)),
+    rate_limit_concurrent_turns=int(os.getenv('RATE_LIMIT_CONCURRENT_TURNS', 2)))
+
+def loading_tenants(path: Optional[str]) -> Dict[str, Tenant]:
+    """
+    Load the tenants from a JSON file holding a list of objects with the
+    fields of Tenant. Missing fields take the value of the default tenant.
+
+    Parameters
+    ----------
+    path : str, optional
+        The path of the file, None for the default tenant only.
+
+    Returns
+    -------
+    Dict[str, Tenant]
+        The tenants, by name.
+    """
+    if not path:
+        return {DEFAULT_TENANT.name: DEFAULT_TENANT}
+    with open(path) as file:
+        configs = json.load(file)
+    tenants = {}
+    for config in configs:
+        tenant = DEFAULT_TENANT._replace(**config)
+        tenants[tenant.name] = tenant
+    return tenants
+
+tenants = loading_tenants(TENANTS_CONFIG)
+by_twilio_number  = {t.twilio_number: t for t in tenants.values() if t.twilio_number}
+by_telegram_token = {t.telegram_token: t for t in tenants.values() if t.telegram_token}
+
+current_tenant = contextvars.ContextVar(
+    "tenant", default=tenants.get(DEFAULT_TENANT.name) or next(iter(tenants.values())))
+
+def tenant() -> Tenant:
+    """
+    Get the tenant of the turn being processed. Scheduled turns carry the
+    tenant of the request that submitted them.
+
+    Returns
+    -------
+    Tenant
+        The current tenant.
+    """
+    return current_tenant.get()
+
+@contextmanager
+def using_tenant(selected: Tenant):
+    """
+    Process a block of code on behalf of a tenant.
+
+    Parameters
+    ----------
+    selected : Tenant
+        The tenant.
+    """
+    token = current_tenant.set(selected)
+    try:
+        yield selected
+    finally:
+        current_tenant.reset(token)
+
+def tenant_by_twilio_number(address: str) -> Tenant:
+    """
+    Find the tenant of a Twilio number, e.g. the `To` of a webhook request.
+
+    Parameters
+    ----------
+    address : str
+        The number, with or without the "whatsapp:+" prefix.
+
+    Returns
+    -------
+    Tenant
+        The tenant of the number, the default tenant if it is unknown.
+    """
+    number = str(address).replace('whatsapp:', '').lstrip('+')
+    return by_twilio_number.get(number, current_tenant.get())
+
+def tenant_by_name(name: Optional[str]) -> Tenant:
+    """
+    Find a tenant by name.
+
+    Parameters
+    ----------
+    name : str, optional
+        The name of the tenant.
+
+    Returns
+    -------
+    Tenant
+        The tenant, the default tenant if the name is unknown.
+    """
+    return tenants.get(name, current_tenant.get())
+
+def tenant_key(key: str) -> str:
+    """
+    Scope the key of a cache shared by the tenants. Keys of the default
+    tenant are unchanged, so single-tenant caches stay valid.
+
+    Parameters
+    ----------
+    key : str
+        The key, e.g. the hashed ID of a user.
+
+    Returns
+    -------
+    str
+        The key of the current tenant.
+    """
+    name = current_tenant.get().name
+    return key if name == DEFAULT_TENANT.name else f"{name}/{key}"
@@ -0,0 +1,57 @@
+from datetime import datetime, timezone
+from typing import Optional
+
+# ISO-8601 UTC with fixed width, so timestamps sort chronologically as strings
+ISO_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Formats written by previous versions of the application
+LEGACY_FORMATS = ["%d-%m-%Y_%H:%M:%S:%f_UTC", "%d-%m-%Y_%H:%M:%S:%f"]
+
+def utc_now() -> str:
+    """
+    Stamp the current moment.
+
+    Returns
+    -------
+    str
+        The current UTC time in ISO-8601, e.g. 2023-05-01T13:45:10.123456Z.
+    """
+    return datetime.now(timezone.utc).strftime(ISO_FORMAT)
+
+def parse_timestamp(value: str) -> Optional[datetime]:
+    """
+    Parse a timestamp written by the application, in the current or in a
+    legacy format.
+
+    Parameters
+    ----------
+    value : str
+        The timestamp of a shift or a session.
+
+    Returns
+    -------
+    Optional[datetime]
+        The naive UTC datetime, None if the value cannot be parsed.
+    """
+    for dt_format in [ISO_FORMAT] + LEGACY_FORMATS:
+        try:
+            return datetime.strptime(str(value), dt_format)
+        except ValueError:
+            continue
+
+def to_sortable(value: str) -> str:
+    """
+    Convert a legacy timestamp to ISO-8601 UTC.
+
+    Parameters
+    ----------
+    value : str
+        The timestamp of a shift or a session.
+
+    Returns
+    -------
+    str
+        The ISO-8601 timestamp, or the value unchanged if it cannot be parsed.
+    """
+    parsed = parse_timestamp(value)
+    return parsed.strftime(ISO_FORMAT) if parsed else value
@@ -1,7 +1,14 @@
 import os
 from twilio.rest import Client as twilio_client
+from twilio.request_validator import RequestValidator
 from twilio.twiml.messaging_response import MessagingResponse
 from dotenv import load_dotenv
+from typing import List
+from answers import Answer
+import accounting
+import delivery
+from logs import staged
+from tenants import tenant
 
 ########################
 # Setting Environment Variables and setting up services
@@ -15,31 +22,41 @@ TWILIO_SANDBOX_NUMBER = os.getenv('TWILIO_SANDBOX_NUMBER')
 TWILIO_CLIENT_ACCOUNT = twilio_client(
     TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
-def answer_is_media(answer: str) -> bool:
+# Checks the X-Twilio-Signature of the callbacks Twilio posts
+request_validator = RequestValidator(TWILIO_AUTH_TOKEN)
+
+def signed_by_twilio(url: str, params: dict, signature: str) -> bool:
     """
-    Check whether the given answer is a media file.
+    Check that a callback was posted by Twilio, with the signature it
+    computes from the auth token, the URL it posted to and the parameters.
 
     Parameters
     ----------
-    answer : str
-        The answer from the chatbot
+    url : str
+        The public URL the callback was posted to, with its query string.
+    params : dict
+        The form parameters of the callback.
+    signature : str
+        The X-Twilio-Signature header, '' if missing.
 
     Returns
     -------
     bool
-        True if the answer is a media file, False otherwise.
+        True if the signature matches, otherwise False.
     """
-    common_media_file_types = ['jpg', 'peg', 'png', 'mp3', 'wav', 'ogg', 'mp4', 'pus', 'aac']
-    if type(answer) is str:
-        if answer[-3:] in common_media_file_types:
-            return True
-        else:
-            return False
-    else:
-        return False
+    return bool(signature) and request_validator.validate(url, params, signature)
+
+def after_fork():
+    """
+    Recreate the client in a forked worker, so it does not share the
+    connections of its parent.
+    """
+    global TWILIO_CLIENT_ACCOUNT
+    TWILIO_CLIENT_ACCOUNT = twilio_client(
+        TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
 
 def answering_with_twilio(
-    user_number_ID: int, is_answer_media: bool, content: str):
+    user_number_ID: int, is_answer_media: bool, content: str, part: int = 0):
     """
     Send a message to a user's WhatsApp number using the Twilio API.
 
@@ -51,29 +68,36 @@ def answering_with_twilio(
         True if the answer is a media file, False otherwise.
     content : str
         The content of the message (either text or media URL).
+    part : int, optional
+        The index of the message in the answer, for delivery tracking.
     """
-    if is_answer_media:
-        TWILIO_CLIENT_ACCOUNT.messages.create(
-            media_url = content,
-            from_ = 'whatsapp:+' + TWILIO_SANDBOX_NUMBER,
-            to = 'whatsapp:+' + str(user_number_ID))
-    else:
+    kwargs = {"media_url": content} if is_answer_media else {"body": content}
+    callback = delivery.status_callback(part)
+    if callback:
+        kwargs["status_callback"] = callback
+    try:
         TWILIO_CLIENT_ACCOUNT.messages.create(
-            body = content,
-            from_ = 'whatsapp:+' + TWILIO_SANDBOX_NUMBER,
-            to = 'whatsapp:+' + str(user_number_ID))
-
-from typing import List, Union
+            from_ = 'whatsapp:+' + tenant().twilio_number,
+            to = 'whatsapp:+' + str(user_number_ID),
+            **kwargs)
+    except Exception:
+        delivery.recording_part("whatsapp", part, "failed")
+        raise
+    accounting.charge(accounting.TWILIO_MESSAGES)
+    delivery.recording_part("whatsapp", part)
 
+@staged("delivery")
 def delivering_answer_whatsapp_twilio(
-    assistant_answer: Union[str, List[str]], user_number_ID: int) -> str:
+    assistant_answer: List[Answer], user_number_ID: int) -> str:
     """
     Deliver the chatbot's answer to the user via WhatsApp using the Twilio API.
+    Every answer but the last is sent through the REST API, the last one is
+    returned as TwiML.
 
     Parameters
     ----------
-    assistant_answer : Union[str, List[str]]
-        The answer from the chatbot.
+    assistant_answer : List[Answer]
+        The typed answers from the chatbot.
     user_number_ID : int
         The phone number of the user in E.164 format.
 
@@ -83,28 +107,68 @@ def delivering_answer_whatsapp_twilio(
         A TwiML string containing the chatbot's answer.
     """
     resp = MessagingResponse()
-    msg = resp.message()
-    if type(assistant_answer) is list:
-        if len(assistant_answer) > 1:
-            for answer in assistant_answer[0:-1]:
-                if answer_is_media(answer):
-                    answering_with_twilio(
-                        user_number_ID, True, answer)
-                else:
-                    answering_with_twilio(
-                        user_number_ID, False, answer)
-            if answer_is_media(assistant_answer[-1]):
-                msg.media(assistant_answer[-1])
-            else:
-                msg.body(assistant_answer[-1])
-        else:
-            if answer_is_media(assistant_answer[0]):
-                msg.media(assistant_answer[0])
-            else:
-                msg.body(assistant_answer[0])
-    else:
-        if answer_is_media(assistant_answer):
-            msg.media(assistant_answer)
+    last = len(assistant_answer) - 1
+    # Twilio posts the statuses of the TwiML message to its action URL
+    callback = delivery.status_callback(last)
+    msg = resp.message(action=callback, method="POST") if callback else resp.message()
+    for part, answer in enumerate(assistant_answer[0:-1]):
+        answering_with_twilio(
+            user_number_ID, answer.is_media, answer.content, part)
+    if assistant_answer:
+        accounting.charge(accounting.TWILIO_MESSAGES)
+        delivery.recording_part("whatsapp", last)
+        if assistant_answer[-1].is_media:
+            msg.media(assistant_answer[-1].url)
         else:
-            msg.body(assistant_answer)
-    return str(resp)
\ No newline at end of file
+            msg.body(assistant_answer[-1].text)
+    return str(resp)
+
+
+@staged("delivery")
+def delivering_answer_whatsapp_rest(
+    assistant_answer: List[Answer], user_number_ID: int):
+    """
+    Deliver every part of the chatbot's answer via WhatsApp using the Twilio
+    REST API, for answers built after the webhook request returned.
+
+    Parameters
+    ----------
+    assistant_answer : List[Answer]
+        The typed answers from the chatbot.
+    user_number_ID : int
+        The phone number of the user in E.164 format.
+    """
+    for part, answer in enumerate(assistant_answer):
+        answering_with_twilio(
+            user_number_ID, answer.is_media, answer.content, part)
+
+def text_twilio_answer(text: str) -> str:
+    """
+    Build a TwiML string replying with a text, or acknowledging the message
+    without replying if the text is empty.
+
+    Parameters
+    ----------
+    text : str
+        The text of the reply.
+
+    Returns
+    -------
+    str
+        A TwiML response.
+    """
+    resp = MessagingResponse()
+    if text:
+        resp.message(text)
+    return str(resp)
+
+def empty_twilio_answer() -> str:
+    """
+    Build a TwiML string that acknowledges a message without replying.
+
+    Returns
+    -------
+    str
+        An empty TwiML response.
+    """
+    return str(MessagingResponse())
@@ -1,10 +1,18 @@
 import os
 from dotenv import load_dotenv
-from datetime import datetime
+from timestamps import utc_now
+from concurrent.futures import Future
+from typing import Callable, List
 from ibm_watson import AssistantV2, ApiException
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from audio_services import process_audio_tts
-from db import update_conversation_shift, upload_specific_feature
+import accounting
+import metrics
+from answers import MEDIA_KINDS, Answer, media_answer, text_answer
+from audio_services import process_audio_tts, process_audio_tts_voice
+from cache import BoundedCache
+from db import context_digest, unlinking_audio, update_conversation_shift
+from logs import get_logger, staged
+from tenants import tenant, tenant_key, using_tenant
 
 ########################
 # Setting Environment Variables and setting up services
@@ -14,15 +22,38 @@ WA_API_KEY            = os.getenv('WA_API_KEY')
 WA_ID                 = os.getenv('WA_ID')
 WA_SERVICE_URL        = os.getenv('WA_SERVICE_URL')
 DEFAULT_ERROR_MESSAGE = str(os.getenv('WA_DEFAULT_ERROR_MESSAGE')).replace("_"," ")
+CONTEXT_CACHE_SIZE    = int(os.getenv('WA_CONTEXT_CACHE_SIZE', 10000))
+
+logger = get_logger(__name__)
 
 # Configuring and authenticating Watson Assistant
-assistant = AssistantV2(
-    version='2021-11-27',
-    authenticator=IAMAuthenticator(WA_API_KEY))
-assistant.set_service_url(WA_SERVICE_URL)
+def connecting() -> AssistantV2:
+    """
+    Create the Watson Assistant client.
+    """
+    client = AssistantV2(
+        version='2021-11-27',
+        authenticator=IAMAuthenticator(WA_API_KEY))
+    client.set_service_url(WA_SERVICE_URL)
+    return client
+
+assistant = connecting()
+
+def after_fork():
+    """
+    Recreate the client in a forked worker, so it does not share the
+    connections of its parent.
+    """
+    global assistant
+    assistant = connecting()
+
+# Hash of the context variables last persisted for each user
+persisted_contexts = BoundedCache(CONTEXT_CACHE_SIZE)
 
-# Setting the media response types of Watson Assistant
-media_response = ["audio", "video", "image"]
+# MIME types of the audio synthesized by `process_audio_tts`
+# and `process_audio_tts_voice`
+TTS_MIME_TYPE   = "audio/mpeg"
+VOICE_MIME_TYPE = "audio/ogg"
 
 def create_session_ID() -> str:
     """
@@ -34,10 +65,11 @@ def create_session_ID() -> str:
         The session ID.
     """
     try:
-        session_ID = assistant.create_session(WA_ID).get_result()["session_id"]
+        session_ID = assistant.create_session(tenant().wa_ID).get_result()["session_id"]
         return session_ID
     except ApiException as ex:
-        f"WA Method failed with status code {str(ex.code)} ~ {ex.message}"
+        logger.error("WA session creation failed with status code %s: %s",
+                     ex.code, ex.message)
 
 def cleaning_text_formatting(text: str) -> str:
     """
@@ -55,11 +87,34 @@ def cleaning_text_formatting(text: str) -> str:
     """
     return ((str(text).replace("_", "")).replace("*", "")).replace("\n", " ")
 
-def filtering_answers_to_return(response: list, user_ID: str, session_ID: str, message_is_audio: bool, timestamp: float) -> list:
+def changed_context_variables(user_ID: str, context_variables: dict):
+    """
+    Return the context variables if they differ from the ones last persisted
+    for the user, so that unchanged variables are not written again. They
+    are only remembered as persisted once written, see `filtering_answers_to_return`.
+
+    Parameters
+    ----------
+    user_ID : str
+        ID of the user.
+    context_variables : dict
+        The user defined context variables returned by Watson Assistant.
+
+    Returns
+    -------
+    Optional[dict]
+        The context variables, or None if they did not change.
+    """
+    if persisted_contexts.get(tenant_key(user_ID)) == context_digest(context_variables):
+        return None
+    return context_variables
+
+def filtering_answers_to_return(response: list, user_ID: str, session_ID: str, message_is_audio: bool, timestamp: float, voice_native: bool = False, context_variables: dict = None) -> List[Answer]:
     """
     Given a list of possible answers from a chatbot, this function filters and formats the answers to return to the user. 
     If the message is audio, the function processes the audio and returns a link to the audio file, along with the original text.
-    If the response contains only media responses, the function returns the link to the media.
+    Media responses are returned with their kind and MIME type resolved, so the
+    delivery modules do not need to inspect the content again.
 
     Parameters
     ----------
@@ -73,75 +128,104 @@ def filtering_answers_to_return(response: list, user_ID: str, session_ID: str, m
         Indicates whether the message is audio or text
     timestamp : float
         Timestamp of the message
+    voice_native : bool
+        Whether the channel uploads voice notes directly; the audio is then
+        synthesized as OGG/Opus and kept in memory in the answer.
+    context_variables : dict, optional
+        Context variables to persist along with the answers.
 
     Returns
     -------
-    list
-        List of answers to return to the user, where each answer is a string (the text or link to media).
+    List[Answer]
+        List of typed answers to return to the user.
     """
+    answers_to_return = []
+    all_answers       = []
+    archives          = []
+    for answer in response:
+        if answer["response_type"] == "text":
+            if message_is_audio:
+                phrase = cleaning_text_formatting(answer["text"])
+                if voice_native:
+                    audio_link, audio, archived = process_audio_tts_voice(user_ID, phrase)
+                    audio_answer = media_answer(
+                        "audio", audio_link, VOICE_MIME_TYPE, phrase, audio)
+                    if archived is not None:
+                        archives.append((audio_link, archived))
+                else:
+                    audio_link   = process_audio_tts(user_ID, phrase)
+                    audio_answer = media_answer(
+                        "audio", audio_link, TTS_MIME_TYPE, phrase)
+                all_answers.extend([phrase, audio_link, answer["text"]])
+                if audio_link:
+                    answers_to_return.append(audio_answer)
+                answers_to_return.append(text_answer(answer["text"]))
 
-    if len(response) > 1:
-        answers_to_return = []
-        all_answers       = []
-        for answer in response:
-            if answer["response_type"] == "text":
-                if message_is_audio:
-                    phrase     = cleaning_text_formatting(answer["text"])
-                    audio_link = process_audio_tts(user_ID, phrase)
-                    all_answers.extend([phrase, audio_link, answer["text"]])
-                    answers_to_return.extend([audio_link, answer["text"]])
+            else:
+                all_answers.append(answer["text"])
+                answers_to_return.append(text_answer(answer["text"]))
 
-                else:
-                    all_answers.append(answer["text"])
-                    answers_to_return.append(answer["text"])
+        elif answer["response_type"] in MEDIA_KINDS:
+            all_answers.append(answer["source"])
+            answers_to_return.append(
+                media_answer(answer["response_type"], answer["source"]))
 
-            elif answer["response_type"] in media_response:
-                all_answers.append(answer["source"])
-                answers_to_return.append(answer["source"])
+    if not answers_to_return:
+        all_answers.append(DEFAULT_ERROR_MESSAGE)
+        answers_to_return.append(text_answer(DEFAULT_ERROR_MESSAGE))
 
-        update_conversation_shift(
-            user_ID, session_ID, 'chatbot', 
-            all_answers, timestamp)
-            
-        return answers_to_return
+    written = update_conversation_shift(
+        user_ID, session_ID, 'chatbot', all_answers, timestamp,
+        context_variables)
+    if written and context_variables is not None:
+        # A failed write leaves them to be written with the next shift
+        persisted_contexts.set(tenant_key(user_ID), context_digest(context_variables))
+    if written:
+        # The audio is archived in the background: its link is taken out of
+        # the shift if the upload fails
+        for audio_link, archived in archives:
+            archived.add_done_callback(unlinking_when_failed(user_ID, session_ID, audio_link))
+    return answers_to_return
 
-    elif len(response) == 1:
-        if response[0]["response_type"] == "text":
-            all_answers       = []
-            answers_to_return = []
+def unlinking_when_failed(user_ID: str, session_ID: str, audio_link: str) -> Callable[[Future], None]:
+    """
+    Build the done-callback of the archival of an audio answer, which takes
+    its link out of the history if the upload failed.
 
-            if message_is_audio:
-                phrase     = cleaning_text_formatting(response[0]["text"])
-                audio_link = process_audio_tts(user_ID, phrase)
-                all_answers.extend([phrase, audio_link, response[0]["text"]])
-                answers_to_return.extend([audio_link, response[0]["text"]])
-            else:
-                all_answers.append(response[0]["text"])
-                answers_to_return.append(response[0]["text"])
+    Parameters
+    ----------
+    user_ID : str
+        ID of the user.
+    session_ID : str
+        ID of the user's session.
+    audio_link : str
+        The COS link written in the history.
 
-            update_conversation_shift(
-                user_ID, session_ID, 'chatbot',
-                all_answers, timestamp)
-            return answers_to_return
-        
-        elif response[0]["response_type"] in media_response:
-            update_conversation_shift(
-                user_ID, session_ID, 'chatbot',
-                response[0]["source"], timestamp)
-            return response[0]["source"]
-        else:
-            update_conversation_shift(
-                user_ID, session_ID, 'chatbot',
-                DEFAULT_ERROR_MESSAGE, timestamp)
-            return DEFAULT_ERROR_MESSAGE
-
-def assistant_conversation(message: str, user_ID: str, session_ID: str, message_is_audio: bool) -> list:
+    Returns
+    -------
+    Callable[[Future], None]
+        The callback, for `Future.add_done_callback`.
+    """
+    # The callback runs outside the context of the turn
+    user_tenant = tenant()
+    def unlinking(future: Future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            return
+        logger.error("Archiving %s failed, unlinking it from the history", audio_link)
+        metrics.increment("tts.archive_failed")
+        with using_tenant(user_tenant):
+            if not unlinking_audio(user_ID, session_ID, audio_link):
+                logger.error("Cannot unlink %s from the history of %s", audio_link, user_ID)
+    return unlinking
+
+@staged("assistant")
+def assistant_conversation(message: str, user_ID: str, session_ID: str, message_is_audio: bool, voice_native: bool = False) -> List[Answer]:
     """
     This function handles the conversation with the assistant. 
     It sends the message to the assistant and retrieves the output, 
     then filters and formats the answers to return to the user. 
     If the conversation creates or updates context variables, 
-    the function updates the context accordingly.
+    they are persisted in the same write as the answers.
 
     Parameters
     ----------
@@ -153,15 +237,17 @@ def assistant_conversation(message: str, user_ID: str, session_ID: str, message_
         ID of the user's session.
     message_is_audio : bool
         Indicates whether the message is audio or text
+    voice_native : bool
+        Whether the channel uploads voice notes directly
 
     Returns
     -------
-    list
-        List of answers to return to the user, where each answer is a string (the text or link to media).
+    List[Answer]
+        List of typed answers to return to the user.
     """
     try:
         conversation = assistant.message(
-            WA_ID,
+            tenant().wa_ID,
             session_ID,
             input = {
                         'text': message,
@@ -170,22 +256,24 @@ def assistant_conversation(message: str, user_ID: str, session_ID: str, message_
                         }
                     }
         ).get_result()
-        timestamp = datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f")
+        accounting.charge(accounting.ASSISTANT_MESSAGES)
+        timestamp = utc_now()
 
+        context_variables = None
         if 'user_defined' in conversation['context']['skills']['main skill']:
-            context_variables = (
+            context_variables = changed_context_variables(
+                str(user_ID),
                 conversation['context']['skills']['main skill']['user_defined'])
-            upload_specific_feature(
-                str(user_ID), session_ID, context_variables)
         
         response = conversation['output']['generic']
         return filtering_answers_to_return(response, user_ID, 
                                            session_ID, message_is_audio, 
-                                           timestamp)
+                                           timestamp, voice_native,
+                                           context_variables)
     except ApiException as ex:
         if ex.code == 404:
             new_session_ID = create_session_ID()
             return assistant_conversation(
-                message, user_ID, new_session_ID, message_is_audio)
-        else:
-            f"WA Method failed with status code {str(ex.code)} ~ {ex.message}"
\ No newline at end of file
+                message, user_ID, new_session_ID, message_is_audio, voice_native)
+        logger.error("WA message failed with status code %s: %s", ex.code, ex.message)
+        return [text_answer(DEFAULT_ERROR_MESSAGE)]
\ No newline at end of file
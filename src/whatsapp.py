@@ -1,17 +1,38 @@
 import hashlib
 import json
-from datetime import datetime
+import threading
+from concurrent.futures import Future, TimeoutError
+from functools import partial
+from timestamps import utc_now
 from flask import Flask, request
 from werkzeug.exceptions import HTTPException
+from typing import Callable, List, Optional
+import accounting
+import contacts
+import delivery
+import health
+import logs
+import metrics
+import rate_limit
+import router
+import scheduler
+from answers import Answer, text_answer
 from file_management import save_media_file
 from audio_services import process_audio_stt
-from redirect_request import redirect_request
-from twilio_deliver import delivering_answer_whatsapp_twilio
+from redirect_request import DEFAULT_ERROR_MESSAGE, redirect_request
+from idempotency import abandon_turn, begin_turn, complete_turn, settling_turn
+from rate_limit import RATE_LIMIT_MESSAGE
+from scheduler import SCHEDULER_BUSY_MESSAGE, SCHEDULER_TIMEOUT
+from tenants import tenant, tenant_by_twilio_number, using_tenant
+from twilio_deliver import (delivering_answer_whatsapp_rest, delivering_answer_whatsapp_twilio,
+                            empty_twilio_answer, signed_by_twilio, text_twilio_answer)
 
 ########################
 # creating the Flask app
 app = Flask(__name__)
 
+logger = logs.get_logger(__name__)
+
 @app.errorhandler(HTTPException)
 def handle_exception(e):
     """
@@ -38,36 +59,53 @@ def handle_exception(e):
     response.content_type = "application/json"
     return response
 
-@app.route("/chatbot-message", methods=['POST'])
-def process_msg():
+def classify_turn(values) -> str:
     """
-    This function handles the route, which is for receiving POST messages from 
-    WhatsApp users through Twilio. It parses each message and passes it to the
-    message handler. It also handles returning responses to WhatsApp users, 
-    which can be audio or text.
+    Classify a message received from Twilio by the cost of its turn: media
+    messages are downloaded, archived and, for voice notes, transcribed and
+    answered with synthesized audio.
+
+    Parameters
+    ----------
+    values : werkzeug.datastructures.CombinedMultiDict
+        The values of the Twilio webhook request.
 
     Returns
     -------
-    resp : MessagingResponse
-        A Twilio message, can be audio or text. For more information on how to use 
-        the class, you can refer to the documentation 
-        `https://www.twilio.com/docs/libraries/reference/twilio-python/`
+    str
+        scheduler.VOICE for media messages, scheduler.TEXT otherwise.
     """
+    return scheduler.VOICE if 'MediaContentType0' in values else scheduler.TEXT
+
+def answering_message(values) -> List[Answer]:
+    """
+    Parses a message received from a WhatsApp user through Twilio and
+    passes it to the message handler.
+
+    Parameters
+    ----------
+    values : werkzeug.datastructures.CombinedMultiDict
+        The values of the Twilio webhook request.
 
-    user_number_ID = request.values.get('WaId')
+    Returns
+    -------
+    List[Answer]
+        The typed answers from the chatbot.
+    """
+    user_number_ID = values.get('WaId')
     encrypted_user_number_ID = hashlib.sha256(
         user_number_ID.encode()).hexdigest()
-    timestamp = datetime.now().utcnow().strftime("%d-%m-%Y_%H:%M:%S:%f_UTC")
+    timestamp = utc_now()
     non_supported_file = False
     message_is_audio = False
 
-    if 'MediaContentType0' in request.values:
+    if 'MediaContentType0' in values:
         # If the incoming message is a media file
-        if request.values['MediaContentType0'] == 'audio/ogg':
+        if values['MediaContentType0'] == 'audio/ogg':
             # If the incoming message is a recorded audio file
             message_is_audio = True
             audio_link, message_recognized = process_audio_stt(
-                request.values['MediaUrl0'], 
+                values['MediaUrl0'], 
                 encrypted_user_number_ID, 
                 timestamp)
             message = [audio_link, message_recognized]
@@ -83,8 +121,8 @@ def process_msg():
             file_link = save_media_file(
                 encrypted_user_number_ID,
                 timestamp,
-                request.values['MediaContentType0'],
-                request.values['MediaUrl0'])
+                values['MediaContentType0'],
+                values['MediaUrl0'])
             assistant_answer = redirect_request(
                 file_link,
                 encrypted_user_number_ID,
@@ -93,7 +131,7 @@ def process_msg():
                 non_supported_file)
     else:
         # If the incoming message is a text message
-        message = str(request.values.get('Body'))
+        message = str(values.get('Body'))
         message = message.replace('\n', ' ').capitalize()
         assistant_answer = redirect_request(
             message,
@@ -102,8 +140,313 @@ def process_msg():
             timestamp,
             non_supported_file)
 
-    return delivering_answer_whatsapp_twilio(
-        assistant_answer, user_number_ID)
+    return assistant_answer
+
+class PendingReply:
+    """
+    The reply of a text turn, handed from its job to the webhook waiting for
+    it. Whichever comes first decides: the job claims the reply for the
+    webhook, which returns it as TwiML, or the webhook gives up on it once
+    SCHEDULER_TIMEOUT is over, and the job delivers it through the REST API.
+    """
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.claimed   = False
+        self.abandoned = False
+
+    def claiming(self) -> bool:
+        with self.lock:
+            self.claimed = not self.abandoned
+            return self.claimed
+
+    def abandoning(self) -> bool:
+        with self.lock:
+            self.abandoned = not self.claimed
+            return self.abandoned
+
+def answering_message_twiml(values, pending: PendingReply) -> str:
+    """
+    Answers a message and builds the reply, which can be audio or text. If
+    the webhook stopped waiting for it, every part of the reply is delivered
+    through the REST API instead.
+
+    Parameters
+    ----------
+    values : werkzeug.datastructures.CombinedMultiDict
+        The values of the Twilio webhook request.
+    pending : PendingReply
+        The reply the webhook waits for.
+
+    Returns
+    -------
+    str
+        A TwiML string containing the chatbot's answer, an empty one if it
+        was delivered through the REST API.
+    """
+    assistant_answer = answering_message(values)
+    if pending.claiming():
+        return delivering_answer_whatsapp_twilio(assistant_answer, values.get('WaId'))
+    metrics.increment("scheduler.text.delivered_late")
+    delivering_answer_whatsapp_rest(assistant_answer, values.get('WaId'))
+    return empty_twilio_answer()
+
+def replying_failure(user_number_ID: str) -> Callable[[Future], None]:
+    """
+    Build the done-callback of a turn answered through the REST API, which
+    sends DEFAULT_ERROR_MESSAGE to the user if the turn fails: Twilio already
+    got its reply and will not retry the message.
+
+    Parameters
+    ----------
+    user_number_ID : str
+        The WhatsApp ID of the user.
+
+    Returns
+    -------
+    Callable[[Future], None]
+        The callback, for `Future.add_done_callback`.
+    """
+    # The callback runs outside the context of the turn
+    user_tenant = tenant()
+    def replying(future: Future):
+        if not future.cancelled() and future.exception() is None:
+            return
+        metrics.increment("whatsapp.failed_turns")
+        try:
+            with using_tenant(user_tenant):
+                delivering_answer_whatsapp_rest(
+                    [text_answer(DEFAULT_ERROR_MESSAGE)], user_number_ID)
+        except Exception as e:
+            logger.error("Cannot tell %s their turn failed: %r", user_number_ID, e)
+    return replying
+
+def waiting_reply(future: Future, pending: PendingReply) -> Optional[str]:
+    """
+    Wait for the TwiML reply of a text turn, at most SCHEDULER_TIMEOUT
+    seconds unless its job already claimed it.
+
+    Parameters
+    ----------
+    future : Future
+        The future of the job.
+    pending : PendingReply
+        The reply the job hands over.
+
+    Returns
+    -------
+    Optional[str]
+        The reply, None if the webhook gave up on it.
+    """
+    try:
+        return future.result(SCHEDULER_TIMEOUT)
+    except TimeoutError:
+        if pending.abandoning():
+            return None
+        # The job has its answers and is building the TwiML
+        return future.result()
+
+def answering_message_rest(values):
+    """
+    Answers a message and delivers every part of the reply through the
+    Twilio REST API, for turns processed after the webhook returned.
+
+    Parameters
+    ----------
+    values : werkzeug.datastructures.CombinedMultiDict
+        The values of the Twilio webhook request.
+    """
+    delivering_answer_whatsapp_rest(
+        answering_message(values), values.get('WaId'))
+
+@app.route("/chatbot-message", methods=['POST'])
+def process_msg():
+    """
+    This function handles the route, which is for receiving POST messages from 
+    WhatsApp users through Twilio. Twilio retries the webhook when the reply
+    is slow, so each message is processed once per MessageSid: a retry gets
+    the cached reply, or an empty acknowledgement while the original message
+    is still being processed.
+
+    Text turns are answered in the text pool and replied with TwiML. Media
+    turns are acknowledged at once and answered in the voice pool, through
+    the REST API, so that they do not hold web workers. A turn refused by
+    admission control gets SCHEDULER_BUSY_MESSAGE, if set. A text turn not
+    answered within SCHEDULER_TIMEOUT gets an empty reply and keeps running,
+    then delivers its answers through the REST API.
+
+    Before any of this, the sender must be within their rate limit; a
+    throttled message gets RATE_LIMIT_MESSAGE, if set, and nothing else.
+    The message is processed on behalf of the tenant owning its `To` number.
+
+    When the app runs on several nodes, the message is first forwarded to the
+    node owning its user on the consistent-hash ring, so that the sessions and
+    caches of a user stay on one node; it is processed locally if that node
+    cannot be reached. The turns of a user run one at a time.
+
+    Returns
+    -------
+    resp : MessagingResponse
+        A Twilio message, can be audio or text. For more information on how to use 
+        the class, you can refer to the documentation 
+        `https://www.twilio.com/docs/libraries/reference/twilio-python/`
+    """
+    values    = request.values.copy()
+    user_hash = hashlib.sha256(str(values.get('WaId')).encode()).hexdigest()
+    kind      = classify_turn(values)
+    with using_tenant(tenant_by_twilio_number(values.get('To'))), \
+            logs.turn(user_hash, values.get('MessageSid')), logs.timing_stages(), \
+            delivery.tracking_turn(), accounting.classified(kind):
+        node = None if router.is_forwarded(request.headers) else router.owner_node(user_hash)
+        if node:
+            try:
+                response = router.forwarding(
+                    node, request.path, {}, data=list(request.form.items(multi=True)))
+            except router.ForwardingFailed:
+                # The owner may still answer, a retry of Twilio goes to it again
+                return "", 502
+            if response is not None:
+                return response.text
+        # Without a MessageSid there is nothing to recognize a retry by
+        turn_key = "twilio:" + values['MessageSid'] if values.get('MessageSid') else None
+        duplicate, cached_reply = begin_turn(turn_key)
+        if duplicate:
+            return cached_reply or empty_twilio_answer()
+        if not rate_limit.acquire_turn(user_hash, kind == scheduler.VOICE):
+            reply = text_twilio_answer(RATE_LIMIT_MESSAGE)
+            complete_turn(turn_key, reply)
+            return reply
+        contacts.register_contact(user_hash, contacts.WHATSAPP, values.get('WaId'))
+        if kind == scheduler.VOICE:
+            answering, arguments = answering_message_rest, (values,)
+        else:
+            pending = PendingReply()
+            answering, arguments = answering_message_twiml, (values, pending)
+        try:
+            future = router.submitting_in_order(
+                user_hash, partial(scheduler.submit, kind), answering, *arguments)
+        except scheduler.Overloaded:
+            rate_limit.release_turn(user_hash)
+            abandon_turn(turn_key)
+            return text_twilio_answer(SCHEDULER_BUSY_MESSAGE)
+        future.add_done_callback(rate_limit.releasing_when_done(user_hash))
+        if kind == scheduler.VOICE:
+            future.add_done_callback(scheduler.reporting_failure)
+            future.add_done_callback(replying_failure(values.get('WaId')))
+            future.add_done_callback(settling_turn(turn_key))
+            return empty_twilio_answer()
+        try:
+            reply = waiting_reply(future, pending)
+        except scheduler.Overloaded:
+            # Refused once the previous turn of the user was over
+            abandon_turn(turn_key)
+            return text_twilio_answer(SCHEDULER_BUSY_MESSAGE)
+        except Exception:
+            abandon_turn(turn_key)
+            raise
+        if reply is None:
+            # The turn is still running and delivers its answers through the
+            # REST API: it stays in flight, so a retry of Twilio is not
+            # processed a second time
+            metrics.increment("scheduler.text.timeouts")
+            future.add_done_callback(scheduler.reporting_failure)
+            future.add_done_callback(replying_failure(values.get('WaId')))
+            future.add_done_callback(settling_turn(turn_key))
+            return empty_twilio_answer()
+        complete_turn(turn_key, reply)
+        return reply
+
+@app.route("/delivery-status", methods=['POST'])
+def receiving_delivery_status():
+    """
+    Receives the status callbacks Twilio posts for the outbound messages.
+    The turn, the part and the start of the turn come in the query string
+    set by `delivery.status_callback`. Callbacks without a valid Twilio
+    signature are refused.
+
+    Returns
+    -------
+    Tuple[str, int]
+        An empty body, and the HTTP status.
+    """
+    values = request.values
+    signed_url = f"{delivery.DELIVERY_STATUS_CALLBACK_URL}?{request.query_string.decode()}"
+    if not signed_by_twilio(signed_url, request.form.to_dict(),
+                            request.headers.get('X-Twilio-Signature', '')):
+        metrics.increment("delivery.whatsapp.unsigned")
+        return "", 403
+    try:
+        started = float(request.args.get('t0'))
+        part    = int(request.args.get('part'))
+    except (TypeError, ValueError):
+        started, part = None, None
+    delivery.recording(
+        "whatsapp", values.get('MessageStatus', 'unknown'), request.args.get('turn'),
+        part, started, values.get('ErrorCode'))
+    return "", 204
+
+@app.route("/delivery-status", methods=['GET'])
+def export_delivery_status():
+    """
+    Exports the delivery latency percentiles and the failure rate of each
+    channel, over the latest status events.
+
+    Returns
+    -------
+    dict
+        The summary, by channel then status.
+    """
+    return delivery.summary()
+
+@app.route("/usage", methods=['GET'])
+def export_usage():
+    """
+    Exports the metered usage of the last flush and of the one in progress,
+    by message type, with the users consuming the most of each resource.
+
+    Returns
+    -------
+    dict
+        The totals by message type then resource, and the top users by resource.
+    """
+    return accounting.snapshot()
+
+@app.route("/metrics", methods=['GET'])
+def export_metrics():
+    """
+    Exports the in-process counters and gauges as JSON.
+
+    Returns
+    -------
+    dict
+        The counters and the gauges, by name.
+    """
+    return metrics.snapshot()
+
+@app.route("/healthz", methods=['GET'])
+def liveness():
+    """
+    Tells that the worker is alive, without calling any dependency.
+
+    Returns
+    -------
+    dict
+        The status of the worker.
+    """
+    return {"status": "ok"}
+
+@app.route("/readyz", methods=['GET'])
+def readiness():
+    """
+    Tells whether the worker is warm: its clients have reached Cloudant,
+    COS and the Watson services. Answers 503 until they have.
+
+    Returns
+    -------
+    Tuple[dict, int]
+        The last check of each dependency, and the HTTP status.
+    """
+    ready, checks = health.readiness()
+    return {"ready": ready, "dependencies": checks}, 200 if ready else 503
 
 if __name__ == "__main__":
     app.run(host = '0.0.0.0', port = 8080, debug = True)
\ No newline at end of file